@@ -24,13 +24,13 @@ from easydict import EasyDict as edict
 
 from qtpy import QtGui, QtCore, QtWidgets
 from qtpy.QtWidgets import QMainWindow, QMessageBox, QTableWidgetItem
-from qtpy.QtGui import QImage, QPixmap
 from qtpy.QtCore import Qt, QByteArray, QVariant, QCoreApplication, QThread, Signal
+from qtpy.QtCore import QObject
 import cv2
 import numpy as np
 
 from eiseg import pjpath, __APPNAME__, logger
-from widget import ShortcutWidget, PolygonAnnotation
+from widget import ShortcutWidget, PolygonAnnotation, TiledImageItem
 from controller import InteractiveController
 from ui import Ui_EISeg
 import util
@@ -47,20 +47,49 @@ from plugin.n2grid import RSGrids, Grids, checkOpenGrid
 class ModelThread(QThread):
     _signal = Signal(dict)
 
-    def __init__(self, controller, param_path):
+    def __init__(self, controller, param_path, inference_config=None):
         super().__init__()
         self.controller = controller
         self.param_path = param_path
+        self.inference_config = inference_config or {}
 
     def run(self):
-        success, res = self.controller.setModel(self.param_path, False)
+        success, res = self.controller.setModel(
+            self.param_path,
+            False,
+            precision=self.inference_config.get("precision", "fp32"),
+            backend=self.inference_config.get("backend", "paddle"),
+        )
         self._signal.emit(
             {"success": success, "res": res, "param_path": self.param_path}
         )
 
 
+class InferenceWorker(QObject):
+    """在推理线程中推理未推理的点击，推理期间来的点击合并到下一次推理"""
+
+    _signal = Signal(dict)
+
+    def __init__(self, controller):
+        super().__init__()
+        self.controller = controller
+
+    def run(self):
+        while True:
+            try:
+                pred = self.controller.inferPendingClicks()
+            except Exception as e:
+                logger.error(f"Inference failed: {e}")
+                self._signal.emit({"success": False, "res": str(e)})
+                return
+            if pred is None:
+                return
+            self._signal.emit({"success": True, "res": "推理完成"})
+
+
 class APP_EISeg(QMainWindow, Ui_EISeg):
     IDILE, ANNING, EDITING = 0, 1, 2
+    inferRequested = Signal()
     # IDILE：网络，权重，图像三者任一没有加载
     # EDITING：多边形编辑，可以交互式，但是多边形内部不能点
     # ANNING：交互式标注，只能交互式，不能编辑多边形，多边形不接hover
@@ -102,12 +131,24 @@ class APP_EISeg(QMainWindow, Ui_EISeg):
                 "net_clicks_limit": None,
                 "max_size": 800,
                 "with_mask": True,
+                "use_numpy": True,
             },
         }
+        self.config = util.parse_configs(osp.join(pjpath, "config/config.yaml"))
         self.controller = InteractiveController(
             predictor_params=self.predictor_params,
             prob_thresh=self.segThresh,
+            history_params=(self.config or {}).get("history"),
         )
+        # 点击在推理线程中推理，界面不会卡住
+        self.inferThread = QThread()
+        self.inferWorker = InferenceWorker(self.controller)
+        self.inferWorker.moveToThread(self.inferThread)
+        self.inferRequested.connect(self.inferWorker.run)
+        self.inferWorker._signal.connect(self.__infer_callback)
+        self.inferThread.start()
+        # 推理期间按了完成，推理结束后在回调中完成当前目标
+        self._finishRequested = False
         # self.controller.labelList = util.LabelList()  # 标签列表
         self.save_status = {
             "gray_scale": True,
@@ -171,7 +212,6 @@ class APP_EISeg(QMainWindow, Ui_EISeg):
         )
         self.recentFiles = self.settings.value("recent_files", QVariant([]), type=list)
 
-        self.config = util.parse_configs(osp.join(pjpath, "config/config.yaml"))
 
         # 支持的图像格式
         rs_ext = [".tif", ".tiff"]
@@ -214,7 +254,7 @@ class APP_EISeg(QMainWindow, Ui_EISeg):
         self.scene.clickRequest.connect(self.canvasClick)
         self.canvas.zoomRequest.connect(self.viewZoomed)
         self.canvas.mousePosChanged.connect(self.scene.onMouseChanged)
-        self.annImage = QtWidgets.QGraphicsPixmapItem()
+        self.annImage = TiledImageItem()
         self.scene.addItem(self.annImage)
 
         ## 按钮点击
@@ -846,7 +886,9 @@ class APP_EISeg(QMainWindow, Ui_EISeg):
             return False
 
         # success, res = self.controller.setModel(param_path)
-        self.load_thread = ModelThread(self.controller, param_path)
+        # 推理后端和精度在config.yaml的inference中设置
+        inference_config = (self.config or {}).get("inference")
+        self.load_thread = ModelThread(self.controller, param_path, inference_config)
         self.load_thread._signal.connect(self.__change_model_callback)
         self.load_thread.start()
 
@@ -1124,8 +1166,7 @@ class APP_EISeg(QMainWindow, Ui_EISeg):
     def getMask(self):
         if not self.controller or self.controller.image is None:
             return
-        s = self.controller.imgShape
-        pesudo = np.zeros([s[0], s[1]])
+        polygons = []
         # 覆盖顺序，从上往下
         # TODO: 是标签数值大的会覆盖小的吗?
         # A: 是列表中上面的覆盖下面的，由于标签可以移动，不一定是大小按顺序覆盖
@@ -1135,9 +1176,9 @@ class APP_EISeg(QMainWindow, Ui_EISeg):
             idx = int(self.labelListTable.item(len_lab - i - 1, 0).text())
             for poly in self.scene.polygon_items:
                 if poly.labelIndex == idx:
-                    pts = np.int32([np.array(poly.scnenePoints)])
-                    cv2.fillPoly(pesudo, pts=pts, color=idx)
-        return pesudo
+                    polygons.append((poly, idx, poly.scnenePoints))
+        # 控制器只重画增删改过的多边形
+        return self.controller.getMask(polygons)
 
     def openRecentImage(self, file_path):
         self.queueEvent(partial(self.loadImage, file_path))
@@ -1487,6 +1528,17 @@ class APP_EISeg(QMainWindow, Ui_EISeg):
         self.turnImg(delta, True)
 
     def finishObject(self):
+        if not self.controller or self.image is None:
+            return
+        # 还在推理时不等待，推理结束后再完成
+        if self.controller.hasPendingInference:
+            self._finishRequested = True
+            return
+        self.finishObjectNow()
+
+    def finishObjectNow(self):
+        """马上完成当前目标，有没推理的点击时等推理完，保存前使用"""
+        self._finishRequested = False
         if not self.controller or self.image is None:
             return
         current_mask, curr_polygon = self.controller.finishObject(
@@ -1522,7 +1574,7 @@ class APP_EISeg(QMainWindow, Ui_EISeg):
             QMessageBox.Yes | QMessageBox.Cancel,
         )
         if res == QMessageBox.Yes:
-            self.finishObject()
+            self.finishObjectNow()
             self.exportLabel()
             self.setDirty(False)
             return True
@@ -1554,7 +1606,7 @@ class APP_EISeg(QMainWindow, Ui_EISeg):
                 self.updateImage()
                 self.controller.image = None
         if close:
-            self.annImage.setPixmap(QPixmap())
+            self.annImage.setImage(None)
 
     def exportLabel(self, saveAs=False, savePath=None, lab_input=None):
         # 1. 需要处于标注状态
@@ -1798,8 +1850,11 @@ class APP_EISeg(QMainWindow, Ui_EISeg):
             return
         if not self.controller:
             return
+        # 正在推理的点击推理结束后才撤销，不等待
         self.controller.undoClick()
         self.updateImage()
+        # 撤销到一次合并推理的点击中间时，剩下的点击要重新推理
+        self.inferRequested.emit()
         if not self.controller.is_incomplete_mask:
             self.setDirty(False)
 
@@ -1828,16 +1883,26 @@ class APP_EISeg(QMainWindow, Ui_EISeg):
             self.warn(self.tr("未选择模型", self.tr("尚未选择模型，请先在右上角选择模型")))
             return
 
-        if self.status == self.IDILE:
+        if self.status == self.IDILE or self._finishRequested:
             return
         currLabel = self.controller.curr_label_number
         if not currLabel or currLabel == 0:
             self.warn(self.tr("未选择当前标签"), self.tr("请先在标签列表中单击点选标签"))
             return
 
-        self.controller.addClick(x, y, isLeft)
+        # 先显示点击，推理在推理线程中进行
+        self.controller.addPendingClick(x, y, isLeft)
         self.updateImage()
         self.status = self.ANNING
+        self.inferRequested.emit()
+
+    def __infer_callback(self, signal_dict: dict):
+        if not signal_dict["success"]:
+            self.warn(self.tr("推理失败"), signal_dict["res"])
+        if self.controller.image is not None:
+            self.updateImage()
+        if self._finishRequested and not self.controller.hasPendingInference:
+            self.finishObject()
 
     def updateImage(self, reset_canvas=False):
         if not self.controller:
@@ -1846,12 +1911,15 @@ class APP_EISeg(QMainWindow, Ui_EISeg):
             alpha_blend=self.opacity,
             click_radius=self.clickRadius,
         )
-        height, width, _ = image.shape
-        bytesPerLine = 3 * width
-        image = QImage(image.data, width, height, bytesPerLine, QImage.Format_RGB888)
+        # 可视化结果是原地更新的缓存，只刷新画布中改过的块
+        region = self.controller.popVisDirtyRegion()
+        if image is not self.annImage.image:
+            self.annImage.setImage(image)
+        elif region is not None:
+            self.annImage.updateRegion(region)
         if reset_canvas:
+            height, width, _ = image.shape
             self.resetZoom(width, height)
-        self.annImage.setPixmap(QPixmap(image))
 
     def viewZoomed(self, scale):
         self.scene.scale = scale
@@ -2190,7 +2258,7 @@ class APP_EISeg(QMainWindow, Ui_EISeg):
             if save_path == "":
                 return
         try:
-            self.finishObject()
+            self.finishObjectNow()
             self.saveGrid()  # 先保存当前
         except:
             pass
@@ -2319,6 +2387,8 @@ class APP_EISeg(QMainWindow, Ui_EISeg):
     def closeEvent(self, event):
         self.saveImage()
         self.saveLayout()
+        self.inferThread.quit()
+        self.inferThread.wait()
         QCoreApplication.quit()
         # sys.exit(0)
 
@@ -0,0 +1,204 @@
+# Copyright (c) 2021 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+自动调优CPU推理配置。
+
+用LimitLongestSide和ZoomIn产生的输入大小构造随机输入，测试不同的线程数、是否开启MKLDNN、
+MKLDNN缓存大小和是否开启IR优化，把最快的配置按机器、模型和推理精度保存，之后加载模型时
+自动使用。bf16和int8总是开启MKLDNN，需要用--precision分别调优。
+"""
+
+import os
+import time
+import argparse
+import itertools
+
+import numpy as np
+
+from eiseg import logger
+from models import EISegModel, save_tuned_config, TUNED_CONFIG_PATH, PRECISIONS
+
+
+# 界面中的默认推理配置：ZoomIn缩放到400x400，LimitLongestSide限制最长边为800
+DEFAULT_SHAPES = ((400, 400), (600, 800), (800, 800))
+
+
+def get_thread_candidates(max_threads=None):
+    """1, 2, 4, ... 直到CPU核数"""
+    max_threads = max_threads or os.cpu_count() or 1
+    threads = []
+    num = 1
+    while num < max_threads:
+        threads.append(num)
+        num *= 2
+    threads.append(max_threads)
+    return threads
+
+
+def get_candidates(threads=None, cache_capacities=(0, 10), precision="fp32"):
+    """所有要测试的CPU推理配置，bf16和int8总是开启MKLDNN"""
+    threads = threads or get_thread_candidates()
+    mkldnn_options = (True, False) if precision == "fp32" else (True,)
+    candidates = []
+    for num_threads, use_mkldnn, ir_optim in itertools.product(
+        threads, mkldnn_options, (True, False)
+    ):
+        capacities = cache_capacities if use_mkldnn else (0,)
+        for capacity in capacities:
+            candidates.append(
+                {
+                    "num_threads": num_threads,
+                    "use_mkldnn": use_mkldnn,
+                    "mkldnn_cache_capacity": capacity,
+                    "ir_optim": ir_optim,
+                }
+            )
+    return candidates
+
+
+def get_inputs(model, shape, rng):
+    """构造一组随机输入
+
+    图像3通道，点击特征是上一次的结果加正负点击共3通道，模型声明了通道数时以模型为准
+    """
+    net = model.model
+    inputs = []
+    for name in model.get_input_names():
+        declared = net.get_input_handle(name).shape()
+        channels = declared[1] if len(declared) > 1 and declared[1] > 0 else 3
+        inputs.append(rng.rand(1, channels, *shape).astype("float32"))
+    return inputs
+
+
+def benchmark(
+    model_path,
+    param_path,
+    cpu_config,
+    shapes=DEFAULT_SHAPES,
+    repeats=5,
+    precision="fp32",
+):
+    """测试一个配置，返回各输入大小中位数耗时的和，单位秒
+
+    和推理器一样通过model.run推理，耗时包含输入输出的拷贝
+    """
+    model = EISegModel(
+        model_path,
+        param_path,
+        cpu_config=cpu_config,
+        use_tuned=False,
+        precision=precision,
+    )
+    rng = np.random.RandomState(0)
+    latency = 0
+    for shape in shapes:
+        inputs = get_inputs(model, shape, rng)
+        times = []
+        # 第一次推理包含MKLDNN的初始化，不计时
+        for i in range(repeats + 1):
+            tic = time.perf_counter()
+            model.run(inputs)
+            if i > 0:
+                times.append(time.perf_counter() - tic)
+        latency += float(np.median(times))
+    return latency
+
+
+def autotune(
+    model_path,
+    param_path,
+    threads=None,
+    shapes=DEFAULT_SHAPES,
+    repeats=5,
+    save=True,
+    path=TUNED_CONFIG_PATH,
+    precision="fp32",
+):
+    """测试所有配置，返回最快的配置和每个配置的耗时
+
+    model_path和param_path是fp32模型，int8会加载eiseg-quantize保存的量化模型
+    """
+    results = []
+    for cpu_config in get_candidates(threads, precision=precision):
+        try:
+            latency = benchmark(
+                model_path, param_path, cpu_config, shapes, repeats, precision
+            )
+        except Exception as e:
+            logger.error(f"Benchmark {cpu_config} failed: {e}")
+            continue
+        logger.info(f"Autotune {cpu_config}: {latency}s")
+        results.append((latency, cpu_config))
+    if not results:
+        raise RuntimeError("所有推理配置都测试失败")
+    results.sort(key=lambda x: x[0])
+    best_latency, best = results[0]
+    if save:
+        best_config = dict(best, latency=best_latency)
+        save_tuned_config(model_path, param_path, best_config, path, precision)
+    return best, results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="自动调优CPU推理配置")
+    parser.add_argument("--param_path", type=str, required=True, help="模型权重路径")
+    parser.add_argument(
+        "--threads",
+        type=str,
+        default=None,
+        help="测试的线程数，逗号分隔，默认1,2,4,...,CPU核数",
+    )
+    parser.add_argument(
+        "--shapes",
+        type=str,
+        default=",".join(f"{h}x{w}" for h, w in DEFAULT_SHAPES),
+        help="测试的输入大小，逗号分隔，如400x400,600x800",
+    )
+    parser.add_argument("--repeats", type=int, default=5, help="每个输入大小测试的次数")
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="fp32",
+        choices=PRECISIONS,
+        help="调优的推理精度，int8需要先用eiseg-quantize量化模型",
+    )
+    parser.add_argument("--no_save", action="store_true", help="只测试不保存结果")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    model_path = args.param_path.replace(".pdiparams", ".pdmodel")
+    threads = None
+    if args.threads:
+        threads = [int(t) for t in args.threads.split(",")]
+    shapes = [tuple(int(v) for v in s.split("x")) for s in args.shapes.split(",")]
+    best, results = autotune(
+        model_path,
+        args.param_path,
+        threads=threads,
+        shapes=shapes,
+        repeats=args.repeats,
+        save=not args.no_save,
+        precision=args.precision,
+    )
+    for latency, cpu_config in results:
+        print(f"{latency * 1000:8.2f} ms  {cpu_config}")
+    print(f"Best: {best}")
+    if not args.no_save:
+        print(f"Saved to {TUNED_CONFIG_PATH}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,432 @@
+# Copyright (c) 2021 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+不启动界面，按记录的点击批量重新生成标签。
+
+每张图片对应一个点击脚本 <图片名>.json，格式为
+{
+    "objects": [
+        {
+            "label": 1,                     标签id
+            "clicks": [[x, y, 1], ...],     点击坐标和是否是正点
+            "building": false               可选，是否使用建筑边界简化
+        },
+        ...
+    ]
+}
+点击按顺序送入InteractiveController.addClick，每个物体结束时调用finishObject，
+保存的灰度图、伪彩色、抠图、json和coco格式与界面中的保存标签一致。
+"""
+
+import os
+import os.path as osp
+import json
+import time
+import argparse
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from eiseg import logger
+from controller import InteractiveController
+from models import PredictorPool, PRECISIONS, BACKENDS
+from util import COCO, LabelList, colorMap
+from inference.evaluation import IMAGE_EXTS
+
+
+SAVE_FORMATS = ("gray_scale", "pseudo_color", "cutout", "json", "coco")
+
+PREDICTOR_PARAMS = {
+    "brs_mode": "NoBRS",
+    "with_flip": False,
+    "zoom_in_params": {
+        "skip_clicks": -1,
+        "target_size": (400, 400),
+        "expansion_ratio": 1.4,
+    },
+    "predictor_params": {
+        "net_clicks_limit": None,
+        "max_size": 800,
+        "with_mask": True,
+        "use_numpy": True,
+    },
+}
+
+# 每个进程一个控制器，只在进程启动时加载一次模型
+_worker = None
+
+
+def get_label_color(label_idx):
+    """标签文件中没有的标签按id取颜色，各个进程中同一个id的颜色相同"""
+    return colorMap.colors[(label_idx - 1) % len(colorMap)]
+
+
+class BatchAnnotator(object):
+    """用一个InteractiveController回放点击脚本并保存标签
+
+    Parameters
+    ----------
+    param_path : str
+        模型权重路径
+    label_path : str
+        标签列表文件，格式和界面导出的标签列表一致，为None时按点击脚本中的id生成
+    output_dir : str
+        标签保存路径
+    save_status : dict
+        保存哪些格式，键和SAVE_FORMATS一致
+    num_threads : int
+        每个进程CPU推理使用的线程数
+    pool : models.PredictorPool
+        不为None时从推理器池中取模型，不再加载param_path
+    precision : str
+        CPU推理精度，fp32、bf16或int8
+    backend : str
+        推理后端，paddle或onnxruntime
+    """
+
+    def __init__(
+        self,
+        param_path,
+        label_path=None,
+        output_dir=None,
+        save_status=None,
+        num_threads=None,
+        use_gpu=False,
+        prob_thresh=0.5,
+        lcc_filter=False,
+        cutout_background=(0, 0, 128, 255),
+        pool=None,
+        precision="fp32",
+        backend="paddle",
+    ):
+        self.output_dir = output_dir
+        self.save_status = save_status or {k: True for k in SAVE_FORMATS}
+        self.cutout_background = list(cutout_background)
+        self.controller = InteractiveController(
+            predictor_params=PREDICTOR_PARAMS, prob_thresh=prob_thresh
+        )
+        self.controller.filterLargestCC(lcc_filter)
+        if pool is not None:
+            self.controller.setModelFromPool(pool)
+        else:
+            self.controller.setModel(
+                param_path, use_gpu, num_threads, precision=precision, backend=backend
+            )
+        if label_path is not None:
+            self.controller.importLabel(label_path)
+
+    def annotate(self, image_path, clicks_path):
+        """标注一张图片
+
+        Returns
+        -------
+        dict
+            图片名，大小，所有多边形[(标签id, 点)]和用时
+        """
+        tic = time.time()
+        image = cv2.imdecode(np.fromfile(image_path, dtype=np.uint8), 1)
+        image = image[:, :, ::-1]  # BGR转RGB
+        with open(clicks_path, "r", encoding="utf-8") as f:
+            script = json.load(f)
+        objects = script["objects"] if isinstance(script, dict) else script
+
+        controller = self.controller
+        controller.setImage(image)
+        polygons = []
+        for obj in objects:
+            label_idx = int(obj["label"])
+            if controller.labelList.getLabelById(label_idx) is None:
+                controller.addLabel(
+                    label_idx, str(label_idx), get_label_color(label_idx)
+                )
+            controller.setCurrLabelIdx(label_idx)
+            for x, y, is_positive in obj["clicks"]:
+                controller.addClick(int(x), int(y), bool(is_positive))
+            _, polygon = controller.finishObject(building=obj.get("building", False))
+            if polygon is None:
+                logger.info(f"{image_path} 中的物体 {obj} 没有生成多边形")
+                continue
+            for points in polygon:
+                if len(points) < 3:
+                    continue
+                points = [[int(p[0]), int(p[1])] for p in points]
+                polygons.append((label_idx, points))
+
+        name = osp.basename(image_path)
+        if self.output_dir is not None:
+            self.save(name, image, polygons)
+        return {
+            "name": name,
+            "shape": image.shape[:2],
+            "polygons": polygons,
+            "time": time.time() - tic,
+        }
+
+    def getMask(self, polygons):
+        # 和界面一致，标签列表中靠后的标签覆盖靠前的
+        polygons = [
+            (points, label_idx, points)
+            for lab in self.controller.labelList
+            for label_idx, points in polygons
+            if label_idx == lab.idx
+        ]
+        return self.controller.getMask(polygons)
+
+    def save(self, name, image, polygons):
+        """按界面中exportLabel的方式保存除coco外的标签"""
+        savePath = osp.join(self.output_dir, osp.splitext(name)[0] + ".png")
+        mask_output = self.getMask(polygons)
+        s = image.shape
+        labelList = self.controller.labelList
+
+        if self.save_status["gray_scale"]:
+            cv2.imencode(".png", mask_output)[1].tofile(savePath)
+
+        if self.save_status["pseudo_color"]:
+            pseudoPath, ext = osp.splitext(savePath)
+            pseudoPath = pseudoPath + "_pseudo" + ext
+            pseudo = np.zeros([s[0], s[1], 3])
+            for lab in labelList:
+                pseudo[mask_output == lab.idx, :] = lab.color[::-1]
+            cv2.imencode(ext, pseudo)[1].tofile(pseudoPath)
+
+        if self.save_status["cutout"]:
+            mattingPath, ext = osp.splitext(savePath)
+            mattingPath = mattingPath + "_cutout" + ext
+            img = np.ones([s[0], s[1], 4], dtype="uint8") * 255
+            img[:, :, :3] = image
+            img[mask_output == 0] = self.cutout_background
+            img = cv2.cvtColor(img, cv2.COLOR_RGBA2BGRA)
+            cv2.imencode(ext, img)[1].tofile(mattingPath)
+
+        if self.save_status["json"]:
+            labels = []
+            for label_idx, points in polygons:
+                l = labelList.getLabelById(label_idx)
+                labels.append(
+                    {
+                        "name": l.name,
+                        "labelIdx": l.idx,
+                        "color": l.color,
+                        "points": points,
+                    }
+                )
+            jsonPath = osp.splitext(savePath)[0] + ".json"
+            open(jsonPath, "w", encoding="utf-8").write(json.dumps(labels))
+
+
+def _init_worker(kwargs):
+    global _worker
+    _worker = BatchAnnotator(**kwargs)
+
+
+def _annotate(task):
+    return _worker.annotate(*task)
+
+
+_thread_workers = threading.local()
+
+
+def _annotate_in_thread(task, kwargs):
+    # 每个线程第一次用到时从推理器池中取一个模型
+    if not hasattr(_thread_workers, "annotator"):
+        _thread_workers.annotator = BatchAnnotator(**kwargs)
+    return _thread_workers.annotator.annotate(*task)
+
+
+def get_tasks(image_dir, clicks_dir):
+    """找出有点击脚本的图片"""
+    tasks = []
+    for name in sorted(os.listdir(image_dir)):
+        if not name.lower().endswith(IMAGE_EXTS):
+            continue
+        clicks_path = osp.join(clicks_dir, osp.splitext(name)[0] + ".json")
+        if not osp.exists(clicks_path):
+            logger.info(f"{name} 没有点击脚本，跳过")
+            continue
+        tasks.append((osp.join(image_dir, name), clicks_path))
+    return tasks
+
+
+def save_coco(results, labelList, output_dir):
+    coco = COCO()
+    for res in results:
+        imgId = coco.addImage(res["name"], res["shape"][1], res["shape"][0])
+        for label_idx, points in res["polygons"]:
+            coco.addAnnotation(imgId, label_idx, [v for p in points for v in p])
+    for lab in labelList:
+        coco.addCategory(lab.idx, lab.name, lab.color)
+    cocoPath = osp.join(output_dir, "annotations.json")
+    open(cocoPath, "w", encoding="utf-8").write(json.dumps(coco.dataset))
+
+
+def run(
+    image_dir,
+    clicks_dir,
+    output_dir,
+    param_path,
+    label_path=None,
+    num_workers=1,
+    num_threads=None,
+    save_status=None,
+    use_threads=False,
+    **kwargs,
+):
+    """批量标注，返回每张图片的结果和每秒处理的图片数
+
+    use_threads为True时在一个进程中开num_workers个线程，共享一个推理器池，
+    否则每个进程加载一份模型。
+    """
+    tasks = get_tasks(image_dir, clicks_dir)
+    if num_threads is None and num_workers > 1:
+        # 多个worker平分CPU，只有一个时用自动调优的结果或默认值
+        num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+    if not osp.exists(output_dir):
+        os.makedirs(output_dir)
+    save_status = save_status or {k: True for k in SAVE_FORMATS}
+    worker_kwargs = dict(
+        param_path=param_path,
+        label_path=label_path,
+        output_dir=output_dir,
+        save_status=save_status,
+        num_threads=num_threads,
+        **kwargs,
+    )
+
+    tic = time.time()
+    if num_workers <= 1:
+        _init_worker(worker_kwargs)
+        results = [_annotate(task) for task in tasks]
+    elif use_threads:
+        # paddle推理时释放GIL，各线程的推理器共享权重
+        model_path = param_path.replace(".pdiparams", ".pdmodel")
+        worker_kwargs["pool"] = PredictorPool(
+            model_path,
+            param_path,
+            size=num_workers,
+            use_gpu=kwargs.get("use_gpu", False),
+            num_threads=num_threads,
+            precision=kwargs.get("precision", "fp32"),
+            backend=kwargs.get("backend", "paddle"),
+        )
+        with ThreadPoolExecutor(num_workers) as executor:
+            results = list(
+                executor.map(
+                    lambda task: _annotate_in_thread(task, worker_kwargs), tasks
+                )
+            )
+    else:
+        # paddle推理库在fork出的进程中不安全，用spawn启动
+        ctx = multiprocessing.get_context("spawn")
+        pool = ctx.Pool(
+            num_workers, initializer=_init_worker, initargs=(worker_kwargs,)
+        )
+        try:
+            results = pool.map(_annotate, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    elapsed = time.time() - tic
+
+    if save_status["coco"]:
+        labelList = LabelList()
+        if label_path is not None:
+            labelList.importLabel(label_path)
+        label_ids = set(lab.idx for lab in labelList)
+        for res in results:
+            for label_idx, _ in res["polygons"]:
+                if label_idx not in label_ids:
+                    label_ids.add(label_idx)
+                    labelList.add(
+                        label_idx, str(label_idx), get_label_color(label_idx)
+                    )
+        save_coco(results, labelList, output_dir)
+
+    speed = len(results) / elapsed if elapsed > 0 else 0
+    logger.info(f"Batch annotated {len(results)} images in {elapsed}s, {speed} img/s")
+    return results, speed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="按点击脚本批量生成标签")
+    parser.add_argument("--image_dir", type=str, required=True, help="图片文件夹")
+    parser.add_argument(
+        "--clicks_dir", type=str, default=None, help="点击脚本文件夹，默认和图片相同"
+    )
+    parser.add_argument("--output_dir", type=str, required=True, help="标签保存路径")
+    parser.add_argument("--param_path", type=str, required=True, help="模型权重路径")
+    parser.add_argument("--label_path", type=str, default=None, help="标签列表文件")
+    parser.add_argument("--num_workers", type=int, default=1, help="进程或线程数")
+    parser.add_argument(
+        "--use_threads", action="store_true", help="用线程和共享权重的推理器池代替多进程"
+    )
+    parser.add_argument(
+        "--num_threads", type=int, default=None, help="每个worker的推理线程数，默认平分CPU"
+    )
+    parser.add_argument(
+        "--save",
+        type=str,
+        default=",".join(SAVE_FORMATS),
+        help=f"保存的格式，逗号分隔，可选 {','.join(SAVE_FORMATS)}",
+    )
+    parser.add_argument("--prob_thresh", type=float, default=0.5, help="前景阈值")
+    parser.add_argument("--lcc", action="store_true", help="只保留最大联通块")
+    parser.add_argument("--use_gpu", action="store_true", help="使用GPU推理")
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="fp32",
+        choices=PRECISIONS,
+        help="CPU推理精度，int8需要先用eiseg-quantize量化模型",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="paddle",
+        choices=BACKENDS,
+        help="推理后端，onnxruntime加载同一目录下paddle2onnx导出的同名.onnx模型",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    formats = [f.strip() for f in args.save.split(",") if f.strip()]
+    for f in formats:
+        if f not in SAVE_FORMATS:
+            raise ValueError(f"不支持的保存格式 {f}，可选 {SAVE_FORMATS}")
+    results, speed = run(
+        args.image_dir,
+        args.clicks_dir or args.image_dir,
+        args.output_dir,
+        args.param_path,
+        label_path=args.label_path,
+        num_workers=args.num_workers,
+        num_threads=args.num_threads,
+        use_threads=args.use_threads,
+        save_status={k: k in formats for k in SAVE_FORMATS},
+        use_gpu=args.use_gpu,
+        prob_thresh=args.prob_thresh,
+        lcc_filter=args.lcc,
+        precision=args.precision,
+        backend=args.backend,
+    )
+    print(f"{len(results)} images, {speed:.2f} images/sec")
+
+
+if __name__ == "__main__":
+    main()
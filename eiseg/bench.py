@@ -0,0 +1,378 @@
+# Copyright (c) 2021 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+在标注好的数据集上评估模型和推理配置。
+
+每张图片对应一个同名的灰度标签 <标签文件夹>/<图片名>.png，大于0的像素是前景，
+255是忽略区域。用Clicker按标签模拟点击，BasePredictor推理，统计NoC@85/90、
+每次点击后的平均IoU，以及模拟点击和推理各阶段耗时的p50/p95。
+多张图片可以分给多个进程并行评估，每个进程只加载一次模型。
+
+--check_parity时不评估数据集，用一组固定的点击分别以paddle和onnxruntime推理，
+检查每次点击后的概率图是否一致，不一致时以非0状态退出。
+"""
+
+import os
+import os.path as osp
+import copy
+import json
+import time
+import argparse
+import multiprocessing
+
+import numpy as np
+
+from eiseg import logger
+from batch import PREDICTOR_PARAMS
+from models import create_model, PRECISIONS, BACKENDS
+from inference.predictor import get_predictor
+from inference.clicker import Clicker, Click
+from inference.evaluation import (
+    load_image,
+    list_images,
+    StageTimer,
+    load_gt_mask,
+    get_gt_path,
+    evaluate_sample,
+    compute_noc,
+    get_noc_metrics,
+)
+
+
+# 每个进程一个评估器，只在进程启动时加载一次模型
+_worker = None
+
+# 对比推理后端时固定的点击序列：(是否正点击, y, x)，坐标是占图像高宽的比例
+PARITY_CLICKS = (
+    (True, 0.5, 0.5),
+    (True, 0.35, 0.6),
+    (False, 0.75, 0.25),
+    (True, 0.6, 0.4),
+    (False, 0.2, 0.85),
+)
+
+
+def get_predictor_params(with_flip=False, max_size=800, zoom_in_size=400):
+    """在界面默认推理配置上修改翻转、最长边和ZoomIn大小，zoom_in_size为0时关闭ZoomIn"""
+    params = copy.deepcopy(PREDICTOR_PARAMS)
+    params["with_flip"] = with_flip
+    params["predictor_params"]["max_size"] = max_size
+    if zoom_in_size > 0:
+        params["zoom_in_params"]["target_size"] = (zoom_in_size, zoom_in_size)
+    else:
+        params["zoom_in_params"] = None
+    return params
+
+
+class BenchWorker(object):
+    """用一个推理器依次评估图片
+
+    Parameters
+    ----------
+    param_path : str
+        模型权重路径
+    gt_dir : str
+        标签文件夹
+    predictor_params : dict
+        get_predictor的参数
+    max_clicks : int
+        每张图最多点击次数
+    pred_thresh : float
+        概率大于这个值算前景
+    backend : str
+        推理后端，paddle或onnxruntime
+    precision : str
+        CPU推理精度
+    use_gpu : bool
+        是否使用GPU推理
+    num_threads : int
+        CPU推理线程数
+    """
+
+    def __init__(
+        self,
+        param_path,
+        gt_dir,
+        predictor_params=None,
+        max_clicks=20,
+        pred_thresh=0.49,
+        backend="paddle",
+        precision="fp32",
+        use_gpu=False,
+        num_threads=None,
+    ):
+        model_path = param_path.replace(".pdiparams", ".pdmodel")
+        model = create_model(
+            model_path, param_path, backend, use_gpu, num_threads, precision
+        )
+        self.predictor = get_predictor(
+            model, **(predictor_params or get_predictor_params())
+        )
+        self.gt_dir = gt_dir
+        self.max_clicks = max_clicks
+        self.pred_thresh = pred_thresh
+
+    def evaluate(self, image_path):
+        image = load_image(image_path)
+        gt_mask = load_gt_mask(get_gt_path(image_path, self.gt_dir))
+        timer = StageTimer()
+        self.predictor.stage_timer = timer
+        try:
+            ious = evaluate_sample(
+                self.predictor,
+                image,
+                gt_mask,
+                self.max_clicks,
+                self.pred_thresh,
+                timer=timer,
+            )
+        finally:
+            self.predictor.stage_timer = None
+        return {
+            "name": osp.basename(image_path),
+            "ious": ious,
+            "times": timer.times,
+        }
+
+
+def _init_worker(kwargs):
+    global _worker
+    _worker = BenchWorker(**kwargs)
+
+
+def _evaluate(image_path):
+    return _worker.evaluate(image_path)
+
+
+def get_samples(image_dir, gt_dir, num_images=None):
+    """找出有标签的图片"""
+    samples = []
+    for path in list_images(image_dir):
+        if not osp.exists(get_gt_path(path, gt_dir)):
+            logger.info(f"{osp.basename(path)} 没有标签，跳过")
+            continue
+        samples.append(path)
+    return samples[:num_images]
+
+
+def summarize(results, max_clicks=20):
+    """汇总所有图片的精度和耗时"""
+    all_ious = [res["ious"] for res in results]
+    report = get_noc_metrics(all_ious, max_clicks=max_clicks)
+    timer = StageTimer()
+    for res in results:
+        timer.update(res["times"])
+    report["latency"] = timer.summary()
+    report["images"] = {
+        res["name"]: {
+            "NoC@85": compute_noc(res["ious"], 0.85, max_clicks),
+            "NoC@90": compute_noc(res["ious"], 0.9, max_clicks),
+            "ious": [float(v) for v in res["ious"]],
+        }
+        for res in results
+    }
+    return report
+
+
+def run(
+    image_dir,
+    gt_dir,
+    param_path,
+    num_workers=1,
+    num_threads=None,
+    num_images=None,
+    max_clicks=20,
+    **kwargs,
+):
+    """评估数据集，返回汇总的结果"""
+    samples = get_samples(image_dir, gt_dir, num_images)
+    if not samples:
+        raise ValueError(f"{image_dir} 中没有带标签的图片")
+    if num_threads is None and num_workers > 1:
+        # 多个进程平分CPU
+        num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+    worker_kwargs = dict(
+        param_path=param_path,
+        gt_dir=gt_dir,
+        max_clicks=max_clicks,
+        num_threads=num_threads,
+        **kwargs,
+    )
+
+    tic = time.time()
+    if num_workers <= 1:
+        _init_worker(worker_kwargs)
+        results = [_evaluate(path) for path in samples]
+    else:
+        # paddle推理库在fork出的进程中不安全，用spawn启动
+        ctx = multiprocessing.get_context("spawn")
+        pool = ctx.Pool(
+            num_workers, initializer=_init_worker, initargs=(worker_kwargs,)
+        )
+        try:
+            results = pool.map(_evaluate, samples, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    elapsed = time.time() - tic
+
+    report = summarize(results, max_clicks)
+    report["num_images"] = len(results)
+    report["elapsed"] = elapsed
+    logger.info(f"Evaluated {len(results)} images in {elapsed}s")
+    return report
+
+
+def get_parity_image(height=480, width=640, seed=0):
+    """对比推理后端用的固定图像，随机噪声中间有一块亮的目标"""
+    rng = np.random.RandomState(seed)
+    image = rng.randint(0, 256, (height, width, 3), dtype=np.uint8)
+    image[height // 4 : height * 3 // 4, width // 4 : width * 3 // 4] = 200
+    return image
+
+
+def check_parity(param_path, predictor_params=None, num_threads=None, image=None):
+    """同一组固定点击分别用paddle和onnxruntime推理
+
+    Returns
+    -------
+    list
+        每次点击后两个后端概率图的最大差值
+    """
+    model_path = param_path.replace(".pdiparams", ".pdmodel")
+    if image is None:
+        image = get_parity_image()
+    height, width = image.shape[:2]
+    probs = []
+    for backend in BACKENDS:
+        model = create_model(model_path, param_path, backend, num_threads=num_threads)
+        predictor = get_predictor(
+            model, **(predictor_params or get_predictor_params())
+        )
+        predictor.set_input_image(image)
+        clicker = Clicker()
+        backend_probs = []
+        for is_positive, y, x in PARITY_CLICKS:
+            coords = (int(y * (height - 1)), int(x * (width - 1)))
+            clicker.add_click(Click(is_positive=is_positive, coords=coords))
+            backend_probs.append(predictor.get_prediction(clicker))
+        probs.append(backend_probs)
+    return [float(np.abs(a - b).max()) for a, b in zip(*probs)]
+
+
+def print_report(report):
+    print(f"{report['num_images']} images, {report['elapsed']:.2f}s")
+    for key in ("NoC@85", "NoC@90"):
+        nof = report[key.replace("NoC", "NoF")]
+        print(f"{key}: {report[key]:.2f}  ({nof} images never reached)")
+    miou = report["miou_per_click"]
+    print("mIoU per click:")
+    for start in range(0, len(miou), 10):
+        row = miou[start : start + 10]
+        print(f"{start + 1:>4}: " + " ".join(f"{v:.4f}" for v in row))
+    print(f"{'stage':>12}{'count':>8}{'mean(ms)':>12}{'p50(ms)':>12}{'p95(ms)':>12}")
+    for stage, stats in report["latency"].items():
+        print(
+            f"{stage:>12}{stats['count']:>8}{stats['mean']:>12.2f}"
+            f"{stats['p50']:>12.2f}{stats['p95']:>12.2f}"
+        )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="在标注好的数据集上模拟点击评估模型")
+    parser.add_argument("--image_dir", type=str, default=None, help="图片文件夹")
+    parser.add_argument("--gt_dir", type=str, default=None, help="标签文件夹")
+    parser.add_argument("--param_path", type=str, required=True, help="模型权重路径")
+    parser.add_argument("--num_images", type=int, default=None, help="最多评估多少张图片")
+    parser.add_argument("--max_clicks", type=int, default=20, help="每张图最多点击次数")
+    parser.add_argument("--pred_thresh", type=float, default=0.49, help="前景阈值")
+    parser.add_argument("--num_workers", type=int, default=1, help="进程数")
+    parser.add_argument(
+        "--num_threads", type=int, default=None, help="每个进程的推理线程数，默认平分CPU"
+    )
+    parser.add_argument("--with_flip", action="store_true", help="推理时加入水平翻转")
+    parser.add_argument("--max_size", type=int, default=800, help="图像最长边的限制")
+    parser.add_argument(
+        "--zoom_in_size", type=int, default=400, help="ZoomIn缩放到的大小，0表示不使用ZoomIn"
+    )
+    parser.add_argument("--use_gpu", action="store_true", help="使用GPU推理")
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="fp32",
+        choices=PRECISIONS,
+        help="CPU推理精度，int8需要先用eiseg-quantize量化模型",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="paddle",
+        choices=BACKENDS,
+        help="推理后端，onnxruntime加载同一目录下paddle2onnx导出的同名.onnx模型",
+    )
+    parser.add_argument("--report", type=str, default=None, help="保存评估结果的json路径")
+    parser.add_argument(
+        "--check_parity",
+        action="store_true",
+        help="不评估数据集，检查paddle和onnxruntime对同一组点击的结果是否一致",
+    )
+    parser.add_argument(
+        "--parity_atol", type=float, default=1e-3, help="两个后端概率图允许的最大差值"
+    )
+    args = parser.parse_args()
+    if not args.check_parity and (args.image_dir is None or args.gt_dir is None):
+        parser.error("评估数据集需要--image_dir和--gt_dir")
+    return args
+
+
+def main():
+    args = parse_args()
+    if args.check_parity:
+        diffs = check_parity(
+            args.param_path,
+            get_predictor_params(args.with_flip, args.max_size, args.zoom_in_size),
+            args.num_threads,
+        )
+        for idx, diff in enumerate(diffs, 1):
+            print(f"click {idx}: max diff {diff:.6f}")
+        if max(diffs) > args.parity_atol:
+            raise SystemExit(
+                f"paddle和onnxruntime的结果不一致，最大差值{max(diffs)}超过{args.parity_atol}"
+            )
+        print("paddle and onnxruntime outputs match")
+        return
+    report = run(
+        args.image_dir,
+        args.gt_dir,
+        args.param_path,
+        num_workers=args.num_workers,
+        num_threads=args.num_threads,
+        num_images=args.num_images,
+        max_clicks=args.max_clicks,
+        pred_thresh=args.pred_thresh,
+        predictor_params=get_predictor_params(
+            args.with_flip, args.max_size, args.zoom_in_size
+        ),
+        backend=args.backend,
+        precision=args.precision,
+        use_gpu=args.use_gpu,
+    )
+    print_report(report)
+    if args.report is not None:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -16,20 +16,38 @@
 import os.path as osp
 import time
 import json
+import queue
 import logging
+import threading
+from collections import OrderedDict
 
 import cv2
 import numpy as np
-from skimage.measure import label
-import paddle
 
 from eiseg import logger
 from inference import clicker
 from inference.predictor import get_predictor
+from inference.history import ClickHistory
 import util
-from util.vis import draw_with_blend_and_clicks
-from models import EISegModel
-from util import LabelList
+from util.vis import LayeredVis, get_mask_bbox
+from models import create_model
+from util import LabelList, LabelRaster
+
+
+class ObjectState(object):
+    """一个正在标注的物体：自己的点击和撤销历史
+
+    历史的当前状态里有这个物体的推理器状态（变换状态和上一次的预测），
+    切换物体时直接恢复，不用重新推理。
+    """
+
+    def __init__(self, history_params=None):
+        self.clicker = clicker.Clicker()
+        self.history = ClickHistory(**(history_params or {}))
+
+    @property
+    def is_incomplete(self):
+        return len(self.history) > 1 or len(self.clicker) > 0
 
 
 class InteractiveController:
@@ -37,6 +55,7 @@ class InteractiveController:
         self,
         predictor_params: dict = None,
         prob_thresh: float = 0.5,
+        history_params: dict = None,
     ):
         """初始化控制器.
 
@@ -46,28 +65,48 @@ class InteractiveController:
             推理器配置
         prob_thresh : float
             区分前景和背景结果的阈值
+        history_params : dict
+            撤销历史的配置，见inference.history.ClickHistory
 
         """
         self.predictor_params = predictor_params
         self.prob_thresh = prob_thresh
         self.model = None
+        self._pool = None  # 模型是从推理器池中取出的
         self.image = None
         self.rawImage = None
         self.predictor = None
-        self.clicker = clicker.Clicker()
-        self.states = []
-        self.probs_history = []
+        # 推理可以在单独的线程中进行，推理期间其他修改推理器的操作需要等待
+        self._inference_cond = threading.Condition()
+        self._inferring = False
+        # 正在推理的点击快照中的点击数，之后添加的点击还可以直接撤销
+        self._inferring_clicks = 0
+        # 推理期间请求的撤销次数，推理结束后在推理线程中执行
+        self._deferred_undos = 0
+        self.history_params = history_params or {}
+        # 同时标注的多个物体，按最近使用的顺序，所有物体共用推理器和转换好的图像
+        self._objects = OrderedDict()
+        self._next_object_id = 0
+        self.currObjectId = None
+        # 最近使用的几个物体保留原始的当前状态，更早的物体压缩保存
+        self.maxUncompressedObjects = 2
+        # 当前物体的点击和历史，历史中是每次推理后的点击、推理器状态和结果，用于undo和redo
+        self.clicker = None
+        self.history = None
+        self.newObject()
         self.polygons = []
 
-        # 用于redo
-        self.undo_states = []
-        self.undo_probs_history = []
-
         self.curr_label_number = 0
         self._result_mask = None
+        # 多边形栅格化的标签图，只重画变化的多边形
+        self.labelRaster = None
         self.labelList = LabelList()
         self.lccFilter = False
         self.log = logging.getLogger(__name__)
+        # 分层缓存的可视化，只重画变化的区域
+        self._vis = LayeredVis()
+        # (概率图, 阈值, 是否只保留最大联通块, 掩膜)，同一个概率图不重复计算
+        self._object_mask_cache = None
 
     def filterLargestCC(self, do_filter: bool):
         """设置是否只保留推理结果中的最大联通块
@@ -81,7 +120,14 @@ class InteractiveController:
             return
         self.lccFilter = do_filter
 
-    def setModel(self, param_path=None, use_gpu=None):
+    def setModel(
+        self,
+        param_path=None,
+        use_gpu=None,
+        num_threads=None,
+        precision="fp32",
+        backend="paddle",
+    ):
         """设置推理其模型.
 
         Parameters
@@ -93,6 +139,15 @@ class InteractiveController:
             None:检测，根据paddle版本判断
             bool:按照指定是否开启GPU
 
+        num_threads : int
+            CPU推理使用的线程数，None时使用自动调优的结果或默认值
+
+        precision : str
+            CPU推理精度，fp32、bf16或int8，int8需要先用eiseg-quantize量化模型
+
+        backend : str
+            推理后端，paddle或onnxruntime，onnxruntime加载同一目录下的同名.onnx模型
+
         Returns
         -------
         bool, str
@@ -101,23 +156,67 @@ class InteractiveController:
         """
         if param_path is not None:
             model_path = param_path.replace(".pdiparams", ".pdmodel")
-            if not osp.exists(model_path):
+            if backend == "paddle" and not osp.exists(model_path):
                 raise Exception(f"未在 {model_path} 找到模型文件")
             if use_gpu is None:
+                import paddle
+
                 if paddle.device.is_compiled_with_cuda():  # TODO: 可以使用GPU却返回False
                     use_gpu = True
                 else:
                     use_gpu = False
             logger.info(f"User paddle compiled with gpu: use_gpu {use_gpu}")
             tic = time.time()
+            self.waitInference()
+            self.releaseModel()
             try:
-                self.model = EISegModel(model_path, param_path, use_gpu)
+                self.model = create_model(
+                    model_path, param_path, backend, use_gpu, num_threads, precision
+                )
                 self.reset_predictor()  # 即刻生效
             except KeyError as e:
                 return False, str(e)
             logger.info(f"Load model {model_path} took {time.time() - tic}")
             return True, "模型设置成功"
 
+    def setModelFromPool(self, pool, block=True, timeout=None):
+        """从推理器池中取一个模型使用，用完后调用releaseModel归还
+
+        Parameters
+        ----------
+        pool : models.PredictorPool
+            推理器池
+        block : bool
+            没有空闲模型时是否等待
+        timeout : float
+            最多等待多少秒
+
+        Returns
+        -------
+        bool, str
+            是否成功设置模型, 失败原因
+
+        """
+        self.releaseModel()
+        try:
+            model = pool.acquire(block, timeout)
+        except queue.Empty:
+            return False, "推理器池中没有空闲的模型"
+        self._pool = pool
+        self.model = model
+        self.predictor = None
+        self.reset_predictor()
+        return True, "模型设置成功"
+
+    def releaseModel(self):
+        """把从推理器池中取出的模型还回去"""
+        if self._pool is None:
+            return
+        self._pool.release(self.model)
+        self._pool = None
+        self.model = None
+        self.predictor = None
+
     def setImage(self, image: np.array):
         """设置当前标注的图片
 
@@ -128,9 +227,108 @@ class InteractiveController:
 
         """
         if self.model is not None:
-            self.image = image
-            self._result_mask = np.zeros(image.shape[:2], dtype=np.uint8)
-            self.resetLastObject()
+            with self._inference_cond:
+                # 先丢掉没推理的点击再等推理结束，推理线程不会再用旧图推理
+                while self._remove_pending_click():
+                    pass
+                self._deferred_undos = 0
+                self._wait_inference()
+                # 换图后之前的物体都作废
+                for obj in self._objects.values():
+                    obj.history.clear()
+                self._objects.clear()
+                self.image = image
+                self._result_mask = np.zeros(image.shape[:2], dtype=np.uint8)
+                self.polygons = []
+                self.labelRaster = LabelRaster(image.shape)
+                self.newObject()
+                self.resetLastObject()
+
+    # 物体操作
+    def newObject(self):
+        """新建一个正在标注的物体并切换过去，之前的物体保留点击和结果
+
+        Returns
+        -------
+        int
+            新物体的id
+        """
+        with self._inference_cond:
+            self._wait_inference()
+            obj_id = self._next_object_id
+            self._next_object_id += 1
+            self._objects[obj_id] = ObjectState(self.history_params)
+            self._activate_object(obj_id)
+        return obj_id
+
+    def switchObject(self, obj_id: int):
+        """切换到另一个正在标注的物体，恢复它的点击、历史和推理器状态，不重新推理
+
+        Parameters
+        ----------
+        obj_id : int
+            newObject返回的物体id
+
+        Returns
+        -------
+        bool
+            是否切换成功，物体不存在时返回False
+        """
+        with self._inference_cond:
+            self._wait_inference()
+            if obj_id not in self._objects:
+                return False
+            if obj_id != self.currObjectId:
+                self._activate_object(obj_id)
+        return True
+
+    def removeObject(self, obj_id: int):
+        """丢掉一个正在标注的物体，删掉的是当前物体时切换到最近使用的物体
+
+        Returns
+        -------
+        bool
+            是否删除成功，物体不存在时返回False
+        """
+        with self._inference_cond:
+            self._wait_inference()
+            obj = self._objects.pop(obj_id, None)
+            if obj is None:
+                return False
+            obj.history.clear()
+            if obj_id == self.currObjectId:
+                self.currObjectId = None
+                if self._objects:
+                    self._activate_object(next(reversed(self._objects)))
+        if self.currObjectId is None:
+            self.newObject()
+        return True
+
+    def _activate_object(self, obj_id):
+        """把obj_id设为当前物体，需要在_inference_cond中调用"""
+        obj = self._objects[obj_id]
+        self._objects.move_to_end(obj_id)
+        self.currObjectId = obj_id
+        self.clicker = obj.clicker
+        self.history = obj.history
+        if self.predictor is not None and self.predictor.original_image is not None:
+            state = self.history.current
+            self.predictor.set_states(None if state is None else state["predictor"])
+        # 不常用的物体压缩当前状态
+        inactive = list(self._objects.values())[:-1]
+        num_compressed = len(inactive) - self.maxUncompressedObjects + 1
+        for obj in inactive[: max(0, num_compressed)]:
+            obj.history.suspend()
+
+    @property
+    def objectIds(self):
+        """所有正在标注的物体的id，按最近使用的顺序，最后一个是当前物体"""
+        return list(self._objects.keys())
+
+    @property
+    def incompleteObjectIds(self):
+        """有点击或结果的物体的id"""
+        return [k for k, obj in self._objects.items() if obj.is_incomplete]
 
     # 标签操作
     def setLabelList(self, labelList: json):
@@ -194,7 +392,32 @@ class InteractiveController:
             点击是否添加成功, 失败原因
 
         """
+        success, res = self.addPendingClick(x, y, is_positive)
+        if not success:
+            return success, res
+        self.inferPendingClicks()
+        return True, "点击添加成功"
 
+    def addPendingClick(self, x: int, y: int, is_positive: bool):
+        """只添加点击不推理，之后调用inferPendingClicks推理
+
+        推理可以放在另一个线程中，推理期间添加的点击会在下一次推理中一起计算。
+
+        Parameters
+        ----------
+        x : int
+            点击的横坐标
+        y : int
+            点击的纵坐标
+        is_positive : bool
+            是否点的是正点
+
+        Returns
+        -------
+        bool, str
+            点击是否添加成功, 失败原因
+
+        """
         # 1. 确定可以点
         if not self.inImage(x, y):
             return False, "点击越界"
@@ -203,72 +426,192 @@ class InteractiveController:
         if not self.imageSet:
             return False, "图像未设置"
 
-        if len(self.states) == 0:  # 保存一个空状态
-            self.states.append(
-                {
-                    "clicker": self.clicker.get_state(),
-                    "predictor": self.predictor.get_states(),
-                }
-            )
+        with self._inference_cond:
+            if len(self.history) == 0:  # 保存一个空状态
+                self.history.push(
+                    {
+                        "clicker": self.clicker.get_state(),
+                        "predictor": self.predictor.get_states(),
+                        "prob": None,
+                    }
+                )
+
+            # 2. 添加点击
+            click = clicker.Click(is_positive=is_positive, coords=(y, x))
+            self.clicker.add_click(click)
+
+            # 点击之后就不能接着之前的历史redo了
+            self.history.clear_redo()
+        return True, "点击添加成功"
+
+    def inferPendingClicks(self):
+        """对还没推理的点击跑一次推理，保存历史用于undo
 
-        # 2. 添加点击，跑推理
-        click = clicker.Click(is_positive=is_positive, coords=(y, x))
-        self.clicker.add_click(click)
-        pred = self.predictor.get_prediction(self.clicker)
+        多个未推理的点击只推理一次，合成一步历史。可以在推理线程中调用，
+        其他修改推理器的操作会等推理结束。
+
+        Returns
+        -------
+        np.ndarray
+            推理结果，没有未推理的点击时返回None
+
+        """
+        with self._inference_cond:
+            self._wait_inference()
+            if len(self.clicker) <= self._num_inferred_clicks:
+                return None
+            clicks = self.clicker.get_state()
+            self._inferring = True
+            self._inferring_clicks = len(clicks)
+
+        try:
+            # 推理期间界面线程可能继续添加点击，推理用点击的快照
+            snapshot = clicker.Clicker(
+                click_indx_offset=self.clicker.click_indx_offset
+            )
+            snapshot.set_state(clicks)
+            pred = self.predictor.get_prediction(snapshot)
+            if logger.isEnabledFor(logging.DEBUG):
+                report = self.predictor.get_copy_report()
+                logger.debug(f"Input bytes per run: {report}")
+                if self.predictor.shape_bucket is not None:
+                    logger.debug(f"Shape stats: {self.predictor.get_shape_stats()}")
+            predictor_states = self.predictor.get_states()
+        except Exception:
+            with self._inference_cond:
+                # 推理失败，丢掉没推理的点击，针对这些点击的撤销不用再执行
+                num_clicks = len(self.history.current["clicker"])
+                num_dropped = len(self.clicker) - num_clicks
+                self.clicker.set_state(self.history.current["clicker"])
+                self._inferring = False
+                num_undo = self._deferred_undos - num_dropped
+                self._deferred_undos = 0
+                self._undo_clicks(num_undo, num_clicks)
+                self._inference_cond.notify_all()
+            raise
 
         # 3. 保存状态
-        self.states.append(
-            {
-                "clicker": self.clicker.get_state(),
-                "predictor": self.predictor.get_states(),
-            }
-        )
-        if self.probs_history:
-            self.probs_history.append((self.probs_history[-1][1], pred))
+        with self._inference_cond:
+            self.history.push(
+                {"clicker": clicks, "predictor": predictor_states, "prob": pred}
+            )
+            self._inferring = False
+            # 推理期间请求的撤销
+            self._undo_clicks(self._deferred_undos, len(clicks))
+            self._deferred_undos = 0
+            self._inference_cond.notify_all()
+        return pred
+
+    def removePendingClick(self):
+        """撤销一个还没开始推理的点击，推理期间添加的点击也可以撤销
+
+        Returns
+        -------
+        bool
+            是否撤销了点击，False表示没有未推理的点击
+        """
+        with self._inference_cond:
+            return self._remove_pending_click()
+
+    def _remove_pending_click(self):
+        if self._inferring:
+            num_inferred = self._inferring_clicks
         else:
-            self.probs_history.append((np.zeros_like(pred), pred))
+            num_inferred = self._num_inferred_clicks
+        if len(self.clicker) <= num_inferred:
+            return False
+        self.clicker._remove_last_click()
+        return True
 
-        # 点击之后就不能接着之前的历史redo了
-        self.undo_states = []
-        self.undo_probs_history = []
-        return True, "点击添加成功"
+    def waitInference(self):
+        """等待正在进行的推理结束"""
+        with self._inference_cond:
+            self._wait_inference()
+
+    def _wait_inference(self):
+        while self._inferring:
+            self._inference_cond.wait()
+
+    @property
+    def _num_inferred_clicks(self):
+        if len(self.history) == 0:
+            return 0
+        return len(self.history.current["clicker"])
+
+    @property
+    def hasPendingInference(self):
+        """是否正在推理或者还有没推理的点击"""
+        with self._inference_cond:
+            return self._inferring or len(self.clicker) > self._num_inferred_clicks
 
     def undoClick(self):
         """
-        undo一步点击
+        undo一个点击，不等待推理
+
+        还没推理的点击直接去掉；正在推理的点击记下来，推理结束后在推理线程中撤销。
+        撤销到一次合并推理的几个点击中间时，剩下的点击变回没推理的点击，
+        需要再调用inferPendingClicks。
+        """
+        with self._inference_cond:
+            if self._remove_pending_click():
+                return
+            if self._inferring:
+                self._deferred_undos += 1
+                return
+            self._undo_clicks(1, len(self.clicker))
+
+    def _undo_clicks(self, num_undo, num_clicks):
+        """撤销前num_clicks个点击中的最后num_undo个，之后的点击保留为没推理的点击
+
+        退回到不多于剩下点击数的历史状态，历史状态中没有的点击重新添加。
+        需要在_inference_cond中调用。
         """
-        if len(self.states) <= 1:  # == 1就只剩下一个空状态了，不用再退
+        if num_undo <= 0 or len(self.history) == 0:
             return
-        self.undo_states.append(self.states.pop())
-        self.clicker.set_state(self.states[-1]["clicker"])
-        self.predictor.set_states(self.states[-1]["predictor"])
-        self.undo_probs_history.append(self.probs_history.pop())
-        if not self.probs_history:
+        clicks = list(self.clicker.get_clicks())
+        num_keep = max(0, num_clicks - num_undo)
+        keep = clicks[:num_keep] + clicks[num_clicks:]
+        state = self.history.current
+        # == 1就只剩下一个空状态了，不用再退
+        while len(self.history) > 1 and len(state["clicker"]) > num_keep:
+            state = self.history.undo()
+        self.clicker.set_state(state["clicker"])
+        self.predictor.set_states(state["predictor"])
+        if len(self.history) <= 1:
             self.reset_init_mask()
+        remaining = keep[len(state["clicker"]) :]
+        if remaining:
+            self.history.clear_redo()
+        for click in remaining:
+            self.clicker.add_click(
+                clicker.Click(is_positive=click.is_positive, coords=click.coords)
+            )
 
     def redoClick(self):
         """
-        redo一步点击
+        redo一步点击，不等待推理，推理期间只能取消还没执行的撤销
         """
-        if len(self.undo_states) == 0:  # 如果还没撤销过
-            return
-        if len(self.undo_probs_history) >= 1:
-            next_state = self.undo_states.pop()
-            self.states.append(next_state)
-            self.clicker.set_state(next_state["clicker"])
-            self.predictor.set_states(next_state["predictor"])
-            self.probs_history.append(self.undo_probs_history.pop())
+        with self._inference_cond:
+            if self._inferring:
+                if self._deferred_undos > 0:
+                    self._deferred_undos -= 1
+                return
+            if self.history.num_redo == 0:  # 如果还没撤销过
+                return
+            state = self.history.redo()
+            self.clicker.set_state(state["clicker"])
+            self.predictor.set_states(state["predictor"])
 
     def finishObject(self, building=False):
         """
-        结束当前物体标注，准备标下一个
+        结束当前物体标注，当前物体清空后用来标下一个，其他正在标注的物体不受影响
         """
+        # 先把还没推理的点击推理完
+        self.inferPendingClicks()
         object_prob = self.current_object_prob
         if object_prob is None:
             return None, None
-        object_mask = object_prob > self.prob_thresh
-        if self.lccFilter:
-            object_mask = self.getLargestCC(object_mask)
+        object_mask = self.getObjectMask(object_prob)
         polygon = util.get_polygon((object_mask.astype(np.uint8) * 255), 
                                     img_size=object_mask.shape,
                                     building=building)
@@ -286,13 +629,28 @@ class InteractiveController:
         self.polygon = polygon
 
     # mask
-    def getMask(self):
-        s = self.imgShape
-        img = np.zeros([s[0], s[1]])
-        for poly in self.polygons:
-            pts = np.int32([np.array(poly[1])])
-            cv2.fillPoly(img, pts=pts, color=poly[0])
-        return img
+    def getMask(self, polygons=None):
+        """所有多边形栅格化得到的标签图，后面的多边形覆盖前面的
+
+        只重画和上一次调用相比增加、删除或修改的多边形所在的区域。
+        返回的标签图会被之后的调用原地修改，需要保留时先复制。
+
+        Parameters
+        ----------
+        polygons : list
+            [(key, 标签id, 点)]，按绘制顺序，key按对象判断是不是同一个多边形。
+            默认是finishObject生成的所有多边形
+        """
+        if self.labelRaster is None:
+            return None
+        if polygons is None:
+            polygons = [
+                (points, label_idx, points)
+                for label_idx, polygon in self.polygons
+                for points in polygon
+                if len(points) >= 3
+            ]
+        return self.labelRaster.update(polygons)
 
     def setCurrLabelIdx(self, number):
         if not isinstance(number, int):
@@ -301,29 +659,35 @@ class InteractiveController:
 
     def resetLastObject(self, update_image=True):
         """
-        重置控制器状态
+        重置当前物体的状态，保留推理器和已转换的图像
         Parameters
-            update_image(bool): 是否更新图像
+            update_image(bool): 是否检查并更新推理器中的图像
         """
-        self.states = []
-        self.probs_history = []
-        self.undo_states = []
-        self.undo_probs_history = []
+        self.waitInference()
+        self.history.clear()
         # self.current_object_prob = None
         self.clicker.reset_clicks()
-        self.reset_predictor()
+        if self.predictor is None:
+            self.reset_predictor()
+        else:
+            # 复用推理器，只有图像变了才重新转换输入
+            if update_image and self.image is not None:
+                self.predictor.set_input_image(self.image)
+            else:
+                self.predictor.reset()
         self.reset_init_mask()
 
     def reset_predictor(self, predictor_params=None):
         """
-        重置推理器，可以换推理配置
+        重建推理器，可以换推理配置
         Parameters
             predictor_params(dict): 推理配置
         """
+        self.waitInference()
         if predictor_params is not None:
             self.predictor_params = predictor_params
-        if self.model.model:
-            self.predictor = get_predictor(self.model.model, **self.predictor_params)
+        if self.model is not None:
+            self.predictor = get_predictor(self.model, **self.predictor_params)
             if self.image is not None:
                 self.predictor.set_input_image(self.image)
 
@@ -331,36 +695,86 @@ class InteractiveController:
         self.clicker.click_indx_offset = 0
 
     def getLargestCC(self, mask):
-        mask = label(mask)
-        if mask.max() == 0:
-            return mask
-        mask = mask == np.argmax(np.bincount(mask.flat)[1:]) + 1
+        """只保留mask中最大的8连通块
+
+        只在mask的外接矩形内计算连通块。面积相同时保留按行优先顺序先出现的连通块。
+        """
+        result = np.zeros(mask.shape, dtype=bool)
+        bbox = get_mask_bbox(mask)
+        if bbox is None:
+            return result
+        y1, y2, x1, x2 = bbox
+        _, labels, stats, _ = cv2.connectedComponentsWithStats(
+            mask[y1:y2, x1:x2].astype(np.uint8), connectivity=8
+        )
+        areas = stats[1:, cv2.CC_STAT_AREA]
+        largest = np.flatnonzero(areas == areas.max()) + 1
+        if len(largest) > 1:
+            # 连通块的编号顺序不一定是行优先的，按每个连通块的第一个像素排序
+            largest = [min(largest, key=lambda idx: np.argmax(labels == idx))]
+        result[y1:y2, x1:x2] = labels == largest[0]
+        return result
+
+    def getObjectMask(self, prob=None):
+        """概率图阈值化后的前景掩膜，开启最大联通块过滤时只保留最大联通块
+
+        按(概率图, 阈值, 是否过滤)缓存，概率图按对象判断，返回的掩膜不要原地修改。
+
+        Parameters
+        ----------
+        prob : np.ndarray
+            概率图，默认是当前物体的推理结果
+        """
+        if prob is None:
+            prob = self.current_object_prob
+            if prob is None:
+                return None
+        cache = self._object_mask_cache
+        if (
+            cache is not None
+            and cache[0] is prob
+            and cache[1:3] == (self.prob_thresh, self.lccFilter)
+        ):
+            return cache[3]
+        mask = prob > self.prob_thresh
+        if self.lccFilter:
+            mask = self.getLargestCC(mask)
+        self._object_mask_cache = (prob, self.prob_thresh, self.lccFilter, mask)
         return mask
 
     def get_visualization(self, alpha_blend: float, click_radius: int):
+        """当前物体的掩膜和点击画在图像上的结果
+
+        返回的图像是缓存的，下一次调用时会被原地修改，需要保留时先复制。
+        """
         if self.image is None:
             return None
-        # 1. 正在标注的mask
-        # results_mask_for_vis = self.result_mask  # 加入之前标完的mask
-        results_mask_for_vis = np.zeros_like(self.result_mask)
-        results_mask_for_vis *= self.curr_label_number
-        if self.probs_history:
-            results_mask_for_vis[
-                self.current_object_prob > self.prob_thresh
-            ] = self.curr_label_number
-        if self.lccFilter:
-            results_mask_for_vis = (
-                self.getLargestCC(results_mask_for_vis) * self.curr_label_number
-            )
-        vis = draw_with_blend_and_clicks(
-            self.image,
-            mask=results_mask_for_vis,
+        self._vis.set_image(self.image)
+        prob = self.current_object_prob
+        self._vis.update_mask(
+            prob,
+            (self.prob_thresh, self.lccFilter, self.curr_label_number),
+            lambda: self._get_vis_mask(prob),
+        )
+        return self._vis.render(
+            self.palette[self.curr_label_number],
             alpha=alpha_blend,
             clicks_list=self.clicker.clicks_list,
             radius=click_radius,
-            palette=self.palette,
         )
-        return vis
+
+    def popVisDirtyRegion(self):
+        """上次调用之后get_visualization返回的图像中改过的区域(y1, y2, x1, x2)
+
+        没有改过时返回None，界面只需要刷新这个区域。
+        """
+        return self._vis.pop_dirty_region()
+
+    def _get_vis_mask(self, prob):
+        """正在标注的物体的掩膜，没有结果或没有选择标签时返回None"""
+        if prob is None or self.curr_label_number == 0:
+            return None
+        return self.getObjectMask(prob)
 
     def inImage(self, x: int, y: int):
         s = self.image.shape
@@ -387,11 +801,9 @@ class InteractiveController:
         """
         获取当前推理标签
         """
-        if self.probs_history:
-            _, current_prob_additive = self.probs_history[-1]
-            return current_prob_additive
-        else:
+        if len(self.history) == 0:
             return None
+        return self.history.current["prob"]
 
     @property
     def is_incomplete_mask(self):
@@ -399,7 +811,7 @@ class InteractiveController:
         Returns
             bool: 当前的物体是不是还没标完
         """
-        return len(self.probs_history) > 0
+        return self._objects[self.currObjectId].is_incomplete
 
     @property
     def imgShape(self):
@@ -22,6 +22,12 @@ import numpy as np
 from copy import deepcopy
 
 
+# 每个点击一行：坐标(y, x)，是否是正点，点击序号
+CLICK_DTYPE = np.dtype(
+    [("y", "float64"), ("x", "float64"), ("is_positive", "bool"), ("indx", "int64")]
+)
+
+
 class Clicker(object):
     def __init__(
         self, gt_mask=None, init_clicks=None, ignore_label=-1, click_indx_offset=0
@@ -33,6 +39,8 @@ class Clicker(object):
         else:
             self.gt_mask = None
 
+        self._data = np.empty(16, dtype=CLICK_DTYPE)
+        self._num_shared = 0
         self.reset_clicks()
 
         if init_clicks is not None:
@@ -45,7 +53,16 @@ class Clicker(object):
         self.add_click(click)
 
     def get_clicks(self, clicks_limit=None):
-        return self.clicks_list[:clicks_limit]
+        """当前所有点击的只读快照，之后添加或删除点击不会改变它"""
+        num_clicks = self._size if clicks_limit is None else clicks_limit
+        num_clicks = min(max(num_clicks, 0), self._size)
+        # 快照和点击共用内存，之后要改这部分内存时先复制
+        self._num_shared = max(self._num_shared, num_clicks)
+        return Clicks(self._data[:num_clicks])
+
+    @property
+    def clicks_list(self):
+        return self.get_clicks()
 
     def _get_next_click(self, pred_mask, padding=True):
         fn_mask = np.logical_and(
@@ -57,30 +74,48 @@ class Clicker(object):
             self.not_ignore_mask,
         )
 
-        if padding:
-            fn_mask = np.pad(fn_mask, ((1, 1), (1, 1)), "constant")
-            fp_mask = np.pad(fp_mask, ((1, 1), (1, 1)), "constant")
+        fn_max_dist, fn_coords = self._get_farthest_point(fn_mask, padding)
+        fp_max_dist, fp_coords = self._get_farthest_point(fp_mask, padding)
 
-        fn_mask_dt = cv2.distanceTransform(fn_mask.astype(np.uint8), cv2.DIST_L2, 0)
-        fp_mask_dt = cv2.distanceTransform(fp_mask.astype(np.uint8), cv2.DIST_L2, 0)
+        is_positive = fn_max_dist > fp_max_dist
+        coords = fn_coords if is_positive else fp_coords  # coords is [y, x]
+        return Click(is_positive=is_positive, coords=coords)
 
-        if padding:
-            fn_mask_dt = fn_mask_dt[1:-1, 1:-1]
-            fp_mask_dt = fp_mask_dt[1:-1, 1:-1]
+    def _get_farthest_point(self, mask, padding=True):
+        """mask中离边界最远的未点击像素
 
-        fn_mask_dt = fn_mask_dt * self.not_clicked_map
-        fp_mask_dt = fp_mask_dt * self.not_clicked_map
+        只在mask的外接矩形外扩一个像素的区域内做距离变换。外扩的一圈都不在mask中，
+        矩形内每个像素到最近的mask外像素的距离和在整张图上算的相同，
+        距离相同时取的也是整张图上按行优先的第一个像素。
 
-        fn_max_dist = np.max(fn_mask_dt)
-        fp_max_dist = np.max(fp_mask_dt)
+        Returns
+        -------
+        tuple
+            最远距离和坐标(y, x)，没有未点击的像素时距离为0，坐标为(0, 0)
+        """
+        rows = np.flatnonzero(mask.any(axis=1))
+        if len(rows) == 0:
+            return 0, (0, 0)
+        cols = np.flatnonzero(mask.any(axis=0))
+        height, width = mask.shape
+        y1, y2 = max(rows[0] - 1, 0), min(rows[-1] + 2, height)
+        x1, x2 = max(cols[0] - 1, 0), min(cols[-1] + 2, width)
+        mask = mask[y1:y2, x1:x2]
 
-        is_positive = fn_max_dist > fp_max_dist
-        if is_positive:
-            coords_y, coords_x = np.where(fn_mask_dt == fn_max_dist)  # coords is [y, x]
-        else:
-            coords_y, coords_x = np.where(fp_mask_dt == fp_max_dist)  # coords is [y, x]
+        if padding:
+            mask = np.pad(mask, ((1, 1), (1, 1)), "constant")
 
-        return Click(is_positive=is_positive, coords=(coords_y[0], coords_x[0]))
+        mask_dt = cv2.distanceTransform(mask.astype(np.uint8), cv2.DIST_L2, 0)
+
+        if padding:
+            mask_dt = mask_dt[1:-1, 1:-1]
+
+        mask_dt = mask_dt * self.not_clicked_map[y1:y2, x1:x2]
+        max_dist = np.max(mask_dt)
+        if max_dist == 0:
+            return max_dist, (0, 0)
+        coords_y, coords_x = np.where(mask_dt == max_dist)
+        return max_dist, (coords_y[0] + y1, coords_x[0] + x1)
 
     def add_click(self, click):
         coords = click.coords
@@ -91,15 +126,25 @@ class Clicker(object):
         else:
             self.num_neg_clicks += 1
 
-        self.clicks_list.append(click)
+        if self._size < self._num_shared or self._size == len(self._data):
+            self._reallocate(max(16, 2 * (self._size + 1)))
+        self._data[self._size] = (coords[0], coords[1], click.is_positive, click.indx)
+        self._size += 1
         if self.gt_mask is not None:
             self.not_clicked_map[coords[0], coords[1]] = False
 
+    def _reallocate(self, capacity):
+        data = np.empty(capacity, dtype=CLICK_DTYPE)
+        data[: self._size] = self._data[: self._size]
+        self._data = data
+        self._num_shared = 0
+
     def _remove_last_click(self):
-        click = self.clicks_list.pop()
-        coords = click.coords
+        self._size -= 1
+        click = self._data[self._size]
+        coords = (int(click["y"]), int(click["x"]))
 
-        if click.is_positive:
+        if click["is_positive"]:
             self.num_pos_clicks -= 1
         else:
             self.num_neg_clicks -= 1
@@ -109,23 +154,117 @@ class Clicker(object):
 
     def reset_clicks(self):
         if self.gt_mask is not None:
-            self.not_clicked_map = np.ones_like(self.gt_mask, dtype=np.bool)
+            self.not_clicked_map = np.ones_like(self.gt_mask, dtype=bool)
 
         self.num_pos_clicks = 0
         self.num_neg_clicks = 0
 
-        self.clicks_list = []
+        self._size = 0
 
     def get_state(self):
-        return deepcopy(self.clicks_list)
+        return self.get_clicks()
 
     def set_state(self, state):
+        """恢复get_state保存的点击，点击序号按click_indx_offset重新编号"""
         self.reset_clicks()
-        for click in state:
-            self.add_click(click)
+        data = as_clicks(state).data
+        indx = self.click_indx_offset + np.arange(len(data))
+        if not np.array_equal(data["indx"], indx):
+            data = data.copy()
+            data["indx"] = indx
+        # 直接使用快照的内存，添加点击时再复制
+        self._data = data
+        self._size = len(data)
+        self._num_shared = len(data)
+        self.num_pos_clicks = int(data["is_positive"].sum())
+        self.num_neg_clicks = len(data) - self.num_pos_clicks
+        if self.gt_mask is not None:
+            ys, xs = data["y"].astype(int), data["x"].astype(int)
+            self.not_clicked_map[ys, xs] = False
+
+    def __len__(self):
+        return self._size
+
+
+class Clicks(object):
+    """只读的点击序列
+
+    点击保存在CLICK_DTYPE的结构化数组中，变换点击坐标时整体计算，
+    遍历时得到Click。
+
+    Parameters
+    ----------
+    data : np.ndarray
+        CLICK_DTYPE的一维数组
+    """
+
+    def __init__(self, data=None):
+        if data is None:
+            data = np.empty(0, dtype=CLICK_DTYPE)
+        data = data.view()
+        data.flags.writeable = False
+        self.data = data
+
+    @classmethod
+    def from_list(cls, clicks_list):
+        data = np.empty(len(clicks_list), dtype=CLICK_DTYPE)
+        for i, click in enumerate(clicks_list):
+            indx = -1 if click.indx is None else click.indx
+            data[i] = (click.coords[0], click.coords[1], click.is_positive, indx)
+        return cls(data)
 
     def __len__(self):
-        return len(self.clicks_list)
+        return len(self.data)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return Clicks(self.data[idx])
+        return self._to_click(self.data[idx])
+
+    def __iter__(self):
+        for row in self.data:
+            yield self._to_click(row)
+
+    def __getstate__(self):
+        return {"data": self.data.copy()}
+
+    def __setstate__(self, state):
+        self.__init__(state["data"])
+
+    @staticmethod
+    def _to_click(row):
+        return Click(
+            is_positive=bool(row["is_positive"]),
+            coords=(row["y"], row["x"]),
+            indx=int(row["indx"]),
+        )
+
+    @property
+    def coords(self):
+        """[N, 2]，每行是(y, x)"""
+        return np.stack([self.data["y"], self.data["x"]], axis=1)
+
+    @property
+    def is_positive(self):
+        return self.data["is_positive"]
+
+    @property
+    def num_positive(self):
+        return int(self.data["is_positive"].sum())
+
+    def with_coords(self, ys, xs):
+        """同样的点击换成新的坐标"""
+        data = self.data.copy()
+        data["y"] = ys
+        data["x"] = xs
+        return Clicks(data)
+
+
+def as_clicks(clicks_list):
+    """Click的列表转成Clicks，已经是Clicks时直接返回"""
+    if isinstance(clicks_list, Clicks):
+        return clicks_list
+    return Clicks.from_list(clicks_list)
 
 
 class Click:
@@ -0,0 +1,194 @@
+# Copyright (c) 2021 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+用标注好的掩膜模拟点击，评估交互分割的精度。
+
+每次点击点在当前预测错得最多的区域中心（Clicker.make_next_click），
+记录每次点击后的IoU，NoC@85/90是IoU第一次达到0.85/0.90需要的点击数。
+还可以用StageTimer按阶段记录每次点击的耗时。
+"""
+
+import os
+import time
+import os.path as osp
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from inference.clicker import Clicker
+
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff")
+
+
+def load_image(path):
+    """读取RGB图像，支持中文路径"""
+    image = cv2.imdecode(np.fromfile(path, dtype=np.uint8), 1)
+    if image is None:
+        raise ValueError(f"无法读取图像 {path}")
+    return image[:, :, ::-1]  # BGR转RGB
+
+
+def list_images(image_dir, num_images=None):
+    """文件夹中按文件名排序的前num_images张图像"""
+    names = sorted(
+        n for n in os.listdir(image_dir) if osp.splitext(n)[1].lower() in IMAGE_EXTS
+    )
+    return [osp.join(image_dir, n) for n in names[:num_images]]
+
+
+def load_gt_mask(path, ignore_value=255):
+    """读取灰度标签，大于0的像素是前景，ignore_value的像素不参与评估
+
+    Returns
+    -------
+    np.ndarray
+        1是前景，0是背景，-1是忽略
+    """
+    mask = cv2.imdecode(np.fromfile(path, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if mask is None:
+        raise ValueError(f"无法读取标签 {path}")
+    gt_mask = (mask > 0).astype(np.int32)
+    if ignore_value is not None:
+        gt_mask[mask == ignore_value] = -1
+    return gt_mask
+
+
+def get_gt_path(image_path, gt_dir, ext=".png"):
+    name = osp.splitext(osp.basename(image_path))[0]
+    return osp.join(gt_dir, name + ext)
+
+
+def get_iou(gt_mask, pred_mask, ignore_label=-1):
+    valid = gt_mask != ignore_label
+    gt = gt_mask == 1
+    intersection = np.logical_and(np.logical_and(pred_mask, gt), valid).sum()
+    union = np.logical_and(np.logical_or(pred_mask, gt), valid).sum()
+    return intersection / union if union > 0 else 1.0
+
+
+class StageTimer(object):
+    """按阶段记录每次的耗时，单位秒
+
+    赋给BasePredictor.stage_timer后记录推理的transform、preprocess、net和
+    postprocess阶段，evaluate_sample另外记录next_click（模拟点击）和click
+    （一次get_prediction的总耗时）。
+    """
+
+    def __init__(self):
+        self.times = OrderedDict()
+
+    def record(self, stage, seconds):
+        self.times.setdefault(stage, []).append(seconds)
+
+    def update(self, times):
+        """合并另一个StageTimer的times"""
+        for stage, values in times.items():
+            self.times.setdefault(stage, []).extend(values)
+
+    def summary(self, percentiles=(50, 95)):
+        """各阶段的次数、平均耗时和分位数耗时，单位毫秒"""
+        result = OrderedDict()
+        for stage, values in self.times.items():
+            values = np.asarray(values) * 1000
+            stats = {"count": len(values), "mean": float(values.mean())}
+            for p in percentiles:
+                stats[f"p{p}"] = float(np.percentile(values, p))
+            result[stage] = stats
+        return result
+
+
+def evaluate_sample(
+    predictor,
+    image,
+    gt_mask,
+    max_clicks=20,
+    pred_thresh=0.49,
+    callback=None,
+    timer=None,
+):
+    """在一张图像上模拟max_clicks次点击
+
+    Parameters
+    ----------
+    predictor : BasePredictor
+        推理器
+    image : np.ndarray
+        RGB图像
+    gt_mask : np.ndarray
+        1是前景，0是背景，-1是忽略
+    max_clicks : int
+        最多点击次数
+    pred_thresh : float
+        概率大于这个值算前景
+    callback : callable
+        每次点击后调用callback(click_idx, clicker, probs)
+    timer : StageTimer
+        记录模拟点击和推理的耗时
+
+    Returns
+    -------
+    np.ndarray
+        每次点击后的IoU
+    """
+    clicker = Clicker(gt_mask=gt_mask)
+    pred_mask = np.zeros(gt_mask.shape, dtype=bool)
+    ious = []
+    predictor.set_input_image(image)
+    for click_idx in range(max_clicks):
+        tic = time.perf_counter()
+        clicker.make_next_click(pred_mask)
+        toc = time.perf_counter()
+        probs = predictor.get_prediction(clicker)
+        if timer is not None:
+            timer.record("next_click", toc - tic)
+            timer.record("click", time.perf_counter() - toc)
+        pred_mask = probs > pred_thresh
+        ious.append(get_iou(gt_mask, pred_mask))
+        if callback is not None:
+            callback(click_idx, clicker, probs)
+    return np.array(ious, dtype=np.float64)
+
+
+def compute_noc(ious, iou_thresh, max_clicks=20):
+    """IoU第一次达到iou_thresh需要的点击数，达不到时记为max_clicks"""
+    reached = np.flatnonzero(np.asarray(ious) >= iou_thresh)
+    return int(reached[0]) + 1 if len(reached) > 0 else max_clicks
+
+
+def get_noc_metrics(all_ious, iou_threshs=(0.85, 0.9), max_clicks=20):
+    """汇总多张图像的评估结果
+
+    Returns
+    -------
+    dict
+        NoC@85、NoC@90等平均点击数，达不到阈值的图像数NoF@85等，
+        以及每次点击后的平均IoU miou_per_click
+    """
+    metrics = {}
+    for thresh in iou_threshs:
+        nocs = [compute_noc(ious, thresh, max_clicks) for ious in all_ious]
+        name = f"{int(round(thresh * 100))}"
+        metrics[f"NoC@{name}"] = float(np.mean(nocs)) if nocs else 0.0
+        metrics[f"NoF@{name}"] = int(
+            sum(ious.max() < thresh for ious in all_ious if len(ious) > 0)
+        )
+    if all_ious:
+        num_clicks = min(len(ious) for ious in all_ious)
+        per_click = np.mean([ious[:num_clicks] for ious in all_ious], axis=0)
+        metrics["miou_per_click"] = [float(v) for v in per_click]
+    else:
+        metrics["miou_per_click"] = []
+    return metrics
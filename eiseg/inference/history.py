@@ -0,0 +1,363 @@
+# Copyright (c) 2021 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+点击历史，用于撤销和重做。
+
+当前状态原样保存，撤销栈和重做栈中的状态只保存和相邻状态不同的部分：
+状态中的大数组（概率图等）裁剪到和相邻状态不同的区域，再转成float16或uint8，
+paddle张量还原成numpy数组，由推理器转回张量。ZoomIn的ROI图像可以用图像和ROI重新得到，
+不放在状态中。撤销栈超过内存上限时，最早的状态压缩后写到磁盘，
+磁盘上的状态也有条数上限，超过后丢弃最早的状态，不能再撤销到那么早。
+暂时不标注的物体可以用suspend把当前状态也按同样的方式压缩，用到时再还原。
+"""
+
+import os
+import os.path as osp
+import zlib
+import pickle
+import tempfile
+
+import numpy as np
+
+from eiseg import logger
+
+
+STORAGE_DTYPES = ("float32", "float16", "uint8")
+
+
+class ArrayPatch(object):
+    """一个数组和参照数组不同的区域
+
+    只在最后两维上裁剪，前面的维度保留全部。区域内的值相同时只保存一个数。
+    """
+
+    def __init__(self, shape, dtype, rows, cols, values, scale=None):
+        self.shape = shape
+        self.dtype = dtype
+        self.rows = rows
+        self.cols = cols
+        self.values = values
+        self.scale = scale
+
+    @property
+    def nbytes(self):
+        return np.asarray(self.values).nbytes
+
+    @classmethod
+    def create(cls, array, ref=None, storage_dtype="float16"):
+        if ref is not None and ref.shape == array.shape:
+            changed = array != ref
+        else:
+            ref = None
+            changed = array != 0
+        changed = changed.reshape(-1, *array.shape[-2:]).any(axis=0)
+        rows = np.flatnonzero(changed.any(axis=1))
+        cols = np.flatnonzero(changed.any(axis=0))
+        if len(rows) == 0:
+            return cls(array.shape, array.dtype, (0, 0), (0, 0), None)
+        rows = (int(rows[0]), int(rows[-1]) + 1)
+        cols = (int(cols[0]), int(cols[-1]) + 1)
+        values = array[..., rows[0] : rows[1], cols[0] : cols[1]]
+        vmin, vmax = values.min(), values.max()
+        scale = None
+        if vmin == vmax:
+            values = array.dtype.type(vmin)
+        elif storage_dtype == "uint8" and vmin >= 0 and vmax <= 1:
+            scale = 255.0
+            values = np.round(values * scale).astype("uint8")
+        elif storage_dtype in ("float16", "uint8"):
+            values = values.astype("float16")
+        else:
+            values = values.copy()
+        return cls(array.shape, array.dtype, rows, cols, values, scale)
+
+    def apply(self, ref=None):
+        """在参照数组的副本上写入不同的区域"""
+        if ref is not None and ref.shape == self.shape:
+            array = np.array(ref, dtype=self.dtype)
+        else:
+            array = np.zeros(self.shape, dtype=self.dtype)
+        if self.values is None:
+            return array
+        values = self.values
+        if self.scale is not None:
+            values = values.astype(self.dtype) / self.scale
+        array[..., self.rows[0] : self.rows[1], self.cols[0] : self.cols[1]] = values
+        return array
+
+
+class _ArrayLeaf(object):
+    """状态中的一个大数组，多个数组共享内存时共用一个ArrayPatch"""
+
+    def __init__(self, patch, shape):
+        self.patch = patch
+        self.shape = shape
+
+
+class _SpilledState(object):
+    """写到磁盘上的状态"""
+
+    def __init__(self, path, nbytes):
+        self.path = path
+        self.nbytes = nbytes
+
+
+def _is_tensor(x):
+    return not isinstance(x, np.ndarray) and hasattr(x, "numpy")
+
+
+def _memory_key(array):
+    """连续数组按内存地址区分，reshape或取[0, 0]得到的数组认为是同一个"""
+    if not array.flags.c_contiguous:
+        return id(array)
+    return (array.__array_interface__["data"][0], array.nbytes, array.dtype.str)
+
+
+class ClickHistory(object):
+    """撤销和重做用的状态历史
+
+    Parameters
+    ----------
+    dtype : str
+        保存数组变化区域的类型，float32无损，float16或uint8更省内存，
+        uint8只用于值在0到1之间的数组
+    max_memory : int
+        撤销栈在内存中最多占用多少MB，超过后把最早的状态写到磁盘，
+        不包括当前状态
+    max_disk_states : int
+        磁盘上最多保存多少个状态，为0时不写磁盘，超过内存上限直接丢弃
+    min_array_size : int
+        元素个数不少于这个值的浮点数组才裁剪保存
+    """
+
+    def __init__(
+        self, dtype="float16", max_memory=512, max_disk_states=100, min_array_size=4096
+    ):
+        if dtype not in STORAGE_DTYPES:
+            raise ValueError(f"不支持的历史保存类型{dtype}，可选{STORAGE_DTYPES}")
+        self.dtype = dtype
+        self.max_memory = max_memory * 1024 * 1024
+        self.max_disk_states = max_disk_states
+        self.min_array_size = min_array_size
+        self._current = None
+        # 当前状态是否被suspend压缩了
+        self._suspended = False
+        self._undo = []
+        self._redo = []
+        self._tempdir = None
+        self._spill_idx = 0
+
+    def __len__(self):
+        """包括当前状态在内能撤销到的状态数"""
+        if self._current is None:
+            return 0
+        return len(self._undo) + 1
+
+    @property
+    def current(self):
+        self.resume()
+        return self._current
+
+    @property
+    def suspended(self):
+        return self._suspended
+
+    @property
+    def num_redo(self):
+        return len(self._redo)
+
+    @property
+    def memory_bytes(self):
+        """撤销栈和重做栈在内存中占用的字节数"""
+        return sum(
+            s[1] for s in self._undo + self._redo if not isinstance(s, _SpilledState)
+        )
+
+    @property
+    def num_spilled(self):
+        return sum(isinstance(s, _SpilledState) for s in self._undo)
+
+    def push(self, state):
+        """保存一个新的当前状态，清空重做栈"""
+        self.resume()
+        if self._current is not None:
+            self._undo.append(self._encode(self._current, state))
+        self._current = state
+        self.clear_redo()
+        self._limit_memory()
+
+    def undo(self):
+        """退回上一个状态并返回它，没有时返回None"""
+        if not self._undo:
+            return None
+        self.resume()
+        state = self._decode(self._load(self._undo.pop()), self._current)
+        self._redo.append(self._encode(self._current, state))
+        self._current = state
+        return state
+
+    def redo(self):
+        """重做一个撤销掉的状态并返回它，没有时返回None"""
+        if not self._redo:
+            return None
+        self.resume()
+        state = self._decode(self._redo.pop(), self._current)
+        self._undo.append(self._encode(self._current, state))
+        self._current = state
+        self._limit_memory()
+        return state
+
+    def suspend(self):
+        """把当前状态中的大数组也换成和全0数组不同的区域，节省暂时不用的历史的内存
+
+        之后访问current、push、撤销或重做时自动还原，还原后的数组按dtype有精度损失。
+        """
+        if self._current is None or self._suspended:
+            return
+        self._current = self._encode(self._current, None)
+        self._suspended = True
+
+    def resume(self):
+        """还原suspend压缩的当前状态"""
+        if not self._suspended:
+            return
+        self._current = self._decode(self._current, None)
+        self._suspended = False
+
+    def clear_redo(self):
+        self._redo = []
+
+    def clear(self):
+        for state in self._undo:
+            if isinstance(state, _SpilledState):
+                os.remove(state.path)
+        self._current = None
+        self._suspended = False
+        self._undo = []
+        self._redo = []
+
+    def _encode(self, state, ref):
+        """把state中的大数组换成和ref中对应数组不同的区域
+
+        Returns
+        -------
+        tuple
+            编码后的状态和占用的字节数
+        """
+        patches = {}
+
+        def encode(obj, ref):
+            if isinstance(obj, dict):
+                ref = ref if isinstance(ref, dict) else {}
+                return {k: encode(v, ref.get(k)) for k, v in obj.items()}
+            if isinstance(obj, (list, tuple)):
+                if not isinstance(ref, (list, tuple)) or len(ref) != len(obj):
+                    ref = [None] * len(obj)
+                return type(obj)(encode(v, r) for v, r in zip(obj, ref))
+            array = obj.numpy() if _is_tensor(obj) else obj
+            if (
+                not isinstance(array, np.ndarray)
+                or array.ndim < 2
+                or array.size < self.min_array_size
+                or not np.issubdtype(array.dtype, np.floating)
+            ):
+                return obj
+            key = _memory_key(array)
+            patch = patches.get(key)
+            if patch is None:
+                if _is_tensor(ref):
+                    ref = ref.numpy()
+                if not isinstance(ref, np.ndarray) or ref.size != array.size:
+                    ref = None
+                elif ref.shape != array.shape:
+                    ref = ref.reshape(array.shape)
+                patch = ArrayPatch.create(array, ref, self.dtype)
+                patches[key] = patch
+            return _ArrayLeaf(patch, array.shape)
+
+        encoded = encode(state, ref)
+        return encoded, sum(p.nbytes for p in patches.values())
+
+    def _decode(self, encoded, ref):
+        """用ref中对应的数组还原编码前的状态"""
+        state, _ = encoded
+        arrays = {}
+
+        def decode(obj, ref):
+            if isinstance(obj, dict):
+                ref = ref if isinstance(ref, dict) else {}
+                return {k: decode(v, ref.get(k)) for k, v in obj.items()}
+            if isinstance(obj, (list, tuple)):
+                if not isinstance(ref, (list, tuple)) or len(ref) != len(obj):
+                    ref = [None] * len(obj)
+                return type(obj)(decode(v, r) for v, r in zip(obj, ref))
+            if not isinstance(obj, _ArrayLeaf):
+                return obj
+            array = arrays.get(id(obj.patch))
+            if array is None:
+                if _is_tensor(ref):
+                    ref = ref.numpy()
+                if not isinstance(ref, np.ndarray) or ref.size != np.prod(
+                    obj.patch.shape
+                ):
+                    ref = None
+                else:
+                    ref = ref.reshape(obj.patch.shape)
+                array = obj.patch.apply(ref)
+                arrays[id(obj.patch)] = array
+            return array.reshape(obj.shape)
+
+        return decode(state, ref)
+
+    def _limit_memory(self):
+        """撤销栈超过内存上限时把最早的状态写到磁盘"""
+        memory = self.memory_bytes
+        for idx, state in enumerate(self._undo):
+            if memory <= self.max_memory:
+                break
+            if isinstance(state, _SpilledState):
+                continue
+            memory -= state[1]
+            if self.max_disk_states > 0:
+                self._undo[idx] = self._spill(state)
+            else:
+                self._undo[idx] = None
+        # 丢掉最早的状态，只能撤销到还保存着的状态
+        num_spilled = self.num_spilled
+        while self._undo and (
+            self._undo[0] is None or num_spilled > self.max_disk_states
+        ):
+            state = self._undo.pop(0)
+            if isinstance(state, _SpilledState):
+                os.remove(state.path)
+                num_spilled -= 1
+            logger.debug("Dropped the oldest click history")
+
+    def _spill(self, state):
+        if self._tempdir is None:
+            self._tempdir = tempfile.TemporaryDirectory(prefix="eiseg_history_")
+        path = osp.join(self._tempdir.name, f"{self._spill_idx}.bin")
+        self._spill_idx += 1
+        data = zlib.compress(pickle.dumps(state, pickle.HIGHEST_PROTOCOL), 1)
+        with open(path, "wb") as f:
+            f.write(data)
+        return _SpilledState(path, state[1])
+
+    def _load(self, state):
+        if not isinstance(state, _SpilledState):
+            return state
+        with open(state.path, "rb") as f:
+            data = f.read()
+        os.remove(state.path)
+        return pickle.loads(zlib.decompress(data))
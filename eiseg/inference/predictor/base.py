@@ -18,12 +18,18 @@ MIT License [see LICENSE for details]
 """
 
 
-import paddle
-import paddle.nn.functional as F
+import time
+import weakref
+from collections import OrderedDict
+
 import numpy as np
 
 from inference.transforms import AddHorizontalFlip, SigmoidForPred, LimitLongestSide
-from .ops import DistMaps, ScaleLayer, BatchImageNormalize
+from inference.transforms import ShapeBucket
+from inference.transforms import ops
+from inference.clicker import as_clicks
+from .ops import DistMaps, BatchImageNormalize
+from .buffers import NetIO
 
 
 class BasePredictor(object):
@@ -35,12 +41,16 @@ class BasePredictor(object):
         zoom_in=None,
         max_size=None,
         with_mask=True,
+        use_numpy=False,
+        shape_bucket=None,
+        net_batch_size=None,
         **kwargs
     ):
 
         self.with_flip = with_flip
         self.net_clicks_limit = net_clicks_limit
         self.original_image = None
+        self._image_source = None
         self.zoom_in = zoom_in
         self.prev_prediction = None
         self.model_indx = 0
@@ -48,6 +58,17 @@ class BasePredictor(object):
         self.net_state_dict = None
         self.with_prev_mask = with_mask
         self.net = model
+        self.net_io = None
+        # 每次最多送入网络的图像数，多物体或切块推理时限制网络中间结果占用的内存
+        self.net_batch_size = net_batch_size
+        # 设置后按阶段记录每次推理的耗时，需要有record(stage, seconds)方法
+        self.stage_timer = None
+        # 变换状态 -> (点击, 点击特征)，用于增量更新点击特征
+        self._click_maps = OrderedDict()
+        # get_predictions_batch中每个clicker对应的物体状态
+        self._object_states = weakref.WeakKeyDictionary()
+        # 前后处理全部用numpy/OpenCV，不执行paddle动态图算子
+        self.use_numpy = use_numpy
 
         self.normalization = BatchImageNormalize(
             [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]
@@ -56,31 +77,58 @@ class BasePredictor(object):
         self.transforms = [zoom_in] if zoom_in is not None else []
         if max_size is not None:
             self.transforms.append(LimitLongestSide(max_size=max_size))
+        # 把输入补边到固定的几种大小，减少MKLDNN为新输入大小创建算子的开销
+        self.shape_bucket = None
+        if shape_bucket is not None:
+            self.shape_bucket = ShapeBucket(**shape_bucket)
+            self.transforms.append(self.shape_bucket)
         self.transforms.append(SigmoidForPred())
         if with_flip:
             self.transforms.append(AddHorizontalFlip())
         self.dist_maps = DistMaps(
-            norm_radius=5, spatial_scale=1.0, cpu_mode=False, use_disks=True
+            norm_radius=5, spatial_scale=1.0, cpu_mode=use_numpy, use_disks=True
         )
 
     def to_tensor(self, x):
         if isinstance(x, np.ndarray):
             if x.ndim == 2:
                 x = x[:, :, None]
-        img = paddle.to_tensor(x.transpose([2, 0, 1])).astype("float32") / 255
+        if self.use_numpy:
+            img = np.empty((x.shape[2], x.shape[0], x.shape[1]), dtype="float32")
+            np.divide(x.transpose([2, 0, 1]), 255, out=img, dtype="float32")
+            return img
+        img = ops.to_tensor(x.transpose([2, 0, 1])).astype("float32") / 255
         return img
 
     def set_input_image(self, image):
-        image_nd = self.to_tensor(image)
-
+        """设置推理图像并重置推理状态
+
+        同一个图像数组（按对象判断）只会转换一次，之后只重置变换和上一次的预测结果。
+        因此原地修改图像数组后需要传入新的数组对象。
+        """
+        if not self.is_image_set(image):
+            image_nd = self.to_tensor(image)
+            if len(image_nd.shape) == 3:
+                image_nd = image_nd[None] if self.use_numpy else image_nd.unsqueeze(0)
+            self.original_image = image_nd
+            self._image_source = image
+        self.reset()
+
+    def is_image_set(self, image):
+        return image is not None and image is self._image_source
+
+    def reset(self):
+        """清空变换状态和上一次的预测结果，保留已缓存的图像"""
         for transform in self.transforms:
             transform.reset()
-        self.original_image = image_nd
-        if len(self.original_image.shape) == 3:
-            self.original_image = self.original_image.unsqueeze(0)
-        self.prev_prediction = paddle.zeros_like(self.original_image[:, :1, :, :])
+        self._click_maps.clear()
+        self._object_states.clear()
+        if self.original_image is None:
+            return
+        mask_shape = [1, 1, *self.original_image.shape[2:]]
+        self.prev_prediction = ops.zeros_like(self.original_image, shape=mask_shape)
         if not self.with_prev_mask:
-            self.prev_edge = paddle.zeros_like(self.original_image[:, :1, :, :])
+            self.prev_edge = ops.zeros_like(self.original_image, shape=mask_shape)
 
     def get_prediction(self, clicker, prev_mask=None):
         clicks_list = clicker.get_clicks()
@@ -93,80 +141,247 @@ class BasePredictor(object):
             else:
                 prev_mask = self.prev_prediction
 
-        input_image = paddle.concat([input_image, prev_mask], axis=1)
+        tic = time.perf_counter()
+        input_image = ops.concat([input_image, prev_mask], axis=1)
 
         image_nd, clicks_lists, is_image_changed = self.apply_transforms(
             input_image, [clicks_list]
         )
+        self._record_time("transform", tic)
         pred_logits, pred_edges = self._get_prediction(
             image_nd, clicks_lists, is_image_changed
         )
+        tic = time.perf_counter()
+        prediction = self._inv_transform_prediction(
+            pred_logits, pred_edges, image_nd.shape[2:]
+        )
+        self._record_time("postprocess", tic)
+
+        if self.zoom_in is not None and self.zoom_in.check_possible_recalculation():
+            return self.get_prediction(clicker)
 
-        pred_logits = paddle.to_tensor(pred_logits)
+        self.prev_prediction = prediction
+        return ops.to_numpy(prediction)[0, 0]
 
-        prediction = F.interpolate(
-            pred_logits, mode="bilinear", align_corners=True, size=image_nd.shape[2:]
-        )
+    def _inv_transform_prediction(self, pred_logits, pred_edges, size):
+        if not self.use_numpy:
+            pred_logits = ops.to_tensor(pred_logits)
+        prediction = ops.interpolate(pred_logits, size=size)
         if pred_edges is not None:
-            pred_edge = paddle.to_tensor(pred_edges)
-            edge_prediction = F.interpolate(
-                pred_edge, mode="bilinear", align_corners=True, size=image_nd.shape[2:]
-            )
+            if not self.use_numpy:
+                pred_edges = ops.to_tensor(pred_edges)
+            edge_prediction = ops.interpolate(pred_edges, size=size)
 
         for t in reversed(self.transforms):
             if pred_edges is not None:
                 edge_prediction = t.inv_transform(edge_prediction)
                 self.prev_edge = edge_prediction
             prediction = t.inv_transform(prediction)
+        return prediction
+
+    def get_predictions_batch(self, clickers, prev_masks=None):
+        """一次推理多个物体，每个物体对应一个clicker
+
+        每个clicker的变换状态和上一次的预测结果单独保存，变换后输入大小相同的物体
+        拼成一个batch，只跑一次网络。不影响get_prediction使用的单物体状态。
+
+        Parameters
+        ----------
+        clickers : list
+            每个物体的Clicker
+        prev_masks : list
+            每个物体上一次的结果，[1, 1, H, W]，为None时用这个物体上一次的预测
+
+        Returns
+        -------
+        list
+            每个物体的概率图，[H, W]
+        """
+        if prev_masks is None:
+            prev_masks = [None] * len(clickers)
+        assert len(prev_masks) == len(clickers)
+        own_state = self._get_object_state()
+
+        inputs = []
+        for clicker, prev_mask in zip(clickers, prev_masks):
+            self._set_object_state(self._object_states.get(clicker))
+            if prev_mask is None:
+                prev_mask = (
+                    self.prev_prediction if self.with_prev_mask else self.prev_edge
+                )
+            input_image = ops.concat([self.original_image, prev_mask], axis=1)
+            image_nd, clicks_lists, _ = self.apply_transforms(
+                input_image, [clicker.get_clicks()]
+            )
+            inputs.append((image_nd, clicks_lists, self._get_object_state()))
+
+        groups = OrderedDict()
+        for idx, (image_nd, _, _) in enumerate(inputs):
+            groups.setdefault(tuple(image_nd.shape[1:]), []).append(idx)
+
+        predictions = [None] * len(clickers)
+        for indices in groups.values():
+            image_nd = ops.concat([inputs[idx][0] for idx in indices], axis=0)
+            clicks_lists = [c for idx in indices for c in inputs[idx][1]]
+            pred_logits, pred_edges = self._get_prediction(
+                image_nd, clicks_lists, True
+            )
 
-        if self.zoom_in is not None and self.zoom_in.check_possible_recalculation():
-            return self.get_prediction(clicker)
-
-        self.prev_prediction = prediction
-        return prediction.numpy()[0, 0]
+            start = 0
+            for idx in indices:
+                clicker = clickers[idx]
+                obj_image_nd, _, state = inputs[idx]
+                end = start + obj_image_nd.shape[0]
+                self._set_object_state(state)
+                prediction = self._inv_transform_prediction(
+                    pred_logits[start:end],
+                    None if pred_edges is None else pred_edges[start:end],
+                    obj_image_nd.shape[2:],
+                )
+                start = end
+                if (
+                    self.zoom_in is not None
+                    and self.zoom_in.check_possible_recalculation()
+                ):
+                    # ROI需要重算，这个物体单独再推理一次
+                    predictions[idx] = self.get_prediction(clicker, prev_masks[idx])
+                else:
+                    self.prev_prediction = prediction
+                    predictions[idx] = ops.to_numpy(prediction)[0, 0]
+                self._object_states[clicker] = self._get_object_state()
+
+        self._set_object_state(own_state)
+        return predictions
+
+    def _get_object_state(self):
+        return {
+            "transform_states": self._get_transform_states(),
+            "prev_prediction": self.prev_prediction,
+            "prev_edge": getattr(self, "prev_edge", None),
+        }
 
-    def prepare_input(self, image):
-        prev_mask = None
+    def _set_object_state(self, state):
+        if state is None:
+            # 新物体从空白状态开始
+            for transform in self.transforms:
+                transform.reset()
+            mask_shape = [1, 1, *self.original_image.shape[2:]]
+            self.prev_prediction = ops.zeros_like(self.original_image, shape=mask_shape)
+            if not self.with_prev_mask:
+                self.prev_edge = ops.zeros_like(self.original_image, shape=mask_shape)
+            return
+        self._set_transform_states(state["transform_states"])
+        self.prev_prediction = self._as_input(state["prev_prediction"])
+        if state["prev_edge"] is not None:
+            self.prev_edge = self._as_input(state["prev_edge"])
+
+    def _as_input(self, x):
+        """撤销历史还原出来的是numpy数组，paddle路径中转回张量"""
+        if x is None or self.use_numpy or not ops.is_numpy(x):
+            return x
+        return ops.to_tensor(x)
+
+    def prepare_input(self, image, out=None):
         prev_mask = image[:, 3:, :, :]
         image = image[:, :3, :, :]
-        image = self.normalization(image)
+        image = self.normalization(image, out=out)
         return image, prev_mask
 
-    def get_coord_features(self, image, prev_mask, points):
+    def get_coord_features(self, image, prev_mask, points, out=None):
+        bs, _, rows, cols = image.shape
 
-        coord_features = self.dist_maps(image, points)
+        if out is not None:
+            num_prev = 0 if prev_mask is None else prev_mask.shape[1]
+            if prev_mask is not None:
+                out[:, :num_prev] = prev_mask
+            if self.dist_maps.cpu_mode:
+                out[:, num_prev:] = self._get_click_maps(points, rows, cols)
+            else:
+                out[:, num_prev:] = self.dist_maps.get_coord_features(
+                    points, bs, rows, cols
+                ).numpy()
+            self.net_io.record("coord_features", out.nbytes)
+            return out
+
+        coord_features = self.dist_maps.get_coord_features(points, bs, rows, cols)
 
         if prev_mask is not None:
-            coord_features = paddle.concat((prev_mask, coord_features), axis=1)
+            coord_features = ops.concat((prev_mask, coord_features), axis=1)
 
         return coord_features
 
+    def _get_click_maps(self, points, rows, cols):
+        """按变换状态缓存点击特征，只增删变化的点击
+
+        ZoomIn或LimitLongestSide换了ROI时所有点击坐标都变了，按新的ROI整个重画
+        """
+        bs = points.shape[0]
+        rois = tuple(getattr(t, "_object_roi", None) for t in self.transforms)
+        key = (rows, cols, rois)
+        prev_points, maps = self._click_maps.pop(key, (None, None))
+        if maps is None or maps.shape[0] != bs:
+            maps = np.empty((bs, 2, rows, cols), dtype="float32")
+            self.dist_maps.get_coord_features(points, bs, rows, cols, out=maps)
+        elif not self.dist_maps.update_coord_features(points, prev_points, maps):
+            self.dist_maps.get_coord_features(points, bs, rows, cols, out=maps)
+        self._click_maps[key] = (points, maps)
+        while len(self._click_maps) > 4:
+            self._click_maps.popitem(last=False)
+        return maps
+
+    def _record_time(self, stage, tic):
+        """设置了stage_timer时记录从tic开始的这个阶段的耗时，返回当前时间"""
+        toc = time.perf_counter()
+        if self.stage_timer is not None:
+            self.stage_timer.record(stage, toc - tic)
+        return toc
+
     def _get_prediction(self, image_nd, clicks_lists, is_image_changed):
-        input_names = self.net.get_input_names()
-        self.input_handle_1 = self.net.get_input_handle(input_names[0])
-        self.input_handle_2 = self.net.get_input_handle(input_names[1])
+        tic = time.perf_counter()
+        if self.net_io is None:
+            self.net_io = NetIO(self.net)
         points_nd = self.get_points_nd(clicks_lists)
 
-        image, prev_mask = self.prepare_input(image_nd)
-        coord_features = self.get_coord_features(image, prev_mask, points_nd)
-        image = image.numpy().astype("float32")
-        coord_features = coord_features.numpy().astype("float32")
-
-        self.input_handle_1.copy_from_cpu(image)
-        self.input_handle_2.copy_from_cpu(coord_features)
-
-        self.net.run()
-
-        output_names = self.net.get_output_names()
-
-        output_handle = self.net.get_output_handle(output_names[0])
-        output_data = output_handle.copy_to_cpu()
-        if len(output_names) == 3:
-            edge_handle = self.net.get_output_handle(output_names[2])
-            edge_data = edge_handle.copy_to_cpu()
-            return output_data, edge_data
-        else:
-            return output_data, None
+        if not self.use_numpy:
+            image_nd = image_nd.numpy()
+            self.net_io.record("to_host", image_nd.nbytes)
+        bs, _, rows, cols = image_nd.shape
+
+        # 归一化和点击特征直接写进复用的输入内存
+        image = self.net_io.get_buffer(0, (bs, 3, rows, cols))
+        image, prev_mask = self.prepare_input(image_nd, out=image)
+        self.net_io.record("normalize", image.nbytes)
+        coord_features = self.net_io.get_buffer(
+            1, (bs, prev_mask.shape[1] + 2, rows, cols)
+        )
+        coord_features = self.get_coord_features(
+            image, prev_mask, points_nd, out=coord_features
+        )
+        tic = self._record_time("preprocess", tic)
+
+        self.net_io.run([image, coord_features], self.net_batch_size)
+
+        output_data = self.net_io.get_output(0)
+        edge_data = None
+        if self.net_io.num_outputs == 3:
+            edge_data = self.net_io.get_output(2)
+        self._record_time("net", tic)
+        return output_data, edge_data
+
+    def get_copy_report(self):
+        """每次推理各阶段拷贝/写入的字节数"""
+        if self.net_io is None:
+            return {}
+        return self.net_io.report()
+
+    def get_shape_stats(self):
+        """输入大小分桶的命中率，以及新输入大小和重复输入大小的平均推理耗时"""
+        stats = {}
+        if self.shape_bucket is not None:
+            stats.update(self.shape_bucket.get_stats())
+        if self.net_io is not None:
+            stats.update(self.net_io.latency_report())
+        return stats
 
     def _get_transform_states(self):
         return [x.get_state() for x in self.transforms]
@@ -185,10 +400,12 @@ class BasePredictor(object):
         return image_nd, clicks_lists, is_image_changed
 
     def get_points_nd(self, clicks_lists):
-        total_clicks = []
-        num_pos_clicks = [
-            sum(x.is_positive for x in clicks_list) for clicks_list in clicks_lists
-        ]
+        """所有点击填进一个[bs, 2 * num_points, 3]的数组
+
+        每组前一半是正点，后一半是负点，每个点是(y, x, 点击序号)，不足的用-1补齐
+        """
+        clicks_lists = [as_clicks(x) for x in clicks_lists]
+        num_pos_clicks = [x.num_positive for x in clicks_lists]
         num_neg_clicks = [
             len(clicks_list) - num_pos
             for clicks_list, num_pos in zip(clicks_lists, num_pos_clicks)
@@ -198,24 +415,22 @@ class BasePredictor(object):
             num_max_points = min(self.net_clicks_limit, num_max_points)
         num_max_points = max(1, num_max_points)
 
-        for clicks_list in clicks_lists:
-            clicks_list = clicks_list[: self.net_clicks_limit]
-            pos_clicks = [
-                click.coords_and_indx for click in clicks_list if click.is_positive
-            ]
-            pos_clicks = pos_clicks + (num_max_points - len(pos_clicks)) * [
-                (-1, -1, -1)
-            ]
-
-            neg_clicks = [
-                click.coords_and_indx for click in clicks_list if not click.is_positive
-            ]
-            neg_clicks = neg_clicks + (num_max_points - len(neg_clicks)) * [
-                (-1, -1, -1)
-            ]
-            total_clicks.append(pos_clicks + neg_clicks)
-
-        return paddle.to_tensor(total_clicks)
+        points = np.full(
+            (len(clicks_lists), 2 * num_max_points, 3), -1, dtype="float32"
+        )
+        for i, clicks_list in enumerate(clicks_lists):
+            data = clicks_list.data[: self.net_clicks_limit]
+            is_positive = data["is_positive"]
+            groups = ((0, data[is_positive]), (num_max_points, data[~is_positive]))
+            for start, group in groups:
+                end = start + len(group)
+                points[i, start:end, 0] = group["y"]
+                points[i, start:end, 1] = group["x"]
+                points[i, start:end, 2] = group["indx"]
+
+        if self.use_numpy:
+            return points
+        return ops.to_tensor(points)
 
     def get_states(self):
         return {
@@ -224,8 +439,12 @@ class BasePredictor(object):
         }
 
     def set_states(self, states):
+        """恢复get_states保存的状态，为None时回到没有点击的空白状态，不重新转换图像"""
+        if states is None:
+            self._set_object_state(None)
+            return
         self._set_transform_states(states["transform_states"])
-        self.prev_prediction = states["prev_prediction"]
+        self.prev_prediction = self._as_input(states["prev_prediction"])
 
 
 def split_points_by_order(tpoints, groups):
@@ -259,6 +478,6 @@ def split_points_by_order(tpoints, groups):
 
             group_points[group_id][bindx, new_point_indx, :] = point
 
-    group_points = [paddle.to_tensor(x, dtype=tpoints.dtype) for x in group_points]
+    group_points = [ops.to_tensor(x, dtype=tpoints.dtype) for x in group_points]
 
     return group_points
@@ -0,0 +1,123 @@
+# Copyright (c) 2021 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class NetIO(object):
+    """推理网络的输入输出
+
+    每个输入按形状保留可复用的float32内存，预处理直接写入这些内存，
+    再由推理后端拷给推理库。
+
+    Parameters
+    ----------
+    net : models.InferenceBackend
+        推理网络
+    max_shapes : int
+        每个输入最多缓存多少种形状的内存，超过后丢弃最久没用的
+    """
+
+    def __init__(self, net, max_shapes=8):
+        self.net = net
+        self.input_names = net.get_input_names()
+        self.output_names = net.get_output_names()
+        self._outputs = None
+        self.max_shapes = max_shapes
+        self._buffers = OrderedDict()
+        self.copy_bytes = OrderedDict()
+        self.num_runs = 0
+        # 输入大小 -> [推理次数, 第一次的耗时, 之后的总耗时]
+        self.run_times = OrderedDict()
+
+    @property
+    def num_outputs(self):
+        return len(self.output_names)
+
+    def get_buffer(self, input_idx, shape):
+        """获取第input_idx个输入对应形状的float32内存，内容未初始化"""
+        key = (input_idx, tuple(shape))
+        buffer = self._buffers.pop(key, None)
+        if buffer is None:
+            buffer = np.empty(shape, dtype="float32")
+        self._buffers[key] = buffer
+        while len(self._buffers) > self.max_shapes * len(self.input_names):
+            self._buffers.popitem(last=False)
+        return buffer
+
+    def record(self, stage, nbytes):
+        self.copy_bytes[stage] = self.copy_bytes.get(stage, 0) + int(nbytes)
+
+    def run(self, inputs, batch_size=None):
+        """推理一次，batch_size不为None时按batch_size把输入分成几次送入网络
+
+        分批推理时网络中间结果的内存只和batch_size有关，输出按顺序拼回一个batch。
+        """
+        assert len(inputs) == len(self.input_names)
+        for data in inputs:
+            self.record("copy_from_cpu", data.nbytes)
+        num = len(inputs[0])
+        if batch_size is None or num <= batch_size:
+            self._outputs = self._run(inputs)
+        else:
+            chunks = [
+                self._run([data[start : start + batch_size] for data in inputs])
+                for start in range(0, num, batch_size)
+            ]
+            self._outputs = [np.concatenate(outputs) for outputs in zip(*chunks)]
+        self.num_runs += 1
+
+    def _run(self, inputs):
+        tic = time.perf_counter()
+        outputs = self.net.run(inputs)
+        self.record_time(tuple(inputs[0].shape), time.perf_counter() - tic)
+        return outputs
+
+    def record_time(self, shape, seconds):
+        times = self.run_times.get(shape)
+        if times is None:
+            self.run_times[shape] = [1, seconds, 0.0]
+        else:
+            times[0] += 1
+            times[2] += seconds
+
+    def latency_report(self):
+        """第一次遇到的输入大小（需要创建算子）和重复的输入大小的平均推理耗时"""
+        new = [t[1] for t in self.run_times.values()]
+        num_repeat = sum(t[0] - 1 for t in self.run_times.values())
+        repeat = sum(t[2] for t in self.run_times.values())
+        return {
+            "num_shapes": len(self.run_times),
+            "new_shape_latency": sum(new) / max(1, len(new)),
+            "repeat_shape_latency": repeat / max(1, num_repeat),
+        }
+
+    def get_output(self, output_idx):
+        output = self._outputs[output_idx]
+        self.record("copy_to_cpu", output.nbytes)
+        return output
+
+    def report(self):
+        """各阶段平均每次推理拷贝/写入的字节数"""
+        runs = max(1, self.num_runs)
+        return OrderedDict((k, v // runs) for k, v in self.copy_bytes.items())
+
+    def reset_report(self):
+        self.copy_bytes = OrderedDict()
+        self.num_runs = 0
+        self.run_times = OrderedDict()
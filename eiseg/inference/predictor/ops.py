@@ -18,38 +18,62 @@ MIT License [see LICENSE for details]
 """
 
 
-import paddle
-import paddle.nn as nn
+from collections import Counter, OrderedDict
+
 import numpy as np
 
+from inference.transforms import ops
+
+
+class DistMaps(object):
+    """点击特征，cpu_mode时用numpy计算，否则用paddle动态图计算"""
 
-class DistMaps(nn.Layer):
     def __init__(self, norm_radius, spatial_scale=1.0, cpu_mode=True, use_disks=False):
-        super(DistMaps, self).__init__()
         self.spatial_scale = spatial_scale
         self.norm_radius = norm_radius
         self.cpu_mode = cpu_mode
         self.use_disks = use_disks
 
         if self.cpu_mode:
-            from util.cython import get_dist_maps
-
             self._get_dist_maps = get_dist_maps
+            # 每种输入大小的行列坐标，只算一次
+            self._grids = OrderedDict()
 
-    def get_coord_features(self, points, batchsize, rows, cols):
+    def _get_grid(self, rows, cols):
+        key = (rows, cols)
+        grid = self._grids.pop(key, None)
+        if grid is None:
+            grid = (
+                np.arange(rows, dtype="float32"),
+                np.arange(cols, dtype="float32"),
+            )
+        self._grids[key] = grid
+        while len(self._grids) > 8:
+            self._grids.popitem(last=False)
+        return grid
+
+    def get_coord_features(self, points, batchsize, rows, cols, out=None):
         if self.cpu_mode:
-            coords = []
+            # cpu模式全部用numpy计算，输入是numpy时也返回numpy
+            is_numpy = isinstance(points, np.ndarray)
+            if not is_numpy:
+                points = points.numpy()
+            if out is None:
+                out = np.empty((batchsize, 2, rows, cols), dtype="float32")
+            row_array, col_array = self._get_grid(rows, cols)
             for i in range(batchsize):
-                norm_delimeter = (
-                    1.0 if self.use_disks else self.spatial_scale * self.norm_radius
+                self._get_dist_maps(
+                    points[i].astype("float32") * self.spatial_scale,
+                    row_array,
+                    col_array,
+                    self.norm_radius * self.spatial_scale,
+                    self.use_disks,
+                    out[i],
                 )
-                coords.append(
-                    self._get_dist_maps(
-                        points[i].numpy().astype("float32"), rows, cols, norm_delimeter
-                    )
-                )
-            coords = paddle.to_tensor(np.stack(coords, axis=0)).astype("float32")
+            return out if is_numpy else ops.to_tensor(out)
         else:
+            import paddle
+
             num_points = points.shape[1] // 2
             points = points.reshape([-1, points.shape[2]])
             points, points_order = paddle.split(points, [2, 1], axis=1)
@@ -87,34 +111,168 @@ class DistMaps(nn.Layer):
             coords = paddle.tanh(paddle.sqrt(coords) * 2)
         return coords
 
-    def forward(self, x, coords):
+    def update_coord_features(self, points, prev_points, maps, max_changes=4):
+        """在上一次的点击特征maps上只画新增的点击、擦掉删除的点击
+
+        Parameters
+        ----------
+        points, prev_points : np.ndarray
+            [bs, 2 * num_points, 3]，这次和上次的点击
+        maps : np.ndarray
+            [bs, 2, rows, cols]，prev_points对应的点击特征，原地修改
+        max_changes : int
+            每组点击最多增删几个，超过了不如整个重画
+
+        Returns
+        -------
+        bool
+            是否更新成功，False时maps没有被修改
+        """
+        assert self.cpu_mode
+        if points.shape[0] != prev_points.shape[0]:
+            return False
+        bs, _, rows, cols = maps.shape
+        changes = []
+        for i in range(bs):
+            for group in range(2):
+                curr = get_group_points(points[i], group, self.spatial_scale)
+                prev = get_group_points(prev_points[i], group, self.spatial_scale)
+                added = list((Counter(curr) - Counter(prev)).elements())
+                removed = list((Counter(prev) - Counter(curr)).elements())
+                if len(added) + len(removed) > max_changes:
+                    return False
+                changes.append((i, group, curr, added, removed))
+
+        row_array, col_array = self._get_grid(rows, cols)
+        radius = self.norm_radius * self.spatial_scale
+        window = radius if self.use_disks else 5 * radius
+        for i, group, curr, added, removed in changes:
+            dist_map = maps[i, group]
+            for point in removed:
+                # 擦掉删除的点击所在的窗口，再用剩下的点击把这个窗口重画一遍
+                clip = get_point_window(point, window, rows, cols)
+                dist_map[clip[0] : clip[1], clip[2] : clip[3]] = (
+                    0 if self.use_disks else 1
+                )
+                for other in curr:
+                    set_point_window(
+                        dist_map,
+                        other,
+                        row_array,
+                        col_array,
+                        radius,
+                        window,
+                        self.use_disks,
+                        clip=clip,
+                    )
+            for point in added:
+                set_point_window(
+                    dist_map, point, row_array, col_array, radius, window, self.use_disks
+                )
+        return True
+
+    def __call__(self, x, coords):
         return self.get_coord_features(coords, x.shape[0], x.shape[2], x.shape[3])
 
 
-class ScaleLayer(nn.Layer):
-    def __init__(self, init_value=1.0, lr_mult=1):
-        super().__init__()
-        self.lr_mult = lr_mult
-        self.scale = self.create_parameter(
-            shape=[1],
-            dtype="float32",
-            default_initializer=nn.initializer.Constant(init_value / lr_mult),
-        )
+def get_dist_maps(points, row_array, col_array, radius, use_disks, out):
+    """把正负点击画到out里，只计算每个点击半径附近的窗口
+
+    Parameters
+    ----------
+    points : np.ndarray
+        [2 * num_points, 3]，前一半是正点击，后一半是负点击，无效点坐标为-1
+    row_array, col_array : np.ndarray
+        特征图的行列坐标
+    radius : float
+        点击半径，use_disks为False时是距离归一化系数
+    use_disks : bool
+        True画半径为radius的圆盘，False画tanh(2 * 距离 / radius)
+    out : np.ndarray
+        [2, rows, cols]的float32结果
+
+    Returns
+    -------
+    np.ndarray
+        out
+    """
+    num_points = points.shape[0] // 2
+    if use_disks:
+        out.fill(0)
+        # 圆盘外的像素都是0
+        window = radius
+    else:
+        out.fill(1)
+        # 距离超过5倍半径时tanh在float32下已经是1
+        window = 5 * radius
+    for group in range(2):
+        for point in points[group * num_points : (group + 1) * num_points]:
+            if max(point[0], point[1]) < 0:
+                continue
+            set_point_window(
+                out[group], point, row_array, col_array, radius, window, use_disks
+            )
+    return out
+
+
+def get_point_window(point, window, rows, cols):
+    rmin = max(0, int(np.floor(point[0] - window)))
+    rmax = min(rows, int(np.ceil(point[0] + window)) + 1)
+    cmin = max(0, int(np.floor(point[1] - window)))
+    cmax = min(cols, int(np.ceil(point[1] + window)) + 1)
+    return rmin, rmax, cmin, cmax
+
 
-    def forward(self, x):
-        scale = paddle.abs(self.scale * self.lr_mult)
-        return x * scale
+def set_point_window(
+    dist_map, point, row_array, col_array, radius, window, use_disks, clip=None
+):
+    rows, cols = len(row_array), len(col_array)
+    rmin, rmax, cmin, cmax = get_point_window(point, window, rows, cols)
+    if clip is not None:
+        rmin, rmax = max(rmin, clip[0]), min(rmax, clip[1])
+        cmin, cmax = max(cmin, clip[2]), min(cmax, clip[3])
+    if rmin >= rmax or cmin >= cmax:
+        return
+    patch = dist_map[rmin:rmax, cmin:cmax]
+    if use_disks:
+        dist = (row_array[rmin:rmax, np.newaxis] - point[0]) ** 2 + (
+            col_array[np.newaxis, cmin:cmax] - point[1]
+        ) ** 2
+        np.maximum(patch, dist <= radius ** 2, out=patch)
+    else:
+        dist = ((row_array[rmin:rmax, np.newaxis] - point[0]) / radius) ** 2 + (
+            (col_array[np.newaxis, cmin:cmax] - point[1]) / radius
+        ) ** 2
+        np.minimum(patch, np.tanh(np.sqrt(dist) * 2), out=patch)
+
+
+def get_group_points(points, group, spatial_scale=1.0):
+    """一组（正或负）有效点击的缩放后坐标"""
+    num_points = points.shape[0] // 2
+    group_points = points[group * num_points : (group + 1) * num_points, :2]
+    group_points = group_points.astype("float32") * spatial_scale
+    return [
+        (point[0], point[1])
+        for point in group_points
+        if max(point[0], point[1]) >= 0
+    ]
 
 
 class BatchImageNormalize:
     def __init__(self, mean, std):
-        self.mean = paddle.to_tensor(
-            np.array(mean)[np.newaxis, :, np.newaxis, np.newaxis]
-        ).astype("float32")
-        self.std = paddle.to_tensor(
-            np.array(std)[np.newaxis, :, np.newaxis, np.newaxis]
-        ).astype("float32")
-
-    def __call__(self, tensor):
+        self.mean_np = np.array(mean, dtype="float32").reshape([1, -1, 1, 1])
+        self.std_np = np.array(std, dtype="float32").reshape([1, -1, 1, 1])
+        # paddle张量在第一次用paddle输入时才创建
+        self.mean = None
+        self.std = None
+
+    def __call__(self, tensor, out=None):
+        if isinstance(tensor, np.ndarray):
+            # numpy输入可以直接写到out里，不产生中间结果
+            out = np.subtract(tensor, self.mean_np, out=out, dtype="float32")
+            return np.divide(out, self.std_np, out=out)
+        if self.mean is None:
+            self.mean = ops.to_tensor(self.mean_np)
+            self.std = ops.to_tensor(self.std_np)
         tensor = (tensor - self.mean) / self.std
         return tensor
@@ -18,3 +18,4 @@ from .flip import AddHorizontalFlip
 from .zoom_in import ZoomIn
 from .limit_longest_side import LimitLongestSide
 from .crops import Crops
+from .bucket import ShapeBucket
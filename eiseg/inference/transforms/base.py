@@ -1,4 +1,4 @@
-import paddle.nn.functional as F
+from . import ops
 
 
 class BaseTransform(object):
@@ -26,7 +26,7 @@ class SigmoidForPred(BaseTransform):
         return image_nd, clicks_lists
 
     def inv_transform(self, prob_map):
-        return F.sigmoid(prob_map)
+        return ops.sigmoid(prob_map)
 
     def reset(self):
         pass
@@ -0,0 +1,110 @@
+# Copyright (c) 2021 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from .base import BaseTransform
+from . import ops
+
+
+class ShapeBucket(BaseTransform):
+    """把输入在右下方补边到少数几种固定大小，推理结果再裁剪回原大小
+
+    ZoomIn和LimitLongestSide的输出大小随ROI变化，MKLDNN每遇到新的输入大小都要重新创建
+    算子，补边到固定大小后可以复用。
+
+    Parameters
+    ----------
+    sizes : list
+        可选的输入大小[(h, w), ...]，选能放下输入的面积最小的一个
+    stride : int
+        sizes中没有能放下输入的大小时，高和宽向上取整到stride的倍数
+    """
+
+    def __init__(self, sizes=None, stride=32):
+        super().__init__()
+        self.sizes = sorted(
+            [tuple(s) for s in sizes or []], key=lambda s: (s[0] * s[1], s)
+        )
+        self.stride = stride
+        self._input_shape = None
+        self.reset_stats()
+
+    def get_bucket(self, height, width):
+        for bucket in self.sizes:
+            if bucket[0] >= height and bucket[1] >= width:
+                return bucket
+        return (
+            -(-height // self.stride) * self.stride,
+            -(-width // self.stride) * self.stride,
+        )
+
+    def transform(self, image_nd, clicks_lists):
+        self.image_changed = False
+        height, width = image_nd.shape[2:]
+        bucket = self.get_bucket(height, width)
+        self._input_shape = (height, width)
+        self._record(height, width, bucket)
+        if bucket == (height, width):
+            return image_nd, clicks_lists
+        # 只在右下方补边，点击坐标不变
+        image_nd = ops.pad(image_nd, bucket[0] - height, bucket[1] - width)
+        return image_nd, clicks_lists
+
+    def inv_transform(self, prob_map):
+        if self._input_shape is None:
+            return prob_map
+        height, width = self._input_shape
+        if tuple(prob_map.shape[2:]) == (height, width):
+            return prob_map
+        return prob_map[:, :, :height, :width]
+
+    def get_state(self):
+        return self._input_shape
+
+    def set_state(self, state):
+        self._input_shape = state
+
+    def reset(self):
+        self._input_shape = None
+
+    def _record(self, height, width, bucket):
+        stats = self.stats
+        stats["calls"] += 1
+        stats["raw_hits"] += (height, width) in self._seen_raw
+        stats["bucket_hits"] += bucket in self._seen_buckets
+        stats["input_pixels"] += height * width
+        stats["padded_pixels"] += bucket[0] * bucket[1]
+        self._seen_raw.add((height, width))
+        self._seen_buckets.add(bucket)
+
+    def reset_stats(self):
+        self.stats = {
+            "calls": 0,
+            "raw_hits": 0,
+            "bucket_hits": 0,
+            "input_pixels": 0,
+            "padded_pixels": 0,
+        }
+        self._seen_raw = set()
+        self._seen_buckets = set()
+
+    def get_stats(self):
+        """输入大小的缓存命中率：不补边时和补边后与之前某次输入大小相同的比例"""
+        stats = dict(self.stats)
+        calls = max(1, stats["calls"])
+        stats["raw_hit_rate"] = stats["raw_hits"] / calls
+        stats["bucket_hit_rate"] = stats["bucket_hits"] / calls
+        stats["num_raw_shapes"] = len(self._seen_raw)
+        stats["num_buckets"] = len(self._seen_buckets)
+        stats["pad_ratio"] = stats["padded_pixels"] / max(1, stats["input_pixels"])
+        return stats
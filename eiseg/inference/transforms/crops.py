@@ -19,86 +19,183 @@ MIT License [see LICENSE for details]
 
 
 import math
+from collections import OrderedDict
 
-import paddle
 import numpy as np
 
-from inference.clicker import Click
+from inference.clicker import as_clicks
 from .base import BaseTransform
+from . import ops
 
 
 class Crops(BaseTransform):
-    def __init__(self, crop_size=(320, 480), min_overlap=0.2):
+    """把大图切成有重叠的小块一起推理，再把各块的结果加权平均拼回原图
+
+    每种图像大小的切块位置和融合权重只计算一次。
+
+    Parameters
+    ----------
+    crop_size : tuple
+        切块大小(h, w)
+    min_overlap : float
+        相邻切块最少重叠的比例
+    feather : bool
+        为True时切块的权重从中心向边缘线性减小，减弱拼接缝，否则重叠区域直接平均
+    max_grids : int
+        最多缓存多少种图像大小的切块位置和权重
+    """
+
+    def __init__(
+        self, crop_size=(320, 480), min_overlap=0.2, feather=False, max_grids=4
+    ):
         super().__init__()
         self.crop_height, self.crop_width = crop_size
         self.min_overlap = min_overlap
-
-        self.x_offsets = None
-        self.y_offsets = None
-        self._counts = None
+        self.feather = feather
+        self.max_grids = max_grids
+        self._grids = OrderedDict()
+        self._grid = None
+
+    @property
+    def x_offsets(self):
+        return None if self._grid is None else self._grid.x_offsets
+
+    @property
+    def y_offsets(self):
+        return None if self._grid is None else self._grid.y_offsets
+
+    def get_grid(self, image_height, image_width):
+        key = (image_height, image_width)
+        grid = self._grids.pop(key, None)
+        if grid is None:
+            grid = CropGrid(
+                image_height,
+                image_width,
+                (self.crop_height, self.crop_width),
+                self.min_overlap,
+                self.feather,
+            )
+        self._grids[key] = grid
+        while len(self._grids) > self.max_grids:
+            self._grids.popitem(last=False)
+        return grid
 
     def transform(self, image_nd, clicks_lists):
         assert image_nd.shape[0] == 1 and len(clicks_lists) == 1
         image_height, image_width = image_nd.shape[2:4]
-        self._counts = None
+        self._grid = None
 
         if image_height < self.crop_height or image_width < self.crop_width:
             return image_nd, clicks_lists
 
-        self.x_offsets = get_offsets(image_width, self.crop_width, self.min_overlap)
-        self.y_offsets = get_offsets(image_height, self.crop_height, self.min_overlap)
-        self._counts = np.zeros((image_height, image_width))
-
-        image_crops = []
-        for dy in self.y_offsets:
-            for dx in self.x_offsets:
-                self._counts[dy : dy + self.crop_height, dx : dx + self.crop_width] += 1
-                image_crop = image_nd[
-                    :, :, dy : dy + self.crop_height, dx : dx + self.crop_width
-                ]
-                image_crops.append(image_crop)
-        image_crops = paddle.concat(image_crops, axis=0)
-        self._counts = paddle.to_tensor(self._counts, dtype="float32")
-
-        clicks_list = clicks_lists[0]
-        clicks_lists = []
-        for dy in self.y_offsets:
-            for dx in self.x_offsets:
-                crop_clicks = [
-                    x.copy(coords=(x.coords[0] - dy, x.coords[1] - dx))
-                    for x in clicks_list
-                ]
-                clicks_lists.append(crop_clicks)
+        self._grid = self.get_grid(image_height, image_width)
+        image_crops = self._grid.extract(image_nd)
+
+        clicks_list = as_clicks(clicks_lists[0])
+        ys, xs = clicks_list.data["y"], clicks_list.data["x"]
+        clicks_lists = [
+            clicks_list.with_coords(ys - dy, xs - dx)
+            for dy in self._grid.y_offsets
+            for dx in self._grid.x_offsets
+        ]
 
         return image_crops, clicks_lists
 
     def inv_transform(self, prob_map):
-        if self._counts is None:
+        if self._grid is None:
             return prob_map
 
-        new_prob_map = paddle.zeros((1, 1, *self._counts.shape), dtype=prob_map.dtype)
-
-        crop_indx = 0
-        for dy in self.y_offsets:
-            for dx in self.x_offsets:
-                new_prob_map[
-                    0, 0, dy : dy + self.crop_height, dx : dx + self.crop_width
-                ] += prob_map[crop_indx, 0]
-                crop_indx += 1
-        new_prob_map = paddle.divide(new_prob_map, self._counts)
-
-        return new_prob_map
+        if ops.is_numpy(prob_map):
+            return self._grid.blend(prob_map)
+        return ops.to_tensor(self._grid.blend(prob_map.numpy()))
 
     def get_state(self):
-        return self.x_offsets, self.y_offsets, self._counts
+        return self._grid
 
     def set_state(self, state):
-        self.x_offsets, self.y_offsets, self._counts = state
+        self._grid = state
 
     def reset(self):
-        self.x_offsets = None
-        self.y_offsets = None
-        self._counts = None
+        self._grid = None
+
+
+class CropGrid(object):
+    """一种图像大小的切块位置和融合权重
+
+    Parameters
+    ----------
+    height, width : int
+        图像大小
+    crop_size : tuple
+        切块大小(h, w)
+    min_overlap : float
+        相邻切块最少重叠的比例
+    feather : bool
+        切块权重是否从中心向边缘线性减小
+    """
+
+    def __init__(self, height, width, crop_size, min_overlap=0.2, feather=False):
+        self.height, self.width = height, width
+        self.crop_height, self.crop_width = crop_size
+        self.y_offsets = get_offsets(height, self.crop_height, min_overlap)
+        self.x_offsets = get_offsets(width, self.crop_width, min_overlap)
+        self.window = None
+        if feather:
+            self.window = np.outer(
+                get_feather_weights(self.crop_height, min_overlap),
+                get_feather_weights(self.crop_width, min_overlap),
+            ).astype("float32")
+        window = 1 if self.window is None else self.window
+        weights = np.broadcast_to(
+            np.float32(window), (len(self), 1, self.crop_height, self.crop_width)
+        )
+        self.inv_weights = np.reciprocal(self._accumulate(weights))
+
+    def __len__(self):
+        return len(self.y_offsets) * len(self.x_offsets)
+
+    def extract(self, image_nd):
+        """按行优先的顺序取出所有切块，[num_crops, C, crop_h, crop_w]"""
+        if not ops.is_numpy(image_nd):
+            return ops.to_tensor(self.extract(image_nd.numpy()))
+        windows = np.lib.stride_tricks.sliding_window_view(
+            image_nd[0], (self.crop_height, self.crop_width), axis=(1, 2)
+        )
+        # 一次取出所有切块，[C, ny, nx, crop_h, crop_w]
+        ys, xs = np.ix_(self.y_offsets, self.x_offsets)
+        crops = windows[:, ys, xs]
+        crops = crops.transpose((1, 2, 0, 3, 4))
+        return crops.reshape(len(self), -1, self.crop_height, self.crop_width)
+
+    def blend(self, crops):
+        """把[num_crops, C, crop_h, crop_w]的切块结果加权平均成[1, C, H, W]"""
+        if self.window is not None:
+            crops = crops * self.window
+        result = self._accumulate(crops)
+        result *= self.inv_weights
+        return result[None]
+
+    def _accumulate(self, crops):
+        """先把同一行的切块沿宽度方向加起来，再把各行沿高度方向加起来"""
+        num_rows, num_cols = len(self.y_offsets), len(self.x_offsets)
+        channels = crops.shape[1]
+        crops = crops.reshape(num_rows, num_cols, channels, *crops.shape[2:])
+        rows = np.zeros(
+            (num_rows, channels, self.crop_height, self.width), dtype="float32"
+        )
+        for col, dx in enumerate(self.x_offsets):
+            rows[..., dx : dx + self.crop_width] += crops[:, col]
+        result = np.zeros((channels, self.height, self.width), dtype="float32")
+        for row, dy in enumerate(self.y_offsets):
+            result[:, dy : dy + self.crop_height] += rows[row]
+        return result
+
+
+def get_feather_weights(crop_size, min_overlap_ratio=0.2):
+    """切块一个方向上的权重，中间为1，两端各min_overlap_ratio长度内线性减小"""
+    ramp = max(1, int(crop_size * min_overlap_ratio))
+    positions = np.arange(crop_size) + 0.5
+    return np.minimum(1, np.minimum(positions, crop_size - positions) / ramp)
 
 
 def get_offsets(length, crop_size, min_overlap_ratio=0.2):
@@ -17,25 +17,24 @@ Ths copyright of saic-vul/ritm_interactive_segmentation is as follows:
 MIT License [see LICENSE for details]
 """
 
-import paddle
-
-from inference.clicker import Click
+from inference.clicker import as_clicks
 from .base import BaseTransform
+from . import ops
 
 
 class AddHorizontalFlip(BaseTransform):
     def transform(self, image_nd, clicks_lists):
         assert len(image_nd.shape) == 4
-        image_nd = paddle.concat([image_nd, paddle.flip(image_nd, axis=[3])], axis=0)
+        image_nd = ops.concat([image_nd, ops.flip(image_nd)], axis=0)
 
         image_width = image_nd.shape[3]
         clicks_lists_flipped = []
         for clicks_list in clicks_lists:
-            clicks_list_flipped = [
-                click.copy(coords=(click.coords[0], image_width - click.coords[1] - 1))
-                for click in clicks_list
-            ]
-            clicks_lists_flipped.append(clicks_list_flipped)
+            clicks_list = as_clicks(clicks_list)
+            ys, xs = clicks_list.data["y"], clicks_list.data["x"]
+            clicks_lists_flipped.append(
+                clicks_list.with_coords(ys, image_width - xs - 1)
+            )
         clicks_lists = clicks_lists + clicks_lists_flipped
 
         return image_nd, clicks_lists
@@ -45,7 +44,7 @@ class AddHorizontalFlip(BaseTransform):
         num_maps = prob_map.shape[0] // 2
         prob_map, prob_map_flipped = prob_map[:num_maps], prob_map[num_maps:]
 
-        return 0.5 * (prob_map + paddle.flip(prob_map_flipped, axis=[3]))
+        return 0.5 * (prob_map + ops.flip(prob_map_flipped))
 
     def get_state(self):
         return None
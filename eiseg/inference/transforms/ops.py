@@ -0,0 +1,120 @@
+# Copyright (c) 2021 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+变换中用到的张量操作，输入是numpy数组时用numpy/OpenCV实现，否则用paddle实现。
+numpy实现都是NCHW的float32数组，和paddle版本的结果在插值精度范围内一致。
+paddle只在paddle分支中导入，numpy路径不会加载paddle动态图。
+"""
+
+import cv2
+import numpy as np
+
+
+def is_numpy(x):
+    return isinstance(x, np.ndarray)
+
+
+def interpolate(x, size):
+    """双线性插值到size=(h, w)，对应F.interpolate(align_corners=True)"""
+    if not is_numpy(x):
+        import paddle.nn.functional as F
+
+        return F.interpolate(x, mode="bilinear", align_corners=True, size=size)
+
+    height, width = int(size[0]), int(size[1])
+    in_height, in_width = x.shape[2:]
+    if (in_height, in_width) == (height, width):
+        return x
+
+    # align_corners=True: 输出的首尾像素对齐输入的首尾像素
+    scale_y = (in_height - 1) / (height - 1) if height > 1 else 0
+    scale_x = (in_width - 1) / (width - 1) if width > 1 else 0
+    matrix = np.array([[scale_x, 0, 0], [0, scale_y, 0]], dtype="float64")
+    flags = cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP
+
+    def warp(img):
+        return cv2.warpAffine(
+            img, matrix, (width, height), flags=flags, borderMode=cv2.BORDER_REPLICATE
+        )
+
+    num, channels = x.shape[:2]
+    result = np.empty((num, channels, height, width), dtype=x.dtype)
+    for n in range(num):
+        if 1 < channels <= 4:
+            # OpenCV一次最多处理4通道，转成HWC一起插值
+            img = np.ascontiguousarray(x[n].transpose((1, 2, 0)))
+            result[n] = warp(img).transpose((2, 0, 1))
+        else:
+            for c in range(channels):
+                result[n, c] = warp(np.ascontiguousarray(x[n, c]))
+    return result
+
+
+def sigmoid(x):
+    if not is_numpy(x):
+        import paddle.nn.functional as F
+
+        return F.sigmoid(x)
+    result = np.negative(x, dtype="float32")
+    np.exp(result, out=result)
+    result += 1
+    return np.reciprocal(result, out=result)
+
+
+def flip(x):
+    """沿宽度方向翻转"""
+    if not is_numpy(x):
+        import paddle
+
+        return paddle.flip(x, axis=[3])
+    return x[:, :, :, ::-1]
+
+
+def concat(xs, axis=0):
+    if is_numpy(xs[0]):
+        return np.concatenate(xs, axis=axis)
+    import paddle
+
+    return paddle.concat(xs, axis=axis)
+
+
+def pad(x, bottom, right):
+    """在下方和右方复制边缘补边"""
+    if not is_numpy(x):
+        import paddle.nn.functional as F
+
+        return F.pad(x, [0, right, 0, bottom], mode="replicate")
+    return np.pad(x, ((0, 0), (0, 0), (0, bottom), (0, right)), mode="edge")
+
+
+def zeros_like(x, shape=None):
+    shape = x.shape if shape is None else shape
+    if is_numpy(x):
+        return np.zeros(shape, dtype=x.dtype)
+    import paddle
+
+    return paddle.zeros(shape, dtype=x.dtype)
+
+
+def to_numpy(x):
+    if is_numpy(x):
+        return x
+    return x.numpy()
+
+
+def to_tensor(x, dtype=None):
+    """numpy数组转成paddle张量，只在paddle路径中使用"""
+    import paddle
+
+    return paddle.to_tensor(x, dtype=dtype)
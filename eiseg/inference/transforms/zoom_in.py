@@ -17,11 +17,11 @@ Ths copyright of saic-vul/ritm_interactive_segmentation is as follows:
 MIT License [see LICENSE for details]
 """
 
-import paddle
 import numpy as np
-from inference.clicker import Click
+from inference.clicker import as_clicks
 from util.misc import get_bbox_iou, get_bbox_from_mask, expand_bbox, clamp_bbox
 from .base import BaseTransform
+from . import ops
 
 
 class ZoomIn(BaseTransform):
@@ -51,7 +51,7 @@ class ZoomIn(BaseTransform):
         assert image_nd.shape[0] == 1 and len(clicks_lists) == 1
         self.image_changed = False
 
-        clicks_list = clicks_lists[0]
+        clicks_list = as_clicks(clicks_lists[0])
         if len(clicks_list) <= self.skip_clicks:
             return image_nd, clicks_lists
 
@@ -59,10 +59,11 @@ class ZoomIn(BaseTransform):
 
         current_object_roi = None
         if self._prev_probs is not None:
-            current_pred_mask = (self._prev_probs > self.prob_thresh)[0, 0]
-            if current_pred_mask.sum() > 0:
-                current_object_roi = get_object_roi(
-                    current_pred_mask,
+            mask_bbox = self._prev_probs.get_mask_bbox(self.prob_thresh)
+            if mask_bbox is not None:
+                current_object_roi = get_object_roi_from_bbox(
+                    mask_bbox,
+                    self._prev_probs.shape,
                     clicks_list,
                     self.expansion_ratio,
                     self.min_crop_size,
@@ -95,30 +96,35 @@ class ZoomIn(BaseTransform):
 
     def inv_transform(self, prob_map):
         if self._object_roi is None:
-            self._prev_probs = prob_map.numpy()
+            self._prev_probs = RoiProbs.from_full(ops.to_numpy(prob_map)[0, 0])
             return prob_map
 
         assert prob_map.shape[0] == 1
         rmin, rmax, cmin, cmax = self._object_roi
-        prob_map = paddle.nn.functional.interpolate(
-            prob_map,
-            size=(rmax - rmin + 1, cmax - cmin + 1),
-            mode="bilinear",
-            align_corners=True,
-        )
+        prob_map = ops.interpolate(prob_map, size=(rmax - rmin + 1, cmax - cmin + 1))
 
         if self._prev_probs is not None:
-            new_prob_map = paddle.zeros(
-                shape=self._prev_probs.shape, dtype=prob_map.dtype
-            )
+            shape = self._prev_probs.shape
+            new_prob_map = ops.zeros_like(prob_map, shape=(1, 1, *shape))
             new_prob_map[:, :, rmin : rmax + 1, cmin : cmax + 1] = prob_map
         else:
+            shape = tuple(prob_map.shape[2:])
             new_prob_map = prob_map
 
-        self._prev_probs = new_prob_map.numpy()
+        # 只保存ROI内的结果，ROI外都是0
+        self._prev_probs = RoiProbs(
+            shape, self._object_roi, ops.to_numpy(prob_map)[0, 0]
+        )
 
         return new_prob_map
 
+    @property
+    def prev_probs(self):
+        """上一次的整张概率图，[1, 1, H, W]"""
+        if self._prev_probs is None:
+            return None
+        return self._prev_probs.to_full()[None, None]
+
     def check_possible_recalculation(self):
         if (
             self._prev_probs is None
@@ -127,10 +133,14 @@ class ZoomIn(BaseTransform):
         ):
             return False
 
-        pred_mask = (self._prev_probs > self.prob_thresh)[0, 0]
-        if pred_mask.sum() > 0:
-            possible_object_roi = get_object_roi(
-                pred_mask, [], self.expansion_ratio, self.min_crop_size
+        mask_bbox = self._prev_probs.get_mask_bbox(self.prob_thresh)
+        if mask_bbox is not None:
+            possible_object_roi = get_object_roi_from_bbox(
+                mask_bbox,
+                self._prev_probs.shape,
+                [],
+                self.expansion_ratio,
+                self.min_crop_size,
             )
             image_roi = (
                 0,
@@ -143,12 +153,15 @@ class ZoomIn(BaseTransform):
         return False
 
     def get_state(self):
-        roi_image = self._roi_image if self._roi_image is not None else None
+        # 概率图存成元组，撤销历史可以只保存数组变化的部分；
+        # ROI图像在下一次transform时用图像和ROI重新得到，不保存
+        prev_probs = None
+        if self._prev_probs is not None:
+            prev_probs = self._prev_probs.get_state()
         return (
             self._input_image_shape,
             self._object_roi,
-            self._prev_probs,
-            roi_image,
+            prev_probs,
             self.image_changed,
         )
 
@@ -156,10 +169,13 @@ class ZoomIn(BaseTransform):
         (
             self._input_image_shape,
             self._object_roi,
-            self._prev_probs,
-            self._roi_image,
+            prev_probs,
             self.image_changed,
         ) = state
+        self._roi_image = None
+        self._prev_probs = None
+        if prev_probs is not None:
+            self._prev_probs = RoiProbs(*prev_probs)
 
     def reset(self):
         self._input_image_shape = None
@@ -169,30 +185,97 @@ class ZoomIn(BaseTransform):
         self.image_changed = False
 
     def _transform_clicks(self, clicks_list):
+        clicks_list = as_clicks(clicks_list)
         if self._object_roi is None:
             return clicks_list
 
         rmin, rmax, cmin, cmax = self._object_roi
         crop_height, crop_width = self._roi_image.shape[2:]
 
-        transformed_clicks = []
-        for click in clicks_list:
-            new_r = crop_height * (click.coords[0] - rmin) / (rmax - rmin + 1)
-            new_c = crop_width * (click.coords[1] - cmin) / (cmax - cmin + 1)
-            transformed_clicks.append(click.copy(coords=(new_r, new_c)))
-        return transformed_clicks
+        data = clicks_list.data
+        new_r = crop_height * (data["y"] - rmin) / (rmax - rmin + 1)
+        new_c = crop_width * (data["x"] - cmin) / (cmax - cmin + 1)
+        return clicks_list.with_coords(new_r, new_c)
+
+
+class RoiProbs(object):
+    """只保存ROI内的概率图，ROI外都是0
+
+    Parameters
+    ----------
+    shape : tuple
+        整张概率图的大小(h, w)
+    roi : tuple
+        ROI的(rmin, rmax, cmin, cmax)，包括rmax和cmax
+    probs : np.ndarray
+        ROI内的概率，[rmax - rmin + 1, cmax - cmin + 1]
+    """
+
+    def __init__(self, shape, roi, probs):
+        self.shape = tuple(shape)
+        self.roi = roi
+        self.probs = probs
+
+    @classmethod
+    def from_full(cls, probs):
+        height, width = probs.shape
+        return cls((height, width), (0, height - 1, 0, width - 1), probs)
+
+    def get_mask_bbox(self, thresh):
+        """概率大于thresh的区域在整张图上的外接矩形，没有时返回None"""
+        mask = self.probs > thresh
+        if not mask.any():
+            return None
+        rmin, rmax, cmin, cmax = get_bbox_from_mask(mask)
+        return (
+            rmin + self.roi[0],
+            rmax + self.roi[0],
+            cmin + self.roi[2],
+            cmax + self.roi[2],
+        )
 
+    def to_full(self):
+        rmin, rmax, cmin, cmax = self.roi
+        if (rmin, cmin) == (0, 0) and self.probs.shape == self.shape:
+            return self.probs
+        probs = np.zeros(self.shape, dtype=self.probs.dtype)
+        probs[rmin : rmax + 1, cmin : cmax + 1] = self.probs
+        return probs
 
-def get_object_roi(pred_mask, clicks_list, expansion_ratio, min_crop_size):
-    pred_mask = pred_mask.copy()
+    def get_state(self):
+        return self.shape, self.roi, self.probs
 
-    for click in clicks_list:
-        if click.is_positive:
-            pred_mask[int(click.coords[0]), int(click.coords[1])] = 1
 
-    bbox = get_bbox_from_mask(pred_mask)
+def get_object_roi(pred_mask, clicks_list, expansion_ratio, min_crop_size):
+    bbox = get_bbox_from_mask(pred_mask) if pred_mask.any() else None
+    return get_object_roi_from_bbox(
+        bbox, pred_mask.shape, clicks_list, expansion_ratio, min_crop_size
+    )
+
+
+def get_object_roi_from_bbox(
+    mask_bbox, shape, clicks_list, expansion_ratio, min_crop_size
+):
+    """包含掩膜外接矩形和所有正点的区域，扩大后限制在图像内
+
+    Parameters
+    ----------
+    mask_bbox : tuple
+        掩膜的外接矩形(rmin, rmax, cmin, cmax)，掩膜为空时为None
+    shape : tuple
+        图像大小(h, w)
+    """
+    data = as_clicks(clicks_list).data
+    positive = data[data["is_positive"]]
+    ys = positive["y"].astype(int)
+    xs = positive["x"].astype(int)
+    if mask_bbox is not None:
+        ys = np.append(ys, mask_bbox[:2])
+        xs = np.append(xs, mask_bbox[2:])
+
+    bbox = ys.min(), ys.max(), xs.min(), xs.max()
     bbox = expand_bbox(bbox, expansion_ratio, min_crop_size)
-    h, w = pred_mask.shape[0], pred_mask.shape[1]
+    h, w = shape[0], shape[1]
     bbox = clamp_bbox(bbox, 0, h - 1, 0, w - 1)
 
     return bbox
@@ -211,24 +294,26 @@ def get_roi_image_nd(image_nd, object_roi, target_size):
         new_height = int(round(height * scale))
         new_width = int(round(width * scale))
 
-    with paddle.no_grad():
-        roi_image_nd = image_nd[:, :, rmin : rmax + 1, cmin : cmax + 1]
-        roi_image_nd = paddle.nn.functional.interpolate(
-            roi_image_nd,
-            size=(new_height, new_width),
-            mode="bilinear",
-            align_corners=True,
-        )
+    roi_image_nd = image_nd[:, :, rmin : rmax + 1, cmin : cmax + 1]
+    if ops.is_numpy(roi_image_nd):
+        roi_image_nd = ops.interpolate(roi_image_nd, size=(new_height, new_width))
+    else:
+        import paddle
+
+        with paddle.no_grad():
+            roi_image_nd = ops.interpolate(roi_image_nd, size=(new_height, new_width))
 
     return roi_image_nd
 
 
 def check_object_roi(object_roi, clicks_list):
-    for click in clicks_list:
-        if click.is_positive:
-            if click.coords[0] < object_roi[0] or click.coords[0] >= object_roi[1]:
-                return False
-            if click.coords[1] < object_roi[2] or click.coords[1] >= object_roi[3]:
-                return False
-
-    return True
+    data = as_clicks(clicks_list).data
+    positive = data[data["is_positive"]]
+    ys, xs = positive["y"], positive["x"]
+    inside = (
+        (ys >= object_roi[0])
+        & (ys < object_roi[1])
+        & (xs >= object_roi[2])
+        & (xs < object_roi[3])
+    )
+    return bool(inside.all())
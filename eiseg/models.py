@@ -13,32 +13,135 @@
 # limitations under the License.
 
 
+import os
 import os.path as osp
-from abc import abstractmethod
+import copy
+import queue
+import hashlib
+import platform
+from functools import lru_cache
+from abc import ABC, abstractmethod
 
 
 import paddle.inference as paddle_infer
 
+from eiseg import logger, settings
+from util.config import parse_configs, save_configs
+
 
 here = osp.dirname(osp.abspath(__file__))
 
+# 自动调优结果，按机器和模型保存在本地界面设置的旁边，不提交到仓库
+TUNED_CONFIG_PATH = osp.join(osp.dirname(settings.fileName()), "autotune.yaml")
+
+DEFAULT_CPU_CONFIG = {
+    "num_threads": 10,
+    "use_mkldnn": True,
+    "mkldnn_cache_capacity": 0,  # 0表示不限制
+    "ir_optim": True,
+}
+
+# fp32: 原模型；bf16: 原模型，卷积等算子用MKLDNN bfloat16计算；
+# int8: eiseg-quantize离线量化后的模型，用MKLDNN int8计算
+PRECISIONS = ("fp32", "bf16", "int8")
+BF16_OPS = {"conv2d", "depthwise_conv2d", "conv2d_transpose", "matmul_v2", "fc"}
+
+# paddle: Paddle Inference加载.pdmodel/.pdiparams；
+# onnxruntime: onnxruntime加载同一目录下paddle2onnx导出的 <模型名>.onnx
+BACKENDS = ("paddle", "onnxruntime")
+
+
+class InferenceBackend(ABC):
+    """推理后端接口，推理器只通过这几个方法使用模型
+
+    输入输出都是numpy数组，输入顺序和get_input_names一致，依次是图像和点击特征。
+    没有实现全部方法的后端在创建时就会报错。
+    """
+
+    @abstractmethod
+    def get_input_names(self):
+        pass
+
+    @abstractmethod
+    def get_output_names(self):
+        pass
+
+    @abstractmethod
+    def run(self, inputs):
+        """推理一次，返回所有输出的列表，顺序和get_output_names一致"""
 
-class EISegModel:
     @abstractmethod
-    def __init__(self, model_path, param_path, use_gpu=False):
+    def clone(self):
+        """复制一个共享权重的模型，推理器可以和原模型在不同线程中同时推理"""
+
+
+class EISegModel(InferenceBackend):
+    def __init__(
+        self,
+        model_path,
+        param_path,
+        use_gpu=False,
+        num_threads=None,
+        cpu_config=None,
+        use_tuned=True,
+        precision="fp32",
+    ):
+        """加载模型
+
+        CPU推理配置优先级：cpu_config > 自动调优保存的配置（use_tuned） > 默认配置，
+        num_threads不为None时覆盖线程数。
+        precision为bf16或int8时只在CPU上生效，并且会开启MKLDNN；
+        int8加载eiseg-quantize保存在同一目录下的 <模型名>.int8.pdmodel/.pdiparams。
+        """
+        if precision not in PRECISIONS:
+            raise ValueError(f"不支持的推理精度{precision}，可选{PRECISIONS}")
+        if use_gpu:
+            precision = "fp32"
+        if precision == "bf16" and not supports_bfloat16():
+            logger.warning("CPU不支持bfloat16，使用fp32推理")
+            precision = "fp32"
+        self.precision = precision
+        tuned_config = None
+        if not use_gpu and cpu_config is None and use_tuned:
+            # 调优结果按原模型和精度保存，int8也用原模型查找
+            tuned_config = load_tuned_config(
+                model_path, param_path, precision=precision
+            )
+        if precision == "int8":
+            model_path, param_path = get_quant_paths(model_path, param_path)
+            if not osp.exists(model_path) or not osp.exists(param_path):
+                raise Exception(f"未找到量化模型{model_path}，请先用eiseg-quantize量化模型")
         model_path, param_path = self.check_param(model_path, param_path)
         try:
             config = paddle_infer.Config(model_path, param_path)
         except:
             ValueError(" 模型和参数不匹配，请检查模型和参数是否加载错误")
         if not use_gpu:
-            config.enable_mkldnn()
-            # TODO: fluid要废弃了，研究判断方式
-            # if paddle.fluid.core.supports_bfloat16():
-            #     config.enable_mkldnn_bfloat16()
-            config.switch_ir_optim(True)
-            config.set_cpu_math_library_num_threads(10)
+            self.cpu_config = dict(DEFAULT_CPU_CONFIG)
+            if tuned_config is not None:
+                logger.info(f"Use tuned cpu config {tuned_config}")
+                cpu_config = tuned_config
+            if cpu_config is not None:
+                self.cpu_config.update(cpu_config)
+            if num_threads is not None:
+                self.cpu_config["num_threads"] = num_threads
+            if precision != "fp32":
+                self.cpu_config["use_mkldnn"] = True
+            if self.cpu_config["use_mkldnn"]:
+                config.enable_mkldnn()
+                if self.cpu_config["mkldnn_cache_capacity"] > 0:
+                    config.set_mkldnn_cache_capacity(
+                        self.cpu_config["mkldnn_cache_capacity"]
+                    )
+            if precision == "bf16":
+                config.enable_mkldnn_bfloat16()
+                config.set_bfloat16_op(BF16_OPS)
+            elif precision == "int8":
+                config.enable_mkldnn_int8()
+            config.switch_ir_optim(self.cpu_config["ir_optim"])
+            config.set_cpu_math_library_num_threads(self.cpu_config["num_threads"])
         else:
+            self.cpu_config = None
             config.enable_use_gpu(500, 0)
             config.delete_pass("conv_elementwise_add_act_fuse_pass")
             config.delete_pass("conv_elementwise_add2_act_fuse_pass")
@@ -56,6 +159,35 @@ class EISegModel:
             #         use_calib_mode=False,
             #     )
         self.model = paddle_infer.create_predictor(config)
+        self._get_handles()
+
+    def _get_handles(self):
+        # 句柄只查找一次
+        self.input_handles = [
+            self.model.get_input_handle(n) for n in self.model.get_input_names()
+        ]
+        self.output_handles = [
+            self.model.get_output_handle(n) for n in self.model.get_output_names()
+        ]
+
+    def get_input_names(self):
+        return self.model.get_input_names()
+
+    def get_output_names(self):
+        return self.model.get_output_names()
+
+    def run(self, inputs):
+        assert len(inputs) == len(self.input_handles)
+        for handle, data in zip(self.input_handles, inputs):
+            handle.copy_from_cpu(data)
+        self.model.run()
+        return [handle.copy_to_cpu() for handle in self.output_handles]
+
+    def clone(self):
+        model = copy.copy(self)
+        model.model = self.model.clone()
+        model._get_handles()
+        return model
 
     def check_param(self, model_path, param_path):
         if model_path is None or not osp.exists(model_path):
@@ -63,3 +195,223 @@ class EISegModel:
         if param_path is None or not osp.exists(param_path):
             raise Exception(f"权重路径{param_path}不存在。请指定正确的权重路径")
         return model_path, param_path
+
+
+class OnnxModel(InferenceBackend):
+    """用onnxruntime推理paddle2onnx导出的模型
+
+    Parameters
+    ----------
+    model_path : str
+        .onnx模型路径
+    use_gpu : bool
+        是否使用CUDAExecutionProvider，不可用时退回CPU
+    num_threads : int
+        CPU推理线程数，None时使用onnxruntime的默认值
+    """
+
+    # 按名字把输入排成图像、点击特征的顺序，导出的模型中输入顺序可能不同
+    INPUT_ORDER = ("image", "points")
+
+    def __init__(self, model_path, use_gpu=False, num_threads=None):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError("使用onnxruntime推理需要先安装：pip install onnxruntime")
+        if model_path is None or not osp.exists(model_path):
+            raise Exception(f"ONNX模型{model_path}不存在，请先用paddle2onnx导出模型")
+        options = ort.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        providers = ["CPUExecutionProvider"]
+        if use_gpu and "CUDAExecutionProvider" in ort.get_available_providers():
+            providers.insert(0, "CUDAExecutionProvider")
+        self.session = ort.InferenceSession(
+            model_path, sess_options=options, providers=providers
+        )
+        self.input_names = [x.name for x in self.session.get_inputs()]
+        if sorted(self.input_names) == sorted(self.INPUT_ORDER):
+            self.input_names = list(self.INPUT_ORDER)
+        self.output_names = [x.name for x in self.session.get_outputs()]
+
+    def get_input_names(self):
+        return list(self.input_names)
+
+    def get_output_names(self):
+        return list(self.output_names)
+
+    def run(self, inputs):
+        assert len(inputs) == len(self.input_names)
+        return self.session.run(self.output_names, dict(zip(self.input_names, inputs)))
+
+    def clone(self):
+        # onnxruntime的session可以在多个线程中同时run，直接共享
+        return copy.copy(self)
+
+
+def get_onnx_path(model_path):
+    """static.pdmodel -> static.onnx"""
+    return osp.splitext(model_path)[0] + ".onnx"
+
+
+def create_model(
+    model_path,
+    param_path,
+    backend="paddle",
+    use_gpu=False,
+    num_threads=None,
+    precision="fp32",
+):
+    """按推理后端加载模型，backend可选BACKENDS"""
+    if backend == "paddle":
+        return EISegModel(
+            model_path, param_path, use_gpu, num_threads, precision=precision
+        )
+    if backend == "onnxruntime":
+        if precision != "fp32":
+            logger.warning(f"onnxruntime后端不支持{precision}，使用fp32推理")
+        return OnnxModel(get_onnx_path(model_path), use_gpu, num_threads)
+    raise ValueError(f"不支持的推理后端{backend}，可选{BACKENDS}")
+
+
+def supports_bfloat16():
+    """CPU是否支持MKLDNN bfloat16计算"""
+    try:
+        from paddle.base import core
+    except ImportError:
+        # paddle 2.x
+        try:
+            from paddle.fluid import core
+        except ImportError:
+            return False
+    return core.supports_bfloat16()
+
+
+def get_quant_paths(model_path, param_path, suffix="int8"):
+    """量化模型的路径：static.pdmodel -> static.int8.pdmodel"""
+    model_path = osp.splitext(model_path)[0] + f".{suffix}.pdmodel"
+    param_path = osp.splitext(param_path)[0] + f".{suffix}.pdiparams"
+    return model_path, param_path
+
+
+def get_machine_id():
+    """区分机器的标识，CPU型号和核数不同的机器调优结果不通用"""
+    return "|".join(
+        [
+            platform.node(),
+            platform.machine(),
+            platform.processor(),
+            str(os.cpu_count()),
+        ]
+    )
+
+
+@lru_cache(maxsize=16)
+def _file_md5(path, size, mtime):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def get_model_hash(model_path, param_path):
+    hashes = []
+    for path in (model_path, param_path):
+        stat = os.stat(path)
+        hashes.append(_file_md5(osp.abspath(path), stat.st_size, stat.st_mtime))
+    return hashlib.md5("".join(hashes).encode()).hexdigest()
+
+
+def get_tuned_key(model_path, param_path, precision="fp32"):
+    """调优结果的键，model_path和param_path是fp32模型，其它精度加上精度后缀"""
+    key = get_model_hash(model_path, param_path)
+    if precision != "fp32":
+        key = f"{key}-{precision}"
+    return key
+
+
+def load_tuned_config(
+    model_path, param_path, path=TUNED_CONFIG_PATH, precision="fp32"
+):
+    """读取这台机器上这个模型在这种精度下的自动调优结果，没有时返回None"""
+    if not osp.exists(model_path) or not osp.exists(param_path):
+        return None
+    tuned = parse_configs(path)
+    if not tuned:
+        return None
+    config = tuned.get(get_machine_id(), {}).get(
+        get_tuned_key(model_path, param_path, precision)
+    )
+    if config is None:
+        return None
+    return {k: config[k] for k in DEFAULT_CPU_CONFIG if k in config}
+
+
+def save_tuned_config(
+    model_path, param_path, config, path=TUNED_CONFIG_PATH, precision="fp32"
+):
+    tuned = parse_configs(path) or {}
+    machine = tuned.setdefault(get_machine_id(), {})
+    machine[get_tuned_key(model_path, param_path, precision)] = dict(config)
+    save_configs(path, tuned)
+
+
+class PredictorPool:
+    """共享权重的推理器池，给多个标注会话或批量标注线程同时使用
+
+    第一个模型正常加载，其余的用predictor.clone()复制，只多占用中间结果的内存。
+    每个推理器的数学库线程数默认是CPU核数除以推理器个数，同时推理时不会抢占CPU。
+
+    Parameters
+    ----------
+    model_path, param_path : str
+        模型和权重路径
+    size : int
+        推理器个数
+    use_gpu : bool
+        是否使用GPU
+    num_threads : int
+        每个推理器的CPU线程数，None时按size平分CPU核数
+    precision : str
+        推理精度，fp32、bf16或int8
+    backend : str
+        推理后端，paddle或onnxruntime
+    """
+
+    def __init__(
+        self,
+        model_path,
+        param_path,
+        size=1,
+        use_gpu=False,
+        num_threads=None,
+        precision="fp32",
+        backend="paddle",
+    ):
+        assert size >= 1, "推理器池至少需要一个推理器"
+        if num_threads is None:
+            num_threads = max(1, (os.cpu_count() or 1) // size)
+        self.num_threads = num_threads
+        base = create_model(
+            model_path, param_path, backend, use_gpu, num_threads, precision
+        )
+        self.models = [base] + [base.clone() for _ in range(size - 1)]
+        self._free = queue.LifoQueue()
+        for model in self.models:
+            self._free.put(model)
+
+    def __len__(self):
+        return len(self.models)
+
+    @property
+    def num_free(self):
+        return self._free.qsize()
+
+    def acquire(self, block=True, timeout=None):
+        """取出一个空闲的模型，没有空闲且不等待或等待超时时抛出queue.Empty"""
+        return self._free.get(block, timeout)
+
+    def release(self, model):
+        assert any(model is m for m in self.models), "只能归还从这个池中取出的模型"
+        self._free.put(model)
@@ -0,0 +1,294 @@
+# Copyright (c) 2021 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+离线量化EISeg模型，并对比量化前后的速度和精度。
+
+校准数据用真实的推理流程生成：在校准图像上按标签模拟点击（没有标签时随机点击），
+用fp32模型推理，记录每次送入网络的归一化图像和点击特征（上一次的结果和DistMaps
+生成的正负点击图）。量化后的模型保存为 <模型名>.int8.pdmodel/.pdiparams，
+EISegModel(precision="int8") 会加载它。
+
+有评估数据时，对比fp32、bf16和int8的推理耗时、NoC@85/90和每次点击后的平均IoU。
+"""
+
+import os.path as osp
+import json
+import argparse
+import contextlib
+
+import numpy as np
+
+from eiseg import logger
+from batch import PREDICTOR_PARAMS
+from models import EISegModel, PRECISIONS, get_quant_paths, supports_bfloat16
+from inference.clicker import Clicker, Click
+from inference.predictor import get_predictor
+from inference.predictor.buffers import NetIO
+from inference.evaluation import (
+    load_image,
+    list_images,
+    load_gt_mask,
+    get_gt_path,
+    evaluate_sample,
+    get_noc_metrics,
+)
+
+
+class CalibrationNetIO(NetIO):
+    """推理的同时保存每次的网络输入，作为量化的校准数据"""
+
+    def __init__(self, net, max_shapes=8):
+        super().__init__(net, max_shapes)
+        self.samples = []
+
+    def run(self, inputs, batch_size=None):
+        self.samples.append([x.copy() for x in inputs])
+        super().run(inputs, batch_size)
+
+
+def create_predictor(param_path, precision="fp32", num_threads=None):
+    model_path = param_path.replace(".pdiparams", ".pdmodel")
+    model = EISegModel(model_path, param_path, False, num_threads, precision=precision)
+    return get_predictor(model, **PREDICTOR_PARAMS)
+
+
+def collect_calibration_data(
+    param_path, image_dir, gt_dir=None, num_images=32, num_clicks=3, seed=0
+):
+    """用fp32模型在校准图像上模拟点击，返回网络输入名和每次推理的输入
+
+    有标签时每次点在预测错得最多的地方，没有标签时第一次点正点，之后随机点正负点。
+    """
+    predictor = create_predictor(param_path)
+    net_io = CalibrationNetIO(predictor.net)
+    predictor.net_io = net_io
+    rng = np.random.RandomState(seed)
+    for path in list_images(image_dir, num_images):
+        image = load_image(path)
+        if gt_dir is not None:
+            gt_mask = load_gt_mask(get_gt_path(path, gt_dir))
+            evaluate_sample(predictor, image, gt_mask, max_clicks=num_clicks)
+            continue
+        predictor.set_input_image(image)
+        clicker = Clicker()
+        for click_idx in range(num_clicks):
+            coords = (rng.randint(image.shape[0]), rng.randint(image.shape[1]))
+            is_positive = click_idx == 0 or rng.rand() < 0.5
+            clicker.add_click(Click(is_positive=is_positive, coords=coords))
+            predictor.get_prediction(clicker)
+    logger.info(f"Collected {len(net_io.samples)} calibration samples")
+    return net_io.input_names, net_io.samples
+
+
+def quantize(param_path, input_names, samples, algo="KL"):
+    """训练后量化，返回量化模型的路径
+
+    Parameters
+    ----------
+    param_path : str
+        fp32模型权重路径
+    input_names : list
+        网络输入名
+    samples : list
+        每次推理的输入，和input_names一一对应
+    algo : str
+        计算激活值量化范围的方法，KL、hist、avg、mse、abs_max或min_max
+    """
+    import paddle
+    from paddle.static.quantization import PostTrainingQuantization
+
+    try:
+        from paddle.pir_utils import OldIrGuard
+    except ImportError:  # paddle 2.x只有旧的静态图
+        OldIrGuard = contextlib.nullcontext
+
+    model_path = param_path.replace(".pdiparams", ".pdmodel")
+    quant_model_path, quant_param_path = get_quant_paths(model_path, param_path)
+
+    def data_loader():
+        for sample in samples:
+            yield dict(zip(input_names, sample))
+
+    # 量化工具只支持旧的静态图
+    with OldIrGuard():
+        paddle.enable_static()
+        try:
+            ptq = PostTrainingQuantization(
+                executor=paddle.static.Executor(paddle.CPUPlace()),
+                model_dir=osp.dirname(osp.abspath(model_path)),
+                model_filename=osp.basename(model_path),
+                params_filename=osp.basename(param_path),
+                data_loader=data_loader,
+                batch_nums=len(samples),
+                algo=algo,
+            )
+            ptq.quantize()
+            ptq.save_quantized_model(
+                osp.dirname(osp.abspath(quant_model_path)),
+                model_filename=osp.basename(quant_model_path),
+                params_filename=osp.basename(quant_param_path),
+            )
+        finally:
+            paddle.disable_static()
+    logger.info(f"Saved quantized model to {quant_model_path}")
+    return quant_model_path, quant_param_path
+
+
+def benchmark(param_path, precision, samples, repeats=3, num_threads=None):
+    """用校准数据测试平均推理耗时，不计每种输入大小的第一次推理，单位秒"""
+    model_path = param_path.replace(".pdiparams", ".pdmodel")
+    model = EISegModel(model_path, param_path, False, num_threads, precision=precision)
+    net_io = NetIO(model)
+    for _ in range(repeats + 1):
+        for sample in samples:
+            net_io.run(sample)
+    return net_io.latency_report()["repeat_shape_latency"]
+
+
+def evaluate(param_path, precision, image_dir, gt_dir, max_clicks=20, num_threads=None):
+    """模拟点击评估一种精度，返回NoC等指标"""
+    predictor = create_predictor(param_path, precision, num_threads)
+    all_ious = []
+    for path in list_images(image_dir):
+        image = load_image(path)
+        gt_mask = load_gt_mask(get_gt_path(path, gt_dir))
+        all_ious.append(evaluate_sample(predictor, image, gt_mask, max_clicks))
+    return get_noc_metrics(all_ious, max_clicks=max_clicks)
+
+
+def compare(
+    param_path,
+    samples,
+    precisions=PRECISIONS,
+    eval_dir=None,
+    eval_gt_dir=None,
+    max_clicks=20,
+    repeats=3,
+    num_threads=None,
+):
+    """对比各精度的耗时和精度，fp32作为基准"""
+    report = {}
+    for precision in precisions:
+        if precision == "bf16" and not supports_bfloat16():
+            logger.warning("CPU不支持bfloat16，跳过bf16")
+            continue
+        latency = benchmark(param_path, precision, samples, repeats, num_threads)
+        result = {"latency": latency}
+        if eval_dir is not None:
+            result.update(
+                evaluate(
+                    param_path,
+                    precision,
+                    eval_dir,
+                    eval_gt_dir or eval_dir,
+                    max_clicks,
+                    num_threads,
+                )
+            )
+        report[precision] = result
+    base = report.get("fp32")
+    if base is not None:
+        for result in report.values():
+            result["speedup"] = base["latency"] / result["latency"]
+            for key in ("NoC@85", "NoC@90"):
+                if key in base:
+                    result[f"delta_{key}"] = result[key] - base[key]
+    return report
+
+
+def print_report(report):
+    print(f"{'precision':>10}{'latency(ms)':>14}{'speedup':>10}", end="")
+    print(f"{'NoC@85':>10}{'NoC@90':>10}{'mIoU@1':>10}{'mIoU@5':>10}")
+    for precision, result in report.items():
+        miou = result.get("miou_per_click", [])
+        row = [
+            f"{precision:>10}",
+            f"{result['latency'] * 1000:>14.2f}",
+            f"{result.get('speedup', 1.0):>10.2f}",
+        ]
+        for key in ("NoC@85", "NoC@90"):
+            row.append(f"{result[key]:>10.2f}" if key in result else f"{'-':>10}")
+        for idx in (0, 4):
+            row.append(f"{miou[idx]:>10.4f}" if len(miou) > idx else f"{'-':>10}")
+        print("".join(row))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="离线量化模型并对比量化前后的速度和精度")
+    parser.add_argument("--param_path", type=str, required=True, help="fp32模型权重路径")
+    parser.add_argument("--calib_dir", type=str, required=True, help="校准图像文件夹")
+    parser.add_argument(
+        "--calib_gt_dir",
+        type=str,
+        default=None,
+        help="校准图像的标签文件夹，有标签时按标签模拟点击，否则随机点击",
+    )
+    parser.add_argument("--num_images", type=int, default=32, help="最多使用多少张校准图像")
+    parser.add_argument("--num_clicks", type=int, default=3, help="每张校准图像点击几次")
+    parser.add_argument(
+        "--algo",
+        type=str,
+        default="KL",
+        choices=["KL", "hist", "avg", "mse", "abs_max", "min_max"],
+        help="计算激活值量化范围的方法",
+    )
+    parser.add_argument(
+        "--skip_quant", action="store_true", help="不重新量化，只对比已有的量化模型"
+    )
+    parser.add_argument(
+        "--eval_dir", type=str, default=None, help="评估图像文件夹，不设置时只对比速度"
+    )
+    parser.add_argument(
+        "--eval_gt_dir", type=str, default=None, help="评估图像的标签文件夹，默认和图像相同"
+    )
+    parser.add_argument("--max_clicks", type=int, default=20, help="评估时每张图最多点击次数")
+    parser.add_argument(
+        "--precisions", type=str, default=",".join(PRECISIONS), help="对比的精度，逗号分隔"
+    )
+    parser.add_argument("--num_threads", type=int, default=None, help="CPU推理线程数")
+    parser.add_argument("--report", type=str, default=None, help="保存对比结果的json路径")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    input_names, samples = collect_calibration_data(
+        args.param_path,
+        args.calib_dir,
+        args.calib_gt_dir,
+        args.num_images,
+        args.num_clicks,
+    )
+    if not samples:
+        raise ValueError(f"{args.calib_dir} 中没有校准图像")
+    if not args.skip_quant:
+        quantize(args.param_path, input_names, samples, args.algo)
+    precisions = [p.strip() for p in args.precisions.split(",") if p.strip()]
+    report = compare(
+        args.param_path,
+        samples,
+        precisions,
+        args.eval_dir,
+        args.eval_gt_dir,
+        args.max_clicks,
+        num_threads=args.num_threads,
+    )
+    print_report(report)
+    if args.report is not None:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
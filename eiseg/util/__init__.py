@@ -1,7 +1,7 @@
 from .qt import newAction, addActions, struct, newIcon
 from .config import parse_configs, save_configs
 from .colormap import colorMap
-from .polygon import get_polygon, Instructions
+from .polygon import get_polygon, Instructions, LabelRaster
 from .manager import MODELS
 from .language import TransUI
 from .coco.coco import COCO
@@ -21,7 +21,8 @@ def save_configs(path=None, config=None, actions=None):
         f = open(path, "w+")
         f.close()
     if not config:
-        config = {}
+        # 只更新快捷键时保留配置文件中的其他设置
+        config = (parse_configs(path) or {}) if actions else {}
     if actions:
         config["shortcut"] = {}
         for action in actions:
@@ -1,4 +1,3 @@
-import paddle
 import numpy as np
 import pickle
 
@@ -29,6 +28,8 @@ def save_checkpoint(
 
     net = net.module if multi_gpu else net
 
+    import paddle
+
     # model_state = {'state_dict': net.state_dict(),'config': net.__dict__}
     paddle.save(net.state_dict(), checkpoint_path)
 
@@ -189,4 +189,118 @@ def check_size_minmax(polygons, img_size):
             elif y > h_max:
                 y = h_max
             ps[j] = np.array([x, y])
-    return polygons
\ No newline at end of file
+    return polygons
+
+
+class LabelRaster(object):
+    """多边形标注栅格化得到的标签图
+
+    每次更新和上一次的多边形比较，只重画增加、删除或修改的多边形所在的区域，
+    区域内和它相交的多边形按顺序重新填充，后面的多边形覆盖前面的。
+    标签id都不超过255时标签图是uint8，否则是uint16。
+
+    Parameters
+    ----------
+    shape : tuple
+        图像大小(h, w)
+    """
+
+    def __init__(self, shape):
+        self.shape = tuple(shape[:2])
+        self.mask = np.zeros(self.shape, dtype=np.uint8)
+        # [(key, 标签id, 点, 外接矩形)]，按绘制顺序
+        self._polygons = []
+
+    def clear(self):
+        self.mask = np.zeros(self.shape, dtype=np.uint8)
+        self._polygons = []
+
+    def update(self, polygons):
+        """更新多边形并返回标签图，返回的标签图会被之后的更新原地修改
+
+        Parameters
+        ----------
+        polygons : list
+            [(key, 标签id, 点)]，按绘制顺序。key按对象判断是不是同一个多边形，
+            点是[[x, y], ...]
+        """
+        new_polygons = []
+        for key, label, points in polygons:
+            points = np.int32(np.array(points).reshape(-1, 2))
+            new_polygons.append((key, int(label), points, self._get_bbox(points)))
+
+        dtype = np.uint8
+        if new_polygons and max(p[1] for p in new_polygons) > 255:
+            dtype = np.uint16
+        if dtype != self.mask.dtype or self._is_reordered(new_polygons):
+            # 标签类型或多边形的先后顺序变了，整张图重画
+            self.mask = np.zeros(self.shape, dtype=dtype)
+            self._polygons = new_polygons
+            self._redraw((0, self.shape[0], 0, self.shape[1]))
+            return self.mask
+
+        old = {id(p[0]): p for p in self._polygons}
+        new = {id(p[0]): p for p in new_polygons}
+        dirty = []
+        for key, polygon in old.items():
+            if not _same_polygon(polygon, new.get(key)):
+                dirty.append(polygon[3])
+        for key, polygon in new.items():
+            if not _same_polygon(polygon, old.get(key)):
+                dirty.append(polygon[3])
+        self._polygons = new_polygons
+        dirty = [bbox for bbox in dirty if bbox is not None]
+        area = sum((y2 - y1) * (x2 - x1) for y1, y2, x1, x2 in dirty)
+        if area >= self.shape[0] * self.shape[1]:
+            dirty = [(0, self.shape[0], 0, self.shape[1])]
+        for region in dirty:
+            self._redraw(region)
+        return self.mask
+
+    def _is_reordered(self, new_polygons):
+        """两次都有的多边形先后顺序是否变了"""
+        new_keys = set(id(p[0]) for p in new_polygons)
+        old_keys = set(id(p[0]) for p in self._polygons)
+        old_order = [id(p[0]) for p in self._polygons if id(p[0]) in new_keys]
+        new_order = [id(p[0]) for p in new_polygons if id(p[0]) in old_keys]
+        return old_order != new_order
+
+    def _get_bbox(self, points):
+        """点的外接矩形(y1, y2, x1, x2)限制在图像内，不包括y2和x2，在图像外时返回None"""
+        if len(points) == 0:
+            return None
+        x1, y1 = points.min(axis=0)
+        x2, y2 = points.max(axis=0) + 1
+        y1, y2 = max(int(y1), 0), min(int(y2), self.shape[0])
+        x1, x2 = max(int(x1), 0), min(int(x2), self.shape[1])
+        if y1 >= y2 or x1 >= x2:
+            return None
+        return y1, y2, x1, x2
+
+    def _redraw(self, region):
+        """重新填充region内的标签
+
+        OpenCV裁剪超出画布的多边形边时结果和不裁剪不完全一致，所以画布要包含和region
+        相交的多边形的整个外接矩形，填充后只取region内的结果。
+        """
+        y1, y2, x1, x2 = region
+        polygons = []
+        cy1, cy2, cx1, cx2 = region
+        for _, label, points, bbox in self._polygons:
+            if bbox is None or bbox[0] >= y2 or bbox[1] <= y1:
+                continue
+            if bbox[2] >= x2 or bbox[3] <= x1:
+                continue
+            polygons.append((label, points))
+            cy1, cy2 = min(cy1, bbox[0]), max(cy2, bbox[1])
+            cx1, cx2 = min(cx1, bbox[2]), max(cx2, bbox[3])
+        canvas = np.zeros((cy2 - cy1, cx2 - cx1), dtype=self.mask.dtype)
+        for label, points in polygons:
+            cv2.fillPoly(canvas, pts=[points], color=label, offset=(-cx1, -cy1))
+        self.mask[y1:y2, x1:x2] = canvas[y1 - cy1 : y2 - cy1, x1 - cx1 : x2 - cx1]
+
+
+def _same_polygon(p1, p2):
+    if p1 is None or p2 is None:
+        return False
+    return p1[0] is p2[0] and p1[1] == p2[1] and np.array_equal(p1[2], p2[2])
@@ -75,23 +75,45 @@ def blend_mask(image, mask, alpha=0.6):
 
 
 def get_boundaries(instances_masks, boundaries_width=1):
-    boundaries = np.zeros(
-        (instances_masks.shape[0], instances_masks.shape[1]), dtype=np.bool
-    )
-
-    for obj_id in np.unique(instances_masks.flatten()):
-        if obj_id == 0:
-            continue
+    """所有非0标签的边界
+
+    和逐个标签腐蚀boundaries_width次的结果相同：邻域内有其他标签的像素是边界，
+    图像边缘不算。一次最小值滤波和一次最大值滤波算出所有标签，只在非0区域的
+    外接矩形内计算。
+    """
+    boundaries = np.zeros(instances_masks.shape[:2], dtype=bool)
+    bbox = get_mask_bbox(instances_masks != 0)
+    if bbox is None:
+        return boundaries
+    # 外扩boundaries_width，让矩形外的0参与滤波
+    height, width = boundaries.shape
+    y1, y2, x1, x2 = bbox
+    y1, x1 = max(y1 - boundaries_width, 0), max(x1 - boundaries_width, 0)
+    y2 = min(y2 + boundaries_width, height)
+    x2 = min(x2 + boundaries_width, width)
+
+    labels = _as_cv_labels(instances_masks[y1:y2, x1:x2])
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
+    min_labels = cv2.erode(labels, kernel, iterations=boundaries_width)
+    max_labels = cv2.dilate(labels, kernel, iterations=boundaries_width)
+    region = (min_labels != labels) | (max_labels != labels)
+    region &= labels != 0
+    boundaries[y1:y2, x1:x2] = region
+    return boundaries
 
-        obj_mask = instances_masks == obj_id
-        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
-        inner_mask = cv2.erode(
-            obj_mask.astype(np.uint8), kernel, iterations=boundaries_width
-        ).astype(np.bool)
 
-        obj_boundary = np.logical_xor(obj_mask, np.logical_and(inner_mask, obj_mask))
-        boundaries = np.logical_or(boundaries, obj_boundary)
-    return boundaries
+def _as_cv_labels(labels):
+    """转成OpenCV形态学运算支持的类型，标签值不变"""
+    if labels.dtype == bool:
+        return labels.view(np.uint8)
+    if labels.dtype in (np.uint8, np.uint16, np.int16, np.float32, np.float64):
+        return labels
+    vmin, vmax = labels.min(), labels.max()
+    if vmin >= 0 and vmax <= np.iinfo(np.uint16).max:
+        return labels.astype(np.uint16)
+    if vmin >= np.iinfo(np.int16).min and vmax <= np.iinfo(np.int16).max:
+        return labels.astype(np.int16)
+    return labels.astype(np.float64)
 
 
 def draw_with_blend_and_clicks(
@@ -104,27 +126,295 @@ def draw_with_blend_and_clicks(
     radius=4,
     palette=None,
 ):
+    """把标签图按palette混合到img的副本上，再画上点击
+
+    只复制一次图像，混合只在每个标签的外接矩形内查表，和浮点计算相比像素值最多差1。
+    """
     result = img.copy()
 
     if mask is not None:
         if not palette:
             palette = get_palette(np.max(mask) + 1)
-        palette = np.array(palette)
-        rgb_mask = palette[mask.astype(np.uint8)]
-
-        mask_region = (mask > 0).astype(np.uint8)
-        result = (
-            result * (1 - mask_region[:, :, np.newaxis])
-            + (1 - alpha) * mask_region[:, :, np.newaxis] * result
-            + alpha * rgb_mask
-        )
-        result = result.astype(np.uint8)
+        blend_labels(result, mask, palette, alpha)
 
     if clicks_list is not None and len(clicks_list) > 0:
         pos_points = [click.coords for click in clicks_list if click.is_positive]
         neg_points = [click.coords for click in clicks_list if not click.is_positive]
 
-        result = draw_points(result, pos_points, pos_color, radius=radius)
-        result = draw_points(result, neg_points, neg_color, radius=radius)
+        draw_points_inplace(result, pos_points, pos_color, radius=radius)
+        draw_points_inplace(result, neg_points, neg_color, radius=radius)
 
     return result
+
+
+@lru_cache(maxsize=256)
+def _get_blend_lut(color, weight):
+    value = np.arange(256, dtype=np.uint32)[:, np.newaxis]
+    lut = value * (256 - weight) + np.array(color, dtype=np.uint32) * weight + 128
+    lut = (lut >> 8).astype(np.uint8)[np.newaxis]
+    lut.flags.writeable = False
+    return lut
+
+
+def get_blend_lut(color, alpha):
+    """和color按alpha混合的查找表，[1, 256, 通道数]的uint8，按颜色和alpha缓存
+
+    用uint8定点计算：(v * (256 - a) + c * a + 128) >> 8，a = alpha * 256
+    """
+    return _get_blend_lut(tuple(int(c) for c in color), int(round(alpha * 256)))
+
+
+def blend_color(image, mask, color, alpha, buffer=None):
+    """在image上原地把mask为True的像素和color混合
+
+    Parameters
+    ----------
+    image : np.ndarray
+        uint8图像，可以是大图中的一块
+    mask : np.ndarray
+        和image一样大的掩膜
+    color : list
+        混合的颜色，长度和image的通道数相同
+    alpha : float
+        color的权重
+    buffer : np.ndarray
+        和image一样大的uint8临时内存，为None时新建
+    """
+    if buffer is None:
+        buffer = np.empty_like(image)
+    if mask.dtype == bool:
+        mask = mask.view(np.uint8)
+    elif mask.dtype != np.uint8:
+        mask = (mask != 0).view(np.uint8)
+    cv2.LUT(image, get_blend_lut(color, alpha), dst=buffer)
+    cv2.copyTo(buffer, mask, image)
+    return image
+
+
+def blend_labels(image, labels, palette, alpha, bbox=None, buffer=None):
+    """在image上原地把标签图中大于0的像素和各自标签的颜色混合
+
+    Parameters
+    ----------
+    image : np.ndarray
+        uint8图像
+    labels : np.ndarray
+        和image一样大的标签图
+    palette : list
+        每个标签的颜色
+    alpha : float
+        颜色的权重
+    bbox : tuple
+        标签图中非0区域的外接矩形(y1, y2, x1, x2)，为None时重新计算
+    buffer : np.ndarray
+        和image一样大的uint8临时内存，为None时按需新建
+    """
+    if bbox is None:
+        bbox = get_mask_bbox(labels > 0)
+        if bbox is None:
+            return image
+    y1, y2, x1, x2 = bbox
+    roi = image[y1:y2, x1:x2]
+    labels = labels[y1:y2, x1:x2]
+    if buffer is not None:
+        buffer = buffer[y1:y2, x1:x2]
+    for idx in _get_label_ids(labels):
+        if idx <= 0:
+            continue
+        mask = labels == idx
+        ly1, ly2, lx1, lx2 = get_mask_bbox(mask)
+        blend_color(
+            roi[ly1:ly2, lx1:lx2],
+            mask[ly1:ly2, lx1:lx2],
+            palette[idx],
+            alpha,
+            None if buffer is None else buffer[ly1:ly2, lx1:lx2],
+        )
+    return image
+
+
+def _get_label_ids(labels):
+    """标签图中出现的标签，无符号整数用计数代替排序"""
+    if labels.dtype in (bool, np.uint8, np.uint16) and labels.size > 0:
+        counts = np.bincount(labels.ravel())
+        return np.flatnonzero(counts)
+    return np.unique(labels)
+
+
+def draw_points_inplace(image, points, color, radius=3):
+    for p in points:
+        cv2.circle(image, (int(p[1]), int(p[0])), radius, color, -1)
+    return image
+
+
+def get_mask_bbox(mask):
+    """mask中True区域的外接矩形(y1, y2, x1, x2)，不包括y2和x2，为空时返回None"""
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+    return int(rows[0]), int(rows[-1]) + 1, int(cols[0]), int(cols[-1]) + 1
+
+
+def union_bbox(*bboxes):
+    bboxes = [b for b in bboxes if b is not None]
+    if not bboxes:
+        return None
+    y1, y2, x1, x2 = zip(*bboxes)
+    return min(y1), max(y2), min(x1), max(x2)
+
+
+def intersect_bbox(b1, b2):
+    if b1 is None or b2 is None:
+        return None
+    y1, y2 = max(b1[0], b2[0]), min(b1[1], b2[1])
+    x1, x2 = max(b1[2], b2[2]), min(b1[3], b2[3])
+    if y1 >= y2 or x1 >= x2:
+        return None
+    return y1, y2, x1, x2
+
+
+class LayeredVis(object):
+    """分层缓存的标注可视化
+
+    原图、当前物体的掩膜和点击分成三层。掩膜只在它的输入变化时重算；输出图只在掩膜、
+    颜色、透明度或点击变化时，把变化前后涉及区域的外接矩形从原图恢复，
+    再在其中重新混合掩膜、画点，其他区域保持上一次的结果。
+
+    render返回的是缓存的输出图，下一次render会原地修改它。修改过的区域累积起来，
+    显示时用pop_dirty_region取出，只刷新这部分。
+    """
+
+    def __init__(self):
+        self._image = None
+        self._output = None
+        # 混合用的临时内存，和输出图一样大，避免每次render分配
+        self._buffer = None
+        # 上次pop_dirty_region之后输出图中改过的区域
+        self._dirty = None
+        self.reset()
+
+    def reset(self):
+        """清空掩膜和点击层，输出图恢复成原图"""
+        if self._image is not None:
+            np.copyto(self._output, self._image)
+            self._dirty = (0, self._image.shape[0], 0, self._image.shape[1])
+        self._mask_source = None
+        self._mask_params = None
+        self._mask = None
+        self._mask_bbox = None
+        self._blend_key = None
+        self._blend_bbox = None
+        self._clicks_key = None
+        self._clicks_bbox = None
+
+    def set_image(self, image):
+        """设置底图，同一个图像数组（按对象判断）不会重复复制"""
+        if image is self._image:
+            return
+        self._image = image
+        self._output = np.ascontiguousarray(image).copy()
+        self._buffer = np.empty_like(self._output)
+        self.reset()
+
+    def update_mask(self, source, params, compute):
+        """source（按对象判断）或params变化时用compute()重算掩膜
+
+        Parameters
+        ----------
+        source : object
+            掩膜的来源，一般是概率图
+        params : tuple
+            影响掩膜的其他参数，如阈值
+        compute : callable
+            返回bool掩膜，没有掩膜时返回None
+        """
+        if (
+            self._mask_params is not None
+            and source is self._mask_source
+            and params == self._mask_params
+        ):
+            return
+        self._mask_source = source
+        self._mask_params = params
+        self._mask = compute()
+        self._mask_bbox = None if self._mask is None else get_mask_bbox(self._mask)
+
+    def render(
+        self,
+        color,
+        alpha=0.6,
+        clicks_list=None,
+        radius=4,
+        pos_color=(0, 255, 0),
+        neg_color=(255, 0, 0),
+    ):
+        """用color和alpha混合掩膜再画上点击，和draw_with_blend_and_clicks相比混合的像素值最多差1"""
+        clicks_list = clicks_list if clicks_list is not None else []
+        pos_points = [click.coords for click in clicks_list if click.is_positive]
+        neg_points = [click.coords for click in clicks_list if not click.is_positive]
+
+        dirty = []
+        blend_key = (self._mask_source, self._mask_params, tuple(color), alpha)
+        if self._blend_key is None or not _same_key(blend_key, self._blend_key):
+            dirty += [self._blend_bbox, self._mask_bbox]
+            self._blend_key = blend_key
+            self._blend_bbox = self._mask_bbox
+        points = [(int(p[0]), int(p[1])) for p in pos_points + neg_points]
+        clicks_key = (tuple(points), len(pos_points), radius, pos_color, neg_color)
+        if clicks_key != self._clicks_key:
+            dirty += [self._clicks_bbox, self._get_points_bbox(points, radius)]
+            self._clicks_key = clicks_key
+            self._clicks_bbox = self._get_points_bbox(points, radius)
+
+        region = union_bbox(*dirty)
+        if region is None:
+            return self._output
+        self._dirty = union_bbox(self._dirty, region)
+        y1, y2, x1, x2 = region
+        self._output[y1:y2, x1:x2] = self._image[y1:y2, x1:x2]
+        blend_region = intersect_bbox(region, self._mask_bbox)
+        if blend_region is not None:
+            y1, y2, x1, x2 = blend_region
+            blend_color(
+                self._output[y1:y2, x1:x2],
+                self._mask[y1:y2, x1:x2],
+                color,
+                alpha,
+                self._buffer[y1:y2, x1:x2],
+            )
+        # 恢复的区域可能擦掉了其他点，所有点重画一遍，颜色不透明所以结果不变
+        draw_points_inplace(self._output, pos_points, pos_color, radius)
+        draw_points_inplace(self._output, neg_points, neg_color, radius)
+        return self._output
+
+    def pop_dirty_region(self):
+        """取出上次调用之后输出图中改过的区域(y1, y2, x1, x2)，没有改过时返回None"""
+        region = self._dirty
+        self._dirty = None
+        return region
+
+    def _get_points_bbox(self, points, radius):
+        if not points:
+            return None
+        ys, xs = zip(*points)
+        height, width = self._image.shape[:2]
+        bbox = (
+            max(min(ys) - radius, 0),
+            min(max(ys) + radius + 1, height),
+            max(min(xs) - radius, 0),
+            min(max(xs) + radius + 1, width),
+        )
+        if bbox[0] >= bbox[1] or bbox[2] >= bbox[3]:
+            return None
+        return bbox
+
+
+def _same_key(k1, k2):
+    """逐项比较，数组等对象按是否是同一个对象判断"""
+    for a, b in zip(k1, k2):
+        if a is b:
+            continue
+        if isinstance(a, np.ndarray) or isinstance(b, np.ndarray) or a != b:
+            return False
+    return len(k1) == len(k2)
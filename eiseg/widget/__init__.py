@@ -6,6 +6,7 @@ from .bbox import BBoxAnnotation
 from .polygon import PolygonAnnotation
 from .scene import AnnotationScene
 from .view import AnnotationView
+from .image import TiledImageItem
 from .create import (
     create_text, create_button, create_slider, DockWidget, creat_dock
 )
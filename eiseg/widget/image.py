@@ -0,0 +1,156 @@
+# Copyright (c) 2021 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import math
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+from qtpy import QtWidgets, QtGui, QtCore
+
+
+class TiledImageItem(QtWidgets.QGraphicsItem):
+    """按金字塔和分块显示大图的画布
+
+    第0层是原图，第k层缩小2^k倍。绘制时按当前缩放选择一层，只把视口中露出的块转成
+    QPixmap，缩放不到一半时不会用原图绘制。setImage传入的图像之后可以原地修改，
+    修改后用updateRegion通知变化的区域，只有和它相交的块会在下次显示时重新转换。
+
+    Parameters
+    ----------
+    tile_size : int
+        每一块的边长
+    max_tiles : int
+        最多缓存多少块QPixmap，超过后丢弃最久没有显示的块
+    """
+
+    def __init__(self, tile_size=256, max_tiles=512):
+        super(TiledImageItem, self).__init__()
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        self.image = None
+        self._levels = []
+        # 每一层中已经是最新的块，第0层直接读原图不需要记录
+        self._valid = []
+        # (层, 行, 列) -> QPixmap
+        self._pixmaps = OrderedDict()
+        self.setFlag(QtWidgets.QGraphicsItem.ItemUsesExtendedStyleOption, True)
+
+    def setImage(self, image):
+        """显示一张新图，image是[H, W, 3]的RGB uint8数组，为None时清空"""
+        self.prepareGeometryChange()
+        self.image = image
+        self._pixmaps.clear()
+        self._levels = []
+        self._valid = []
+        if image is not None:
+            num_levels = 1 + max(0, int(math.log2(max(image.shape[:2]))))
+            self._levels = [image] + [None] * (num_levels - 1)
+            self._valid = [None] + [set() for _ in range(num_levels - 1)]
+        self.update()
+
+    def updateRegion(self, bbox=None):
+        """image中(y1, y2, x1, x2)区域的像素变了，bbox为None时整张图都变了"""
+        if self.image is None:
+            return
+        height, width = self.image.shape[:2]
+        if bbox is None:
+            bbox = (0, height, 0, width)
+        y1, y2, x1, x2 = bbox
+        if y1 >= y2 or x1 >= x2:
+            return
+        for level in range(len(self._levels)):
+            size = self.tile_size << level
+            for row in range(y1 // size, (y2 - 1) // size + 1):
+                for col in range(x1 // size, (x2 - 1) // size + 1):
+                    self._pixmaps.pop((level, row, col), None)
+                    if level > 0:
+                        self._valid[level].discard((row, col))
+        self.update(QtCore.QRectF(x1, y1, x2 - x1, y2 - y1))
+
+    def boundingRect(self):
+        if self.image is None:
+            return QtCore.QRectF()
+        height, width = self.image.shape[:2]
+        return QtCore.QRectF(0, 0, width, height)
+
+    def paint(self, painter, option, widget=None):
+        if self.image is None:
+            return
+        lod = option.levelOfDetailFromTransform(painter.worldTransform())
+        level = 0
+        if lod < 1:
+            level = min(int(math.log2(1 / lod)), len(self._levels) - 1)
+        # 放大时不插值，方便看清像素
+        painter.setRenderHint(QtGui.QPainter.SmoothPixmapTransform, lod < 1)
+
+        height, width = self.image.shape[:2]
+        rect = option.exposedRect.intersected(self.boundingRect())
+        if rect.isEmpty():
+            return
+        size = self.tile_size << level
+        row1, col1 = int(rect.top()) // size, int(rect.left()) // size
+        row2 = min(int(math.ceil(rect.bottom())), height) - 1
+        col2 = min(int(math.ceil(rect.right())), width) - 1
+        for row in range(row1, row2 // size + 1):
+            for col in range(col1, col2 // size + 1):
+                pixmap = self._get_pixmap(level, row, col)
+                target = QtCore.QRectF(
+                    col * size,
+                    row * size,
+                    min(size, width - col * size),
+                    min(size, height - row * size),
+                )
+                painter.drawPixmap(target, pixmap, QtCore.QRectF(pixmap.rect()))
+
+    def _get_pixmap(self, level, row, col):
+        key = (level, row, col)
+        pixmap = self._pixmaps.pop(key, None)
+        if pixmap is None:
+            tile = self._get_tile(level, row, col)
+            height, width = tile.shape[:2]
+            image = QtGui.QImage(
+                tile.data, width, height, tile.strides[0], QtGui.QImage.Format_RGB888
+            )
+            pixmap = QtGui.QPixmap.fromImage(image)
+        self._pixmaps[key] = pixmap
+        while len(self._pixmaps) > self.max_tiles:
+            self._pixmaps.popitem(last=False)
+        return pixmap
+
+    def _get_tile(self, level, row, col):
+        """第level层的一块，不是最新的时候从原图对应的区域缩小得到"""
+        ts = self.tile_size
+        if level == 0:
+            tile = self.image[row * ts : (row + 1) * ts, col * ts : (col + 1) * ts]
+            return np.ascontiguousarray(tile)
+        array = self._levels[level]
+        if array is None:
+            height, width = self.image.shape[:2]
+            shape = (-(-height >> level), -(-width >> level), self.image.shape[2])
+            array = self._levels[level] = np.empty(shape, dtype=np.uint8)
+        tile = array[row * ts : (row + 1) * ts, col * ts : (col + 1) * ts]
+        if (row, col) not in self._valid[level]:
+            size = ts << level
+            y1, x1 = row * size, col * size
+            src = self.image[y1 : y1 + size, x1 : x1 + size]
+            cv2.resize(
+                src,
+                (tile.shape[1], tile.shape[0]),
+                dst=tile,
+                interpolation=cv2.INTER_AREA,
+            )
+            self._valid[level].add((row, col))
+        return np.ascontiguousarray(tile)
@@ -23,9 +23,8 @@ class AnnotationView(QtWidgets.QGraphicsView):
 
     def __init__(self, *args):
         super(AnnotationView, self).__init__(*args)
-        self.setRenderHints(
-            QtGui.QPainter.Antialiasing | QtGui.QPainter.SmoothPixmapTransform
-        )
+        # 图像的插值由TiledImageItem按缩放决定
+        self.setRenderHints(QtGui.QPainter.Antialiasing)
         self.setMouseTracking(True)
         self.setTransformationAnchor(QtWidgets.QGraphicsView.NoAnchor)
         self.setResizeAnchor(QtWidgets.QGraphicsView.NoAnchor)
@@ -49,6 +49,10 @@ setup(
     entry_points={
         "console_scripts": [
             "eiseg=eiseg.run:main",
+            "eiseg-batch=eiseg.batch:main",
+            "eiseg-autotune=eiseg.autotune:main",
+            "eiseg-quantize=eiseg.quantize:main",
+            "eiseg-bench=eiseg.bench:main",
         ]
     },
 )
@@ -0,0 +1,182 @@
+# Copyright (c) 2021 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+对比util.vis中查表混合、单次形态学求边界和原来的浮点实现在4K、8K图像上的耗时。
+
+用法：python tool/vis_bench.py --sizes 4k,8k --repeats 5
+"""
+
+import os.path as osp
+import sys
+import time
+import argparse
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, osp.join(osp.dirname(osp.abspath(__file__)), ".."))
+import eiseg  # noqa: E402,F401  把eiseg目录加入sys.path
+from util.vis import (  # noqa: E402
+    LayeredVis,
+    draw_with_blend_and_clicks,
+    get_boundaries,
+)
+
+SIZES = {"1080p": (1080, 1920), "4k": (2160, 3840), "8k": (4320, 7680)}
+PALETTE = [[0, 0, 0], [255, 0, 0], [0, 255, 0], [0, 0, 255], [255, 255, 0]]
+
+
+class Click(object):
+    def __init__(self, is_positive, coords):
+        self.is_positive = is_positive
+        self.coords = coords
+
+
+def reference_draw(img, mask, alpha, clicks_list, palette, radius=4):
+    """原来的draw_with_blend_and_clicks：整图转浮点混合，每组点复制一次图像"""
+    result = img.copy()
+    rgb_mask = np.array(palette)[mask.astype(np.uint8)]
+    mask_region = (mask > 0).astype(np.uint8)
+    result = (
+        result * (1 - mask_region[:, :, np.newaxis])
+        + (1 - alpha) * mask_region[:, :, np.newaxis] * result
+        + alpha * rgb_mask
+    )
+    result = result.astype(np.uint8)
+    for is_positive, color in ((True, (0, 255, 0)), (False, (255, 0, 0))):
+        result = result.copy()
+        for click in clicks_list:
+            if click.is_positive == is_positive:
+                p = click.coords
+                cv2.circle(result, (int(p[1]), int(p[0])), radius, color, -1)
+    return result
+
+
+def reference_boundaries(labels, boundaries_width=1):
+    """原来的get_boundaries：每个标签在整图上腐蚀一次"""
+    boundaries = np.zeros(labels.shape, dtype=bool)
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
+    for obj_id in np.unique(labels):
+        if obj_id == 0:
+            continue
+        obj_mask = labels == obj_id
+        inner = cv2.erode(
+            obj_mask.astype(np.uint8), kernel, iterations=boundaries_width
+        ).astype(bool)
+        boundaries |= obj_mask & ~inner
+    return boundaries
+
+
+def make_scene(height, width, num_objects, seed=0):
+    """随机图像，num_objects个互相遮挡的椭圆标签集中在图像中部"""
+    rng = np.random.RandomState(seed)
+    image = rng.randint(0, 256, (height, width, 3), dtype=np.uint8)
+    labels = np.zeros((height, width), dtype=np.uint8)
+    for idx in range(num_objects):
+        center = (
+            int(width * rng.uniform(0.35, 0.65)),
+            int(height * rng.uniform(0.35, 0.65)),
+        )
+        axes = (
+            int(width * rng.uniform(0.03, 0.12)),
+            int(height * rng.uniform(0.03, 0.12)),
+        )
+        label = idx % (len(PALETTE) - 1) + 1
+        cv2.ellipse(labels, center, axes, 0, 0, 360, label, -1)
+    clicks = [
+        Click(bool(i % 3), (int(rng.randint(height)), int(rng.randint(width))))
+        for i in range(10)
+    ]
+    return image, labels, clicks
+
+
+def timeit(func, repeats):
+    """多次运行的最短耗时，单位毫秒，返回耗时和最后一次的结果"""
+    best = float("inf")
+    for _ in range(repeats):
+        tic = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - tic)
+    return best * 1000, result
+
+
+def bench_size(name, height, width, num_objects, repeats, alpha=0.6):
+    image, labels, clicks = make_scene(height, width, num_objects)
+    rows = []
+
+    old_ms, expected = timeit(
+        lambda: reference_draw(image, labels, alpha, clicks, PALETTE), repeats
+    )
+    new_ms, result = timeit(
+        lambda: draw_with_blend_and_clicks(
+            image, labels, alpha, clicks, palette=PALETTE
+        ),
+        repeats,
+    )
+    diff = int(np.abs(result.astype(np.int16) - expected).max())
+    rows.append(("blend+clicks", old_ms, new_ms, f"max diff {diff}"))
+
+    old_ms, expected = timeit(lambda: reference_boundaries(labels), repeats)
+    new_ms, result = timeit(lambda: get_boundaries(labels), repeats)
+    equal = np.array_equal(result, expected)
+    rows.append(("boundaries", old_ms, new_ms, f"equal {equal}"))
+
+    # 交互中只移动一个点时的增量重画
+    vis = LayeredVis()
+    vis.set_image(image)
+    mask = labels == 1
+    vis.update_mask(mask, (), lambda: mask)
+    vis.render(PALETTE[1], alpha, clicks)
+    moved = list(clicks)
+
+    def render_moved():
+        y, x = moved[-1].coords
+        moved[-1] = Click(moved[-1].is_positive, (y, (x + 7) % width))
+        return vis.render(PALETTE[1], alpha, moved)
+
+    new_ms, _ = timeit(render_moved, repeats)
+    old_ms, _ = timeit(
+        lambda: reference_draw(image, mask.view(np.uint8), alpha, moved, PALETTE),
+        repeats,
+    )
+    rows.append(("move click", old_ms, new_ms, "LayeredVis"))
+
+    print(f"{name} ({width}x{height}, {num_objects} objects)")
+    print(f"{'case':>14}{'old(ms)':>12}{'new(ms)':>12}{'speedup':>10}  note")
+    for case, old_ms, new_ms, note in rows:
+        speedup = old_ms / new_ms
+        print(f"{case:>14}{old_ms:>12.2f}{new_ms:>12.2f}{speedup:>10.1f}  {note}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="对比可视化混合和求边界的新旧实现的耗时")
+    parser.add_argument(
+        "--sizes", type=str, default="4k,8k", help="图像大小，逗号分隔，可选1080p、4k、8k"
+    )
+    parser.add_argument("--num_objects", type=int, default=8, help="标签图中的物体数")
+    parser.add_argument("--repeats", type=int, default=5, help="每种情况运行几次取最短耗时")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    for name in args.sizes.split(","):
+        name = name.strip().lower()
+        if name not in SIZES:
+            raise ValueError(f"不支持的图像大小{name}，可选{list(SIZES)}")
+        bench_size(name, *SIZES[name], args.num_objects, args.repeats)
+
+
+if __name__ == "__main__":
+    main()